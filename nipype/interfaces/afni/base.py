@@ -7,6 +7,7 @@ import os
 import warnings
 
 from ...utils.filemanip import fname_presuffix, split_filename
+from ...utils.toolcache import cached_version
 from ..base import (
     CommandLine, traits, CommandLineInputSpec, isdefined, File, TraitedSpec)
 
@@ -29,6 +30,7 @@ class Info(object):
               'NIFTI_GZ': '.nii.gz'}
 
     @staticmethod
+    @cached_version('afni')
     def version():
         """Check for afni version on system
 
@@ -8,21 +8,22 @@ Exaples  FSL, matlab/SPM , afni
 Requires Packages to be installed
 """
 
+from collections import deque
 from ConfigParser import NoOptionError
+from contextlib import contextmanager
 from copy import deepcopy
 from cPickle import dumps
 import datetime
-import errno
 import json
 import os
 import re
 import platform
 import pwd
-from socket import getfqdn
+from socket import getfqdn, gethostname
 from string import Template
-import select
 import subprocess
 import sys
+import threading
 from textwrap import wrap
 from datetime import datetime as dt
 from dateutil.parser import parse as parseutc
@@ -39,10 +40,10 @@ from .traits_extension import (traits, Undefined, TraitDictObject,
                                TraitListObject, TraitError,
                                isdefined, File, Directory,
                                has_metadata)
-from ..utils.filemanip import (md5, hash_infile, FileNotFoundError,
-                               hash_timestamp, save_json,
-                               split_filename)
+from ..utils.filemanip import (md5, FileNotFoundError, hash_file,
+                               hash_infiles, save_json, split_filename)
 from ..utils.misc import is_container, trim, str2bool
+from ..utils.toolcache import get_cached, set_cached
 from .. import config, logging
 from .. import __version__
 
@@ -424,15 +425,7 @@ class BaseTraitedSpec(traits.HasTraits):
                 hashlist = self._hash_infile({'infiles': afile}, 'infiles')
                 hash = [val[1] for val in hashlist]
             else:
-                if config.get('execution',
-                              'hash_method').lower() == 'timestamp':
-                    hash = hash_timestamp(afile)
-                elif config.get('execution',
-                                'hash_method').lower() == 'content':
-                    hash = hash_infile(afile)
-                else:
-                    raise Exception("Unknown hash method: %s" %
-                                    config.get('execution', 'hash_method'))
+                hash = hash_file(afile)
             file_list.append((afile, hash))
         return file_list
 
@@ -510,8 +503,10 @@ class BaseTraitedSpec(traits.HasTraits):
 
         """
 
-        dict_withhash = {}
-        dict_nofilename = {}
+        if hash_method is None:
+            hash_method = config.get('execution', 'hash_method')
+        items = []
+        files = []
         for name, val in sorted(self.get().items()):
             if isdefined(val):
                 trait = self.trait(name)
@@ -521,55 +516,85 @@ class BaseTraitedSpec(traits.HasTraits):
                                                False)
                               and not has_metadata(trait.trait_type,
                                                    "name_source"))
-                dict_nofilename[name] = \
-                    self._get_sorteddict(val, hash_method=hash_method,
-                                         hash_files=hash_files)
-                dict_withhash[name] = \
-                    self._get_sorteddict(val, True, hash_method=hash_method,
-                                         hash_files=hash_files)
+                items.append((name, val, hash_files))
+                if hash_files:
+                    self._get_hash_files(val, files)
+        # hash the input files concurrently, then look the hashes up
+        file_hashes = hash_infiles(files, hash_method)
+        dict_withhash = {}
+        dict_nofilename = {}
+        for name, val, hash_files in items:
+            dict_withhash[name], dict_nofilename[name] = \
+                self._get_sorteddicts(val, hash_method=hash_method,
+                                      hash_files=hash_files,
+                                      file_hashes=file_hashes)
         return (dict_withhash, md5(str(dict_nofilename)).hexdigest())
 
     def _get_sorteddict(self, object, dictwithhash=False, hash_method=None,
                         hash_files=True):
+        withhash, nofilename = self._get_sorteddicts(object,
+                                                     hash_method=hash_method,
+                                                     hash_files=hash_files)
+        if dictwithhash:
+            return withhash
+        return nofilename
+
+    def _get_hash_files(self, object, files):
+        """Appends the existing files found in object to files"""
         if isinstance(object, dict):
-            out = {}
+            for val in object.values():
+                self._get_hash_files(val, files)
+        elif isinstance(object, (list, tuple)):
+            for val in object:
+                self._get_hash_files(val, files)
+        elif isinstance(object, str) and os.path.isfile(object):
+            files.append(object)
+
+    def _get_sorteddicts(self, object, hash_method=None, hash_files=True,
+                         file_hashes=None):
+        """Returns the sorted values of object with and without file names
+
+        Both versions are built in a single traversal so that every file is
+        hashed only once. Hashes found in file_hashes are not recomputed.
+        """
+        if isinstance(object, dict):
+            withhash = {}
+            nofilename = {}
             for key, val in sorted(object.items()):
                 if isdefined(val):
-                    out[key] = \
-                        self._get_sorteddict(val, dictwithhash,
-                                             hash_method=hash_method,
-                                             hash_files=hash_files)
+                    withhash[key], nofilename[key] = \
+                        self._get_sorteddicts(val, hash_method=hash_method,
+                                              hash_files=hash_files,
+                                              file_hashes=file_hashes)
         elif isinstance(object, (list, tuple)):
-            out = []
+            withhash = []
+            nofilename = []
             for val in object:
                 if isdefined(val):
-                    out.append(self._get_sorteddict(val, dictwithhash,
-                                                    hash_method=hash_method,
-                                                    hash_files=hash_files))
+                    outs = self._get_sorteddicts(val, hash_method=hash_method,
+                                                 hash_files=hash_files,
+                                                 file_hashes=file_hashes)
+                    withhash.append(outs[0])
+                    nofilename.append(outs[1])
             if isinstance(object, tuple):
-                out = tuple(out)
+                withhash = tuple(withhash)
+                nofilename = tuple(nofilename)
         else:
+            withhash = nofilename = None
             if isdefined(object):
                 if (hash_files and isinstance(object, str) and
                         os.path.isfile(object)):
-                    if hash_method is None:
-                        hash_method = config.get('execution', 'hash_method')
-
-                    if hash_method.lower() == 'timestamp':
-                        hash = hash_timestamp(object)
-                    elif hash_method.lower() == 'content':
-                        hash = hash_infile(object)
+                    if file_hashes and object in file_hashes:
+                        hash = file_hashes[object]
                     else:
-                        raise Exception("Unknown hash method: %s" % hash_method)
-                    if dictwithhash:
-                        out = (object, hash)
-                    else:
-                        out = hash
+                        hash = hash_file(object, hash_method)
+                    withhash = (object, hash)
+                    nofilename = hash
                 elif isinstance(object, float):
-                    out = '%.10f' % object
+                    withhash = nofilename = '%.10f' % object
                 else:
-                    out = object
-        return out
+                    withhash = nofilename = object
+        return withhash, nofilename
 
 
 class DynamicTraitedSpec(BaseTraitedSpec):
@@ -691,9 +716,9 @@ def safe_encode(x):
     if isinstance(x, (str, unicode)):
         if os.path.exists(x):
             try:
-                return pm.URIRef('file://%s%s' % (getfqdn(), x))
+                return pm.URIRef('file://%s%s' % (get_fqdn(), x))
             except AttributeError:
-                return pm.Literal('file://%s%s' % (getfqdn(), x),
+                return pm.Literal('file://%s%s' % (get_fqdn(), x),
                                   pm.XSD['anyURI'])
         else:
             return pm.Literal(x, pm.XSD['string'])
@@ -752,6 +777,9 @@ class BaseInterface(Interface):
     """
     input_spec = BaseInterfaceInputSpec
     _version = None
+    # provenance mode set by the node running the interface; None uses the
+    # global configuration
+    _provenance_mode = None
 
     def __init__(self, **inputs):
         if not self.input_spec:
@@ -981,16 +1009,21 @@ class BaseInterface(Interface):
         self._check_mandatory_inputs()
         self._check_version_requirements(self.inputs)
         interface = self.__class__
+        prov_mode = self._provenance_mode or provenance_mode()
         # initialize provenance tracking
-        env = deepcopy(os.environ.data)
+        env = dict(os.environ)
+        if runtime_capture_level() == 'none':
+            hostname = gethostname()
+        else:
+            hostname = get_fqdn()
         runtime = Bunch(cwd=os.getcwd(),
                         returncode=None,
                         duration=None,
                         environ=env,
                         startTime=dt.isoformat(dt.utcnow()),
                         endTime=None,
-                        platform=platform.platform(),
-                        hostname=getfqdn(),
+                        platform=get_platform(),
+                        hostname=hostname,
                         version=self.version)
         try:
             runtime = self._run_interface(runtime)
@@ -1002,7 +1035,9 @@ class BaseInterface(Interface):
             results = InterfaceResult(interface, runtime,
                                       inputs=self.inputs.get_traitsfree(),
                                       outputs=outputs)
-            prov_record = self.write_provenance(results)
+            prov_record = None
+            if prov_mode == 'node':
+                prov_record = self.write_provenance(results)
             results.provenance = prov_record
         except Exception, e:
             runtime.endTime = dt.isoformat(dt.utcnow())
@@ -1037,10 +1072,12 @@ class BaseInterface(Interface):
             except Exception, e:
                 pass
             results = InterfaceResult(interface, runtime, inputs=inputs)
-            try:
-                prov_record = self.write_provenance(results)
-            except Exception:
-                prov_record = None
+            prov_record = None
+            if prov_mode == 'node':
+                try:
+                    prov_record = self.write_provenance(results)
+                except Exception:
+                    prov_record = None
             results.provenance = prov_record
             if hasattr(self.inputs, 'ignore_exception') and \
                     isdefined(self.inputs.ignore_exception) and \
@@ -1244,127 +1281,203 @@ class BaseInterface(Interface):
         return g
 
 
+class WorkingDirectoryLock(object):
+    """Serialises the threads of a process that depend on its working directory
+
+    Interfaces and nodes change and use the process working directory, so
+    threads running them hold this lock. A thread releases it while it only
+    waits for a subprocess (see `run_command`) and gets its working
+    directory back when it reacquires it.
+
+    >>> lock = WorkingDirectoryLock()
+    >>> with lock:
+    ...     with lock.released():
+    ...         pass
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._local.held = True
+        return self
+
+    def __exit__(self, *args):
+        self._local.held = False
+        self._lock.release()
+
+    @contextmanager
+    def released(self):
+        """Releases the lock for the block if the current thread holds it"""
+        if not getattr(self._local, 'held', False):
+            yield
+            return
+        cwd = os.getcwd()
+        self.__exit__()
+        try:
+            yield
+        finally:
+            self.__enter__()
+            os.chdir(cwd)
+
+
+working_directory_lock = WorkingDirectoryLock()
+
+
 class Stream(object):
     """Function to capture stdout and stderr streams with timestamps
 
     stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359
+
+    The stream is read line by line, blocking until data or EOF, by `read`
+    (usually on a thread of its own). At most `max_lines` rows are kept in
+    memory; once more lines are read, the complete output is spilled to
+    `spillfile` and only the most recent rows stay in memory.
     """
 
-    def __init__(self, name, impl):
+    def __init__(self, name, impl, log=False, max_lines=None,
+                 spillfile=None):
         self._name = name
         self._impl = impl
-        self._buf = ''
-        self._rows = []
-        self._lastidx = 0
+        self._log = log
+        self._rows = deque(maxlen=max_lines)
+        self._spillfile = spillfile
+        self._spill = None
 
     def fileno(self):
         "Pass-through for file descriptor."
         return self._impl.fileno()
 
-    def read(self, drain=0):
-        "Read from the file descriptor. If 'drain' set, read until EOF."
-        while self._read(drain) is not None:
-            if not drain:
-                break
-
-    def _read(self, drain):
-        "Read from the file descriptor"
-        fd = self.fileno()
-        buf = os.read(fd, 4096)
-        if not buf and not self._buf:
-            return None
-        if '\n' not in buf:
-            if not drain:
-                self._buf += buf
-                return []
-
-        # prepend any data previously read, then split into lines and format
-        buf = self._buf + buf
-        if '\n' in buf:
-            tmp, rest = buf.rsplit('\n', 1)
-        else:
-            tmp = buf
-            rest = None
-        self._buf = rest
-        now = datetime.datetime.now().isoformat()
-        rows = tmp.split('\n')
-        self._rows += [(now, '%s %s:%s' % (self._name, now, r), r)
-                       for r in rows]
-        for idx in range(self._lastidx, len(self._rows)):
-            iflogger.info(self._rows[idx][1])
-        self._lastidx = len(self._rows)
+    @property
+    def lines(self):
+        """The lines kept in memory, without their line terminators"""
+        return [row[2] for row in self._rows]
+
+    @property
+    def spilled(self):
+        return self._spill is not None
 
+    def read(self, drain=0):
+        "Read from the file descriptor until EOF."
+        try:
+            for line in iter(self._impl.readline, ''):
+                self._add_row(line.rstrip('\n'))
+        finally:
+            if self._spill is not None:
+                self._spill.close()
 
-def run_command(runtime, output=None, timeout=0.01):
+    def _add_row(self, line):
+        now = datetime.datetime.now().isoformat()
+        row = (now, '%s %s:%s' % (self._name, now, line), line)
+        if self._log:
+            iflogger.info(row[1])
+        if self._spill is None and len(self._rows) == self._rows.maxlen:
+            if self._spillfile is None:
+                # no spill file: only the most recent lines are kept
+                self._rows.append(row)
+                return
+            self._spill = open(self._spillfile, 'wt')
+            for oldrow in self._rows:
+                self._spill.write(oldrow[2] + '\n')
+        if self._spill is not None:
+            self._spill.write(line + '\n')
+        self._rows.append(row)
+
+
+def run_command(runtime, output=None, timeout=0.01, max_lines=100000):
     """Run a command, read stdout and stderr, prefix with timestamp.
 
     The returned runtime contains a merged stdout+stderr log with timestamps
-    """
-    PIPE = subprocess.PIPE
-    proc = subprocess.Popen(runtime.cmdline,
-                             stdout=PIPE,
-                             stderr=PIPE,
-                             shell=True,
-                             cwd=runtime.cwd,
-                             env=runtime.environ)
-    result = {}
-    if output == 'stream':
-        streams = [Stream('stdout', proc.stdout), Stream('stderr', proc.stderr)]
-
-        def _process(drain=0):
-            try:
-                res = select.select(streams, [], [], timeout)
-            except select.error, e:
-                iflogger.info(str(e))
-                if e[0] == errno.EINTR:
-                    return
-                else:
-                    raise
-            else:
-                for stream in res[0]:
-                    stream.read(drain)
 
-        while proc.returncode is None:
-            proc.poll()
-            _process()
-        _process(drain=1)
+    The command is started once. Depending on `output`:
 
-        # collect results, merge and return
-        result = {}
-        temp = []
-        for stream in streams:
-            rows = stream._rows
-            temp += rows
-            result[stream._name] = [r[2] for r in rows]
-        temp.sort()
-        result['merged'] = [r[1] for r in temp]
-    if output == 'allatonce':
-        stdout, stderr = proc.communicate()
-        result['stdout'] = stdout.split('\n')
-        result['stderr'] = stderr.split('\n')
-        result['merged'] = ''
-    if output == 'file':
-        errfile = os.path.join(runtime.cwd, 'stderr.nipype')
-        outfile = os.path.join(runtime.cwd, 'stdout.nipype')
-        stderr = open(errfile, 'wt')
-        stdout = open(outfile, 'wt')
+    - stream: the output is read by one thread per pipe, logged line by line
+      and merged with timestamps
+    - allatonce: the output is read by one thread per pipe
+    - file: the output is written to stdout.nipype and stderr.nipype in the
+      working directory
+    - none: the output is discarded
+
+    runtime.stdout and runtime.stderr hold the output lines joined by
+    newlines. At most `max_lines` lines of each are kept in memory; longer
+    outputs are spilled in full to stdout.nipype and stderr.nipype. The
+    `timeout` argument is no longer used. A thread holding
+    `working_directory_lock` releases it while the command runs.
+    """
+    if output not in ['stream', 'allatonce', 'file', 'none']:
+        raise ValueError('Unknown terminal output: %s' % output)
+    errfile = os.path.join(runtime.cwd, 'stderr.nipype')
+    outfile = os.path.join(runtime.cwd, 'stdout.nipype')
+    result = {'merged': ''}
+    if output in ['stream', 'allatonce']:
+        PIPE = subprocess.PIPE
         proc = subprocess.Popen(runtime.cmdline,
-                                stdout=stdout,
-                                stderr=stderr,
+                                stdout=PIPE,
+                                stderr=PIPE,
                                 shell=True,
                                 cwd=runtime.cwd,
                                 env=runtime.environ)
-        ret_code = proc.wait()
-        stderr.flush()
-        stdout.flush()
-        result['stdout'] = [line.strip() for line in open(outfile).readlines()]
-        result['stderr'] = [line.strip() for line in open(errfile).readlines()]
-        result['merged'] = ''
-    if output == 'none':
-        proc.communicate()
+        streams = [Stream('stdout', proc.stdout, log=output == 'stream',
+                          max_lines=max_lines, spillfile=outfile),
+                   Stream('stderr', proc.stderr, log=output == 'stream',
+                          max_lines=max_lines, spillfile=errfile)]
+        threads = [threading.Thread(target=stream.read) for stream in streams]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        with working_directory_lock.released():
+            for thread in threads:
+                thread.join()
+            proc.wait()
+        for stream in streams:
+            result[stream._name] = stream.lines
+            if stream.spilled:
+                iflogger.info('Output of %s truncated to the last %d lines, '
+                              'see %s' % (runtime.cmdline, max_lines,
+                                          stream._spillfile))
+        if output == 'stream':
+            # collect results, merge and return
+            temp = []
+            for stream in streams:
+                temp += stream._rows
+            temp.sort()
+            result['merged'] = [r[1] for r in temp]
+    elif output == 'file':
+        stderr = open(errfile, 'wt')
+        stdout = open(outfile, 'wt')
+        try:
+            proc = subprocess.Popen(runtime.cmdline,
+                                    stdout=stdout,
+                                    stderr=stderr,
+                                    shell=True,
+                                    cwd=runtime.cwd,
+                                    env=runtime.environ)
+            with working_directory_lock.released():
+                proc.wait()
+        finally:
+            stderr.close()
+            stdout.close()
+        for name, fname in [('stdout', outfile), ('stderr', errfile)]:
+            with open(fname, 'rt') as fp:
+                result[name] = [line.rstrip('\n') for line in
+                                deque(fp, maxlen=max_lines)]
+    else:
+        devnull = open(os.devnull, 'wb')
+        try:
+            proc = subprocess.Popen(runtime.cmdline,
+                                    stdout=devnull,
+                                    stderr=devnull,
+                                    shell=True,
+                                    cwd=runtime.cwd,
+                                    env=runtime.environ)
+            with working_directory_lock.released():
+                proc.wait()
+        finally:
+            devnull.close()
         result['stdout'] = []
         result['stderr'] = []
-        result['merged'] = ''
     runtime.stderr = '\n'.join(result['stderr'])
     runtime.stdout = '\n'.join(result['stdout'])
     runtime.merged = result['merged']
@@ -1372,6 +1485,81 @@ def run_command(runtime, output=None, timeout=0.01):
     return runtime
 
 
+def runtime_capture_level():
+    """Returns the level of runtime information recorded by interfaces
+
+    - none: the short host name, no library dependencies
+    - basic: the fully qualified host name, no library dependencies
+    - full: the fully qualified host name and the library dependencies of
+      command line executables
+    """
+    level = config.get('execution', 'runtime_capture').lower()
+    if level not in ['none', 'basic', 'full']:
+        raise ValueError('Unknown runtime capture level: %s' % level)
+    return level
+
+
+def provenance_mode(exec_config=None):
+    """Returns the W3C PROV mode of a configuration
+
+    - off: no provenance is written
+    - node: every interface run writes provenance.* in its working directory
+    - workflow: a workflow run writes a single workflow_provenance.* bundle
+      in the workflow directory
+
+    Parameters
+    ----------
+    exec_config : dict
+        a workflow configuration (default: the global configuration)
+    """
+    if exec_config is None:
+        mode = config.get('execution', 'write_provenance')
+    else:
+        mode = exec_config['execution']['write_provenance']
+    mode = mode.lower()
+    if mode not in ['off', 'node', 'workflow']:
+        raise ValueError('Unknown provenance mode: %s' % mode)
+    return mode
+
+
+def get_fqdn():
+    """Returns the fully qualified domain name of the host
+
+    The name is looked up once per process, since a lookup may be a slow DNS
+    round trip.
+    """
+    key = ('fqdn', gethostname())
+    fqdn = get_cached(key)
+    if fqdn is None:
+        fqdn = getfqdn()
+        set_cached(key, fqdn)
+    return fqdn
+
+
+def get_platform():
+    """Returns platform.platform(), memoised per process"""
+    platform_str = get_cached(('platform',))
+    if platform_str is None:
+        platform_str = platform.platform()
+        set_cached(('platform',), platform_str)
+    return platform_str
+
+
+def get_cached_dependencies(name, environ):
+    """Return library dependencies of an executable, memoised per process
+
+    The dependencies are keyed by the executable, the search path, the host
+    and the library search path.
+    """
+    key = ('dependencies', name, environ.get('PATH'), gethostname(),
+           environ.get('LD_LIBRARY_PATH'), environ.get('DYLD_LIBRARY_PATH'))
+    deps = get_cached(key)
+    if deps is None:
+        deps = get_dependencies(name, environ)
+        set_cached(key, deps)
+    return deps
+
+
 def get_dependencies(name, environ):
     """Return library dependencies of a dynamically linked executable
 
@@ -1529,10 +1717,10 @@ class CommandLine(BaseInterface):
 
     def version_from_command(self, flag='-v'):
         cmdname = self.cmd.split()[0]
-        if self._exists_in_path(cmdname):
-            env = deepcopy(os.environ.data)
-            out_environ = self._get_environ()
-            env.update(out_environ)
+        env = deepcopy(os.environ.data)
+        out_environ = self._get_environ()
+        env.update(out_environ)
+        if self._exists_in_path(cmdname, env)[0]:
             proc = subprocess.Popen(' '.join((cmdname, flag)),
                                     shell=True,
                                     env=env,
@@ -1567,8 +1755,10 @@ class CommandLine(BaseInterface):
             raise IOError("%s could not be found on host %s" %
                           (self.cmd.split()[0], runtime.hostname))
         setattr(runtime, 'command_path', cmd_path)
-        setattr(runtime, 'dependencies', get_dependencies(executable_name,
-                                                          runtime.environ))
+        if runtime_capture_level() == 'full':
+            setattr(runtime, 'dependencies',
+                    get_cached_dependencies(executable_name,
+                                            runtime.environ))
         runtime = run_command(runtime, output=self.inputs.terminal_output)
         if runtime.returncode is None or \
                         runtime.returncode not in correct_return_codes:
@@ -1580,18 +1770,27 @@ class CommandLine(BaseInterface):
         '''
         Based on a code snippet from
          http://orip.org/2009/08/python-checking-if-executable-exists-in.html
+
+        Found executables are memoised per process, keyed by the command and
+        the search path.
         '''
 
         if 'PATH' in environ:
             input_environ = environ.get("PATH")
         else:
             input_environ = os.environ.get("PATH", "")
-        extensions = os.environ.get("PATHEXT", "").split(os.pathsep)
+        pathext = os.environ.get("PATHEXT", "")
+        key = ('exists_in_path', cmd, input_environ, pathext)
+        filename = get_cached(key)
+        if filename is not None and os.path.exists(filename):
+            return True, filename
+        extensions = pathext.split(os.pathsep)
         for directory in input_environ.split(os.pathsep):
             base = os.path.join(directory, cmd)
             options = [base] + [(base + ext) for ext in extensions]
             for filename in options:
                 if os.path.exists(filename):
+                    set_cached(key, filename)
                     return True, filename
         return False, None
 
@@ -15,6 +15,7 @@ See the docstrings for the individual classes for 'working' examples.
 __docformat__ = 'restructuredtext'
 import re
 from nipype.interfaces.base import CommandLine
+from nipype.utils.toolcache import cached_version
 
 class Info(object):
     """ Handle dtk output type and version information.
@@ -29,6 +30,7 @@ class Info(object):
     """
 
     @staticmethod
+    @cached_version('dtk')
     def version():
         """Check for dtk version on system
 
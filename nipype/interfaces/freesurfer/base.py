@@ -18,6 +18,7 @@ __docformat__ = 'restructuredtext'
 import os
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.toolcache import cached_version
 from nipype.interfaces.base import (CommandLine, Directory,
                                     CommandLineInputSpec, isdefined)
 
@@ -35,6 +36,7 @@ class Info(object):
     """
 
     @staticmethod
+    @cached_version('freesurfer', env_vars=['FREESURFER_HOME'])
     def version():
         """Check for freesurfer version on system
 
@@ -30,6 +30,7 @@ import os
 import warnings
 
 from nipype.utils.filemanip import fname_presuffix
+from nipype.utils.toolcache import cached_version
 from nipype.interfaces.base import (CommandLine, traits, CommandLineInputSpec,
                                     isdefined)
 
@@ -53,6 +54,7 @@ class Info(object):
               'NIFTI_PAIR_GZ': '.img.gz'}
 
     @staticmethod
+    @cached_version('fsl', env_vars=['FSLDIR'])
     def version():
         """Check for fsl version on system
 
@@ -1,10 +1,16 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """ General matlab interface code """
+import atexit
 import os
+from Queue import Queue
+import subprocess
+import threading
+from uuid import uuid4
 
 from nipype.interfaces.base import (CommandLineInputSpec, InputMultiPath, isdefined,
-                                    CommandLine, traits, File, Directory)
+                                    CommandLine, traits, File, Directory,
+                                    working_directory_lock)
 from .. import config
 
 def get_matlab_command():
@@ -26,6 +32,157 @@ def get_matlab_command():
 
 no_matlab = get_matlab_command() is None
 
+
+class MatlabSession(object):
+    """A long-lived interactive MATLAB process
+
+    Statements are written to the standard input of MATLAB; each script run
+    is followed by a marker printed on both output streams, which delimits
+    the output of the script.
+
+    Parameters
+    ----------
+    cmd : str
+        command line starting MATLAB without a desktop, e.g.
+        'matlab -nodesktop -nosplash'
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._proc = subprocess.Popen(cmd, shell=True,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        self._queues = {}
+        for name in ['stdout', 'stderr']:
+            queue = Queue()
+            reader = threading.Thread(target=self._read,
+                                      args=(getattr(self._proc, name), queue))
+            reader.daemon = True
+            reader.start()
+            self._queues[name] = queue
+        # discard the start up banner
+        self._execute('')
+
+    @staticmethod
+    def _read(stream, queue):
+        for line in iter(stream.readline, ''):
+            queue.put(line)
+        queue.put(None)
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def _execute(self, statements):
+        token = 'nipype_done_%s' % uuid4().hex
+        self._proc.stdin.write(
+            "%s fprintf(1,'\\n%s\\n'); fprintf(2,'\\n%s\\n');\n" %
+            (statements, token, token))
+        self._proc.stdin.flush()
+        output = {}
+        for name, queue in self._queues.items():
+            lines = []
+            while True:
+                line = queue.get()
+                if line is None:
+                    raise RuntimeError('MATLAB session %s exited:\n%s' %
+                                       (self.cmd, ''.join(lines)))
+                if line.strip() == token:
+                    break
+                lines.append(line)
+            # the marker is preceded by a newline
+            if lines and lines[-1] == '\n':
+                lines.pop()
+            output[name] = ''.join(lines)
+        return output['stdout'], output['stderr']
+
+    def run_script(self, script_file, cwd=None):
+        """Runs the m-file script_file in directory cwd
+
+        Returns the standard output and error of the script.
+        """
+        if cwd is None:
+            cwd = os.getcwd()
+        quote = lambda path: path.replace("'", "''")
+        # errors escaping the script would skip the end marker
+        return self._execute(
+            "clear variables; cd('%s'); try, run('%s'); catch nipype_err, "
+            "fprintf(2,'MATLAB code threw an exception:\\n%%s\\n',"
+            "nipype_err.message); end;" %
+            (quote(cwd), quote(os.path.abspath(script_file))))
+
+    def close(self):
+        if self.alive:
+            try:
+                self._proc.stdin.write('exit\n')
+                self._proc.stdin.close()
+            except IOError:
+                pass
+            self._proc.wait()
+
+
+class MatlabSessionPool(object):
+    """Pool of MATLAB sessions keyed by their command line
+
+    A session serves one script at a time; concurrent requests from the
+    threads of a process start additional sessions, so the pool holds one
+    session per worker slot. Sessions are not shared with forked processes.
+    """
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._sessions = []
+
+    def acquire(self, cmd):
+        with self._lock:
+            idle = self._idle.setdefault(cmd, [])
+            while idle:
+                session = idle.pop()
+                if session.alive:
+                    return session
+        session = MatlabSession(cmd)
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def release(self, session):
+        if session.alive:
+            with self._lock:
+                self._idle.setdefault(session.cmd, []).append(session)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions, self._idle = self._sessions, [], {}
+        if os.getpid() != self._pid:
+            return
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_session_pool = None
+
+
+def get_session_pool():
+    """Returns the MATLAB session pool of the current process"""
+    global _session_pool
+    if _session_pool is None or _session_pool._pid != os.getpid():
+        _session_pool = MatlabSessionPool()
+    return _session_pool
+
+
+def _close_session_pool():
+    if _session_pool is not None:
+        _session_pool.close()
+
+atexit.register(_close_session_pool)
+
+
 class MatlabInputSpec(CommandLineInputSpec):
     """ Basic expected inputs to Matlab interface """
 
@@ -74,17 +231,24 @@ class MatlabCommand(CommandLine):
     _default_matlab_cmd = None
     _default_mfile = None
     _default_paths = None
+    _default_use_session = None
     input_spec = MatlabInputSpec
 
-    def __init__(self, matlab_cmd = None, **inputs):
+    def __init__(self, matlab_cmd = None, use_session = None, **inputs):
         """initializes interface to matlab
         (default 'matlab -nodesktop -nosplash')
+
+        With use_session the m-code is run by a pooled, long-lived MATLAB
+        process rather than a new one.
         """
         super(MatlabCommand,self).__init__(**inputs)
         if matlab_cmd and isdefined(matlab_cmd):
             self._cmd = matlab_cmd
         elif self._default_matlab_cmd:
             self._cmd = self._default_matlab_cmd
+        if use_session is None or not isdefined(use_session):
+            use_session = self._default_use_session
+        self.use_session = bool(use_session)
 
         if self._default_mfile and not isdefined(self.inputs.mfile):
             self.inputs.mfile = self._default_mfile
@@ -133,15 +297,59 @@ class MatlabCommand(CommandLine):
         """
         cls._default_paths = paths
 
+    @classmethod
+    def set_default_use_session(cls, use_session):
+        """Set whether MATLAB classes run m-code in pooled MATLAB sessions.
+
+        This method is used to set values for all MATLAB
+        subclasses.  However, setting this will not update
+        existing instances.  For these, assign <instance>.use_session.
+        """
+        cls._default_use_session = use_session
+
+    def _session_cmd(self):
+        args = [self._cmd]
+        for name in ['nodesktop', 'nosplash', 'single_comp_thread']:
+            value = getattr(self.inputs, name)
+            if isdefined(value) and value:
+                args.append(self.inputs.trait(name).argstr)
+        return ' '.join(args)
+
+    def _run_in_session(self, runtime):
+        mfile = self.inputs.mfile
+        self.inputs.mfile = True
+        try:
+            self._gen_matlab_command('%s', self.inputs.script)
+        finally:
+            self.inputs.mfile = mfile
+        script_file = os.path.join(runtime.cwd, self.inputs.script_file)
+        pool = get_session_pool()
+        session = pool.acquire(self._session_cmd())
+        runtime.cmdline = "%s: run('%s')" % (session.cmd, script_file)
+        try:
+            # the script runs in its own working directory, so other threads
+            # can use the process one meanwhile
+            with working_directory_lock.released():
+                runtime.stdout, runtime.stderr = session.run_script(
+                    script_file, runtime.cwd)
+        finally:
+            pool.release(session)
+        runtime.merged = runtime.stdout + runtime.stderr
+        runtime.returncode = 0
+        return runtime
+
     def _run_interface(self,runtime):
         self.inputs.terminal_output = 'allatonce'
-        runtime = super(MatlabCommand, self)._run_interface(runtime)
-        try:
-            # Matlab can leave the terminal in a barbbled state
-            os.system('stty sane')
-        except:
-            # We might be on a system where stty doesn't exist
-            pass
+        if self.use_session and not self.inputs.uses_mcr:
+            runtime = self._run_in_session(runtime)
+        else:
+            runtime = super(MatlabCommand, self)._run_interface(runtime)
+            try:
+                # Matlab can leave the terminal in a barbbled state
+                os.system('stty sane')
+            except:
+                # We might be on a system where stty doesn't exist
+                pass
         if 'MATLAB code threw an exception' in runtime.stderr:
             self.raise_exception(runtime)
         return runtime
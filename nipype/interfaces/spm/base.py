@@ -7,6 +7,7 @@ __docformat__ = 'restructuredtext'
 # Standard library imports
 import os
 from copy import deepcopy
+import threading
 
 # Third-party imports
 from nibabel import load
@@ -18,10 +19,22 @@ from ..base import (BaseInterface, traits, isdefined, InputMultiPath,
                     BaseInterfaceInputSpec, Directory, Undefined)
 from ..matlab import MatlabCommand
 from ...utils import spm_docs as sd
+from ...utils.toolcache import cached_version
 
 from ... import logging
 logger = logging.getLogger('interface')
 
+# the batches opened by each thread, innermost last
+_open_batches = threading.local()
+
+
+def _current_batch():
+    """Returns the innermost batch opened by the current thread or None"""
+    batches = getattr(_open_batches, 'stack', None)
+    if batches:
+        return batches[-1]
+    return None
+
 
 def func_is_3d(in_file):
     """Checks if input functional files are 3d."""
@@ -111,6 +124,7 @@ class Info(object):
     """Handles SPM version information
     """
     @staticmethod
+    @cached_version('spm', env_vars=['MATLABCMD', 'MATLABPATH'])
     def version(matlab_cmd=None):
         """Returns the path to the SPM directory in the Matlab path
         If path not found, returns None.
@@ -134,7 +148,8 @@ class Info(object):
                 matlab_cmd = os.environ['MATLABCMD']
             except:
                 matlab_cmd = 'matlab -nodesktop -nosplash'
-        mlab = MatlabCommand(matlab_cmd=matlab_cmd)
+        # the script exits MATLAB, so it must not run in a pooled session
+        mlab = MatlabCommand(matlab_cmd=matlab_cmd, use_session=False)
         mlab.inputs.script = """
 if isempty(which('spm')),
 throw(MException('SPMCheck:NotFound','SPM not in matlab path'));
@@ -178,6 +193,125 @@ class SPMCommandInputSpec(BaseInterfaceInputSpec):
     mfile = traits.Bool(True, desc='Run m-code using m-file',
                         usedefault=True)
     use_mcr = traits.Bool(desc='Run m-code using SPM MCR')
+    use_session = traits.Bool(desc=('Run m-code in a pooled, long-lived '
+                                    'MATLAB session'), nohash=True)
+
+
+class SPMBatch(object):
+    """Runs the jobs of several SPM interfaces in one MATLAB process
+
+    Within a ``with`` block, SPM interfaces run by the same thread that
+    support batching record their job script instead of starting MATLAB
+    and do not collect their outputs. Interfaces run by other threads are
+    not affected, and leaving a nested block restores the enclosing batch.
+    ``run`` executes all recorded jobs in a single script, each in its own
+    working directory and guarded by its own try/catch, after which the
+    outputs of every interface can be aggregated as usual.
+
+    >>> batch = SPMBatch()
+    >>> with batch:
+    ...     pass # run SPM interfaces
+    >>> batch.run() # doctest: +SKIP
+    """
+
+    _marker = 'NIPYPE_BATCH_JOB'
+    _failed = 'NIPYPE_BATCH_FAILED'
+
+    def __init__(self):
+        self._jobs = []
+        self._stdout = {}
+        self._errors = {}
+        self._runtime = None
+
+    def __enter__(self):
+        if not hasattr(_open_batches, 'stack'):
+            _open_batches.stack = []
+        _open_batches.stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _open_batches.stack.pop()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, interface):
+        return self._index(interface) is not None
+
+    def _index(self, interface):
+        for idx, job in enumerate(self._jobs):
+            if job[0] is interface:
+                return idx
+        return None
+
+    def add(self, interface, script):
+        """Records the job script of interface for the current directory"""
+        self._jobs.append((interface, os.getcwd(), script))
+
+    def _make_script(self):
+        lines = []
+        for idx, (_, cwd, script) in enumerate(self._jobs):
+            lines += ["fprintf(1,'\\n%s %d\\n');" % (self._marker, idx),
+                      "try,",
+                      "cd('%s');" % cwd.replace("'", "''"),
+                      script,
+                      "catch ME,",
+                      "fprintf(1,'\\n%s %d\\n');" % (self._failed, idx),
+                      "fprintf(1,'%s\\n',ME.message);",
+                      "end;",
+                      "clear jobs;"]
+        return '\n'.join(lines)
+
+    def run(self):
+        """Runs all recorded jobs and splits their output"""
+        if not self._jobs:
+            return None
+        mlab = deepcopy(self._jobs[0][0].mlab)
+        mlab.inputs.mfile = True
+        mlab.inputs.script_file = 'pyscript_batch.m'
+        mlab.inputs.script = self._make_script()
+        try:
+            self._runtime = mlab.run().runtime
+        except RuntimeError, e:
+            for idx in range(len(self._jobs)):
+                self._errors[idx] = str(e)
+            return None
+        idx = None
+        for line in self._runtime.stdout.split('\n'):
+            words = line.split()
+            if len(words) == 2 and words[0] == self._marker:
+                idx = int(words[1])
+                self._stdout[idx] = []
+            elif len(words) == 2 and words[0] == self._failed:
+                self._errors[idx] = ''
+            elif idx in self._errors:
+                self._errors[idx] += line + '\n'
+            elif idx is not None:
+                self._stdout[idx].append(line)
+        for idx in range(len(self._jobs)):
+            if idx not in self._stdout:
+                self._errors.setdefault(idx, 'Job was not run')
+        return self._runtime
+
+    def update_runtime(self, interface, runtime):
+        """Sets the output of the job of interface on runtime
+
+        Raises a RuntimeError if the job failed.
+        """
+        idx = self._index(interface)
+        runtime.stdout = '\n'.join(self._stdout.get(idx, []))
+        runtime.stderr = ''
+        if self._runtime is not None:
+            runtime.cmdline = self._runtime.cmdline
+            runtime.stderr = self._runtime.stderr
+        runtime.merged = runtime.stdout
+        if idx in self._errors:
+            runtime.returncode = 1
+            raise RuntimeError('SPM job of %s in %s failed:\n%s' %
+                               (interface.__class__.__name__,
+                                self._jobs[idx][1], self._errors[idx]))
+        runtime.returncode = 0
+        return runtime
 
 
 class SPMCommand(BaseInterface):
@@ -193,21 +327,33 @@ class SPMCommand(BaseInterface):
     _matlab_cmd = None
     _paths = None
     _use_mcr = None
+    _use_session = None
+    # outputs are predicted from the inputs, so jobs can be batched
+    _batchable = True
 
     def __init__(self, **inputs):
         super(SPMCommand, self).__init__(**inputs)
         self.inputs.on_trait_change(self._matlab_cmd_update, ['matlab_cmd',
                                                               'mfile',
                                                               'paths',
-                                                              'use_mcr'])
+                                                              'use_mcr',
+                                                              'use_session'])
         self._check_mlab_inputs()
         self._matlab_cmd_update()
 
     @classmethod
-    def set_mlab_paths(cls, matlab_cmd=None, paths=None, use_mcr=None):
+    def set_mlab_paths(cls, matlab_cmd=None, paths=None, use_mcr=None,
+                       use_session=None):
+        """Set the MATLAB command, paths and mode of all SPM interfaces
+
+        With use_session the jobs run in pooled, long-lived MATLAB
+        processes (one per worker slot) instead of a new MATLAB each; it
+        has no effect with use_mcr.
+        """
         cls._matlab_cmd = matlab_cmd
         cls._paths = paths
         cls._use_mcr = use_mcr
+        cls._use_session = use_session
 
     def _matlab_cmd_update(self):
         # MatlabCommand has to be created here,
@@ -216,7 +362,8 @@ class SPMCommand(BaseInterface):
         self.mlab = MatlabCommand(matlab_cmd=self.inputs.matlab_cmd,
                                   mfile=self.inputs.mfile,
                                   paths=self.inputs.paths,
-                                  uses_mcr=self.inputs.use_mcr)
+                                  uses_mcr=self.inputs.use_mcr,
+                                  use_session=self.inputs.use_session)
         self.mlab.inputs.script_file = 'pyscript_%s.m' % \
             self.__class__.__name__.split('.')[-1].lower()
         if isdefined(self.inputs.use_mcr) and self.inputs.use_mcr:
@@ -242,11 +389,32 @@ class SPMCommand(BaseInterface):
             self.inputs.paths = self._paths
         if not isdefined(self.inputs.use_mcr) and self._use_mcr:
             self.inputs.use_mcr = self._use_mcr
+        if not isdefined(self.inputs.use_session) and self._use_session:
+            self.inputs.use_session = self._use_session
+
+    def create_batch(self):
+        """Returns an SPMBatch if the jobs of this interface can be batched
+        """
+        if self._batchable:
+            return SPMBatch()
+        return None
+
+    @property
+    def _batch(self):
+        """The batch opened by the thread running the interface or None"""
+        return _current_batch()
+
+    def _deferred(self):
+        return self._batch is not None and self in self._batch
 
     def _run_interface(self, runtime):
         """Executes the SPM function using MATLAB."""
         self.mlab.inputs.script = self._make_matlab_command(
             deepcopy(self._parse_inputs()))
+        if self._batchable and self._batch is not None:
+            self._batch.add(self, self.mlab.inputs.script)
+            runtime.returncode = 0
+            return runtime
         results = self.mlab.run()
         runtime.returncode = results.runtime.returncode
         if self.mlab.inputs.uses_mcr:
@@ -257,6 +425,13 @@ class SPMCommand(BaseInterface):
         runtime.merged = results.runtime.merged
         return runtime
 
+    def aggregate_outputs(self, runtime=None, needed_outputs=None):
+        if self._deferred():
+            # the outputs exist once the batch has run
+            return None
+        return super(SPMCommand, self).aggregate_outputs(
+            runtime=runtime, needed_outputs=needed_outputs)
+
     def _list_outputs(self):
         """Determine the expected outputs based on inputs."""
 
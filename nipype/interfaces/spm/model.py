@@ -431,6 +431,8 @@ class Threshold(SPMCommand):
     '''
     input_spec = ThresholdInputSpec
     output_spec = ThresholdOutputSpec
+    # outputs are parsed from the terminal output
+    _batchable = False
 
     def _gen_thresholded_map_filename(self):
         _, fname, ext = split_filename(self.inputs.stat_image)
@@ -609,6 +611,8 @@ class ThresholdStatistics(SPMCommand):
     '''
     input_spec = ThresholdStatisticsInputSpec
     output_spec = ThresholdStatisticsOutputSpec
+    # outputs are parsed from the terminal output
+    _batchable = False
 
     def _make_matlab_command(self, _):
         script = "con_index = %d;\n" % self.inputs.contrast_index
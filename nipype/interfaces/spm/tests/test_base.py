@@ -1,8 +1,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+from glob import glob
 import os
+import sys
 from tempfile import mkdtemp
 from shutil import rmtree
+import threading
 
 import nibabel as nb
 import numpy as np
@@ -12,7 +15,8 @@ import nipype.interfaces.spm.base as spm
 from nipype.interfaces.spm import no_spm
 import nipype.interfaces.matlab as mlab
 from nipype.interfaces.spm.base import SPMCommandInputSpec
-from nipype.interfaces.base import traits
+from nipype.interfaces.base import traits, File, TraitedSpec
+import nipype.pipeline.engine as pe
 
 try:
     matlab_cmd = os.environ['MATLABCMD']
@@ -21,6 +25,10 @@ except:
 
 mlab.MatlabCommand.set_default_matlab_cmd(matlab_cmd)
 
+fake_matlab = '%s %s' % (sys.executable,
+                         os.path.join(os.path.dirname(mlab.__file__),
+                                      'tests', 'fake_matlab.py'))
+
 
 def create_files_in_directory():
     outdir = mkdtemp()
@@ -77,6 +85,165 @@ def test_cmd_update():
     yield assert_equal, dc.mlab._cmd, 'foo'
 
 
+def test_use_session():
+    class TestClass(spm.SPMCommand):
+        _jobtype = 'jobtype'
+        _jobname = 'jobname'
+        input_spec = spm.SPMCommandInputSpec
+
+        def _list_outputs(self):
+            return {}
+    filelist, outdir, cwd = create_files_in_directory()
+    TestClass.set_mlab_paths(matlab_cmd=fake_matlab, use_session=True)
+    try:
+        dc = TestClass()  # dc = derived_class
+        yield assert_true, dc.inputs.use_session
+        yield assert_true, dc.mlab.use_session
+        res = dc.run()
+        yield assert_true, res.runtime.stdout.startswith(
+            'Executing pyscript_testclass.m')
+        yield assert_equal, res.runtime.stdout, dc.run().runtime.stdout
+    finally:
+        TestClass.set_mlab_paths()
+        mlab.get_session_pool().close()
+        clean_directory(outdir, cwd)
+    yield assert_false, TestClass().mlab.use_session
+
+
+class CopyInputSpec(SPMCommandInputSpec):
+    in_file = File(exists=True, mandatory=True)
+
+
+class CopyOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class Copy(spm.SPMCommand):
+    """Copies in_file, failing for files named bad.nii"""
+    input_spec = CopyInputSpec
+    output_spec = CopyOutputSpec
+
+    def _make_matlab_command(self, _):
+        if os.path.basename(self.inputs.in_file) == 'bad.nii':
+            return "error('bad input');"
+        return "copyfile('%s','%s');" % (self.inputs.in_file,
+                                         self._list_outputs()['out_file'])
+
+    def _list_outputs(self):
+        return {'out_file': os.path.abspath(
+            'copy_' + os.path.basename(self.inputs.in_file))}
+
+
+def test_batch():
+    filelist, outdir, cwd = create_files_in_directory()
+    filelist = [os.path.join(outdir, name) for name in filelist]
+    mapnode = pe.MapNode(Copy(matlab_cmd=fake_matlab, use_session=True),
+                         iterfield=['in_file'], name='copy', batch=True,
+                         base_dir=outdir)
+    mapnode.inputs.in_file = filelist
+    pool = mlab.get_session_pool()
+    pool.close()
+    try:
+        res = mapnode.run()
+        yield assert_equal, [os.path.basename(out) for out in
+                             res.outputs.out_file], ['copy_a.nii',
+                                                     'copy_b.nii']
+        yield assert_true, all([os.path.exists(out)
+                                for out in res.outputs.out_file])
+        # one script ran in one MATLAB
+        yield assert_equal, len(pool), 1
+        batch_script = os.path.join(outdir, 'copy', 'pyscript_batch.m')
+        yield assert_true, os.path.exists(batch_script)
+        subdir = os.path.join(outdir, 'copy', 'mapflow', '_copy1')
+        yield assert_true, os.path.exists(os.path.join(subdir,
+                                                       'result__copy1.pklz'))
+        yield assert_equal, len(glob(os.path.join(subdir, '_0x*.json'))), 1
+        yield assert_equal, glob(os.path.join(subdir, '*_unfinished.json')), []
+        # subnodes are cached individually
+        os.remove(batch_script)
+        mapnode.inputs.in_file = filelist + [filelist[0]]
+        mapnode.run()
+        yield assert_true, os.path.exists(batch_script)
+        yield assert_true, 'copy_b.nii' not in open(batch_script).read()
+        # a failing job fails its subnode only
+        bad_file = os.path.join(outdir, 'bad.nii')
+        open(bad_file, 'wt').write('bad')
+        mapnode.inputs.in_file = [filelist[0], bad_file]
+        failed = False
+        try:
+            mapnode.run()
+        except Exception:
+            failed = True
+        yield assert_true, failed
+        subdir = os.path.join(outdir, 'copy', 'mapflow', '_copy1')
+        yield assert_equal, glob(os.path.join(subdir, '_0x*.json')), []
+        subdir = os.path.join(outdir, 'copy', 'mapflow', '_copy0')
+        yield assert_equal, len(glob(os.path.join(subdir, '_0x*.json'))), 1
+    finally:
+        pool.close()
+        clean_directory(outdir, cwd)
+
+
+def test_batch_deferred_hash():
+    filelist, outdir, cwd = create_files_in_directory()
+    node = pe.Node(Copy(matlab_cmd=fake_matlab,
+                        in_file=os.path.join(outdir, filelist[0])),
+                   name='deferred', base_dir=outdir)
+    try:
+        with spm.SPMBatch():
+            node.run()
+        # the node is not cached until the batch has run
+        nodedir = os.path.join(outdir, 'deferred')
+        yield assert_equal, len(glob(os.path.join(nodedir,
+                                                  '_0x*_unfinished.json'))), 1
+        yield assert_equal, [hashfile for hashfile in
+                             glob(os.path.join(nodedir, '_0x*.json'))
+                             if not hashfile.endswith('_unfinished.json')], []
+    finally:
+        clean_directory(outdir, cwd)
+
+
+def test_batch_threads():
+    filelist, outdir, cwd = create_files_in_directory()
+    pool = mlab.get_session_pool()
+    pool.close()
+    batch = spm.SPMBatch()
+    opened = threading.Event()
+    release = threading.Event()
+    current = []
+
+    def open_batch():
+        with batch:
+            opened.set()
+            release.wait(60)
+            current.append(spm._current_batch())
+    thread = threading.Thread(target=open_batch)
+    thread.start()
+    opened.wait(60)
+    try:
+        # a batch opened by another thread does not capture the interface
+        copy = Copy(matlab_cmd=fake_matlab, use_session=True,
+                    in_file=os.path.join(outdir, filelist[0]))
+        res = copy.run()
+        yield assert_true, os.path.exists(res.outputs.out_file)
+        yield assert_equal, len(batch), 0
+        yield assert_equal, spm._current_batch(), None
+    finally:
+        release.set()
+        thread.join()
+        pool.close()
+        clean_directory(outdir, cwd)
+    yield assert_equal, current, [batch]
+    # leaving a nested batch restores the enclosing one
+    outer = spm.SPMBatch()
+    inner = spm.SPMBatch()
+    with outer:
+        with inner:
+            yield assert_equal, spm._current_batch(), inner
+        yield assert_equal, spm._current_batch(), outer
+    yield assert_equal, spm._current_batch(), None
+
+
 def test_cmd_update2():
     class TestClass(spm.SPMCommand):
         _jobtype = 'jobtype'
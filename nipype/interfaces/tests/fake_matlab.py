@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Stand-in for an interactive MATLAB session in tests
+
+Reads statements from standard input and interprets the few used by
+MatlabSession, SPMBatch and the tests: ``cd('dir')``, ``run('script')``,
+``error('message')``, ``copyfile('src','dst')``, ``fprintf`` of a literal
+or of an error message, ``try``/``catch``/``end`` blocks and ``exit``.
+``if`` blocks are always entered, any ``<name>.message`` is the last caught
+error and everything else is ignored. Running a script first prints its
+name and the process id.
+"""
+import os
+import re
+import shutil
+import sys
+
+_token = re.compile(r"(cd|run|error)\('((?:[^']|'')*)'\)|"
+                    r"copyfile\('((?:[^']|'')*)','((?:[^']|'')*)'\)|"
+                    r"fprintf\(([12]),'((?:[^']|'')*)'(?:,(\w+)\.message)?\)|"
+                    r"\b(try|catch|if|end|exit)\b")
+
+
+# message of the last caught error
+last_error = ['']
+
+
+class Exit(Exception):
+    pass
+
+
+class MatlabError(Exception):
+    pass
+
+
+def unquote(text):
+    return text.replace("''", "'")
+
+
+def tokenize(code):
+    tokens = []
+    for match in _token.finditer(code):
+        func, arg, src, dst, fd, fmt, var, keyword = match.groups()
+        if func:
+            tokens.append((func, unquote(arg)))
+        elif src:
+            tokens.append(('copyfile', (unquote(src), unquote(dst))))
+        elif fd:
+            fmt = unquote(fmt).replace('\\n', '\n')
+            tokens.append(('fprintf', (int(fd), fmt, var)))
+        else:
+            tokens.append((keyword, None))
+    return tokens
+
+
+def skip_block(tokens, idx, stop):
+    """Returns the index of the token in stop closing the current block"""
+    depth = 0
+    while idx < len(tokens):
+        kind = tokens[idx][0]
+        if kind in ['try', 'if']:
+            depth += 1
+        elif depth == 0 and kind in stop:
+            return idx
+        elif kind == 'end':
+            depth -= 1
+        idx += 1
+    return idx
+
+
+def execute(code):
+    tokens = tokenize(code)
+    blocks = []
+    idx = 0
+    while idx < len(tokens):
+        kind, arg = tokens[idx]
+        idx += 1
+        try:
+            if kind == 'exit':
+                raise Exit()
+            elif kind in ['try', 'if']:
+                blocks.append(kind)
+            elif kind == 'end':
+                if blocks:
+                    blocks.pop()
+            elif kind == 'catch':
+                # the try block succeeded
+                idx = skip_block(tokens, idx, ['end']) + 1
+                blocks.pop()
+            elif kind == 'cd':
+                os.chdir(arg)
+            elif kind == 'run':
+                sys.stdout.write('Executing %s in process %d\n' %
+                                 (os.path.basename(arg), os.getpid()))
+                execute(open(arg).read())
+            elif kind == 'error':
+                raise MatlabError(arg)
+            elif kind == 'copyfile':
+                shutil.copyfile(*arg)
+            elif kind == 'fprintf':
+                fd, fmt, var = arg
+                if var:
+                    fmt = fmt.replace('%s', last_error[0], 1)
+                [sys.stdout, sys.stderr][fd - 1].write(fmt)
+        except MatlabError, err:
+            # unwind to the innermost try block
+            while blocks and blocks[-1] != 'try':
+                blocks.pop()
+                idx = skip_block(tokens, idx, ['end']) + 1
+            if not blocks:
+                raise
+            idx = skip_block(tokens, idx, ['catch']) + 1
+            last_error[0] = str(err)
+
+
+def main():
+    sys.stdout.write('Fake MATLAB\n')
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            execute(line)
+        except MatlabError, err:
+            sys.stderr.write('??? %s\n' % err)
+        except Exit:
+            return
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+
+if __name__ == '__main__':
+    main()
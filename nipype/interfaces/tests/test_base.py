@@ -192,6 +192,55 @@ def test_TraitedSpec_withFile():
     yield assert_equal, hashval[1], '8c227fb727c32e00cd816c31d8fea9b9'
     teardown_file(tmpd)
 
+def test_TraitedSpec_hashes_files_once():
+    import nipype.utils.filemanip as fm
+    tmp_infile = setup_file()
+    tmpd, nme = os.path.split(tmp_infile)
+    class spec2(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.traits.List(nib.File(exists=True))
+    infields = spec2(moo=tmp_infile, doo=[tmp_infile])
+    calls = []
+    orig_md5_content = fm._md5_content
+    def counting_md5_content(afile, *args):
+        calls.append(afile)
+        return orig_md5_content(afile, *args)
+    fm.clear_hash_cache()
+    fm._md5_content = counting_md5_content
+    try:
+        hashval = infields.get_hashval(hash_method='content')
+        hashval2 = infields.get_hashval(hash_method='content')
+    finally:
+        fm._md5_content = orig_md5_content
+    yield assert_equal, hashval[1], '8c227fb727c32e00cd816c31d8fea9b9'
+    yield assert_equal, hashval2, hashval
+    yield assert_equal, hashval[0]['moo'][0], tmp_infile
+    yield assert_equal, len(calls), 1
+    teardown_file(tmpd)
+
+def test_TraitedSpec_hash_methods():
+    tmp_infile = setup_file()
+    tmpd, nme = os.path.split(tmp_infile)
+    tmp_infile2 = os.path.join(tmpd, 'bar.txt')
+    fp = open(tmp_infile2, 'wt')
+    fp.write('123456')
+    fp.close()
+    class spec2(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.traits.List(nib.File(exists=True))
+    infields = spec2(moo=tmp_infile, doo=[tmp_infile, tmp_infile2])
+    hashes = {}
+    for hash_method in ['content', 'content_fast', 'content_sampled',
+                        'timestamp']:
+        hashes[hash_method] = infields.get_hashval(hash_method=hash_method)
+    yield assert_equal, len(set(val[1] for val in hashes.values())), 4
+    moo = hashes['content_fast'][0]['moo']
+    yield assert_true, moo[1].startswith('crc32adler32:')
+    moo = hashes['content_sampled'][0]['moo']
+    yield assert_true, moo[1].startswith('sampledmd5:')
+    yield assert_raises, Exception, infields.get_hashval, 'unknown'
+    teardown_file(tmpd)
+
 @skipif(checknose)
 def test_TraitedSpec_withNoFileHashing():
     tmp_infile = setup_file()
@@ -487,6 +536,61 @@ def test_CommandLine_output():
     os.chdir(pwd)
     teardown_file(tmpd)
 
+def test_runtime_capture():
+    from socket import gethostname
+    tmpd = tempfile.mkdtemp()
+    pwd = os.getcwd()
+    os.chdir(tmpd)
+    old_level = config.get('execution', 'runtime_capture')
+    try:
+        for level in ['none', 'basic', 'full']:
+            config.set('execution', 'runtime_capture', level)
+            ci = nib.CommandLine(command='ls', terminal_output='allatonce')
+            runtime = ci.run().runtime
+            yield (assert_equal, hasattr(runtime, 'dependencies'),
+                   level == 'full')
+            if level == 'none':
+                yield assert_equal, runtime.hostname, gethostname()
+            else:
+                yield assert_equal, runtime.hostname, nib.get_fqdn()
+        config.set('execution', 'runtime_capture', 'verbose')
+        yield assert_raises, ValueError, nib.runtime_capture_level
+    finally:
+        config.set('execution', 'runtime_capture', old_level)
+    os.chdir(pwd)
+    shutil.rmtree(tmpd)
+
+def test_run_command():
+    tmpd = tempfile.mkdtemp()
+    cmdline = 'for i in 1 2 3 4 5; do echo out$i; echo err$i >&2; done'
+    for output in ['stream', 'allatonce', 'file', 'none']:
+        runtime = nib.Bunch(cmdline=cmdline, cwd=tmpd,
+                            environ=dict(os.environ))
+        runtime = nib.run_command(runtime, output=output, max_lines=2)
+        yield assert_equal, runtime.returncode, 0
+        if output == 'none':
+            yield assert_equal, runtime.stdout, ''
+            yield assert_equal, runtime.stderr, ''
+            continue
+        # only the last lines are kept in memory
+        yield assert_equal, runtime.stdout, 'out4\nout5'
+        yield assert_equal, runtime.stderr, 'err4\nerr5'
+        # and the complete output is on disk
+        outfile = os.path.join(tmpd, 'stdout.nipype')
+        yield assert_equal, open(outfile).read().split(), \
+            ['out%d' % i for i in range(1, 6)]
+        os.remove(outfile)
+        os.remove(os.path.join(tmpd, 'stderr.nipype'))
+        if output == 'stream':
+            yield assert_equal, len(runtime.merged), 4
+    runtime = nib.Bunch(cmdline='exit 3', cwd=tmpd, environ=dict(os.environ))
+    runtime = nib.run_command(runtime, output='allatonce')
+    yield assert_equal, runtime.returncode, 3
+    yield assert_equal, os.listdir(tmpd), []
+    yield (assert_raises, ValueError, nib.run_command, runtime,
+           'everything')
+    shutil.rmtree(tmpd)
+
 def test_global_CommandLine_output():
     tmp_infile = setup_file()
     tmpd, name = os.path.split(tmp_infile)
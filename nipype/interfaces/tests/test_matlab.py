@@ -1,12 +1,14 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+import sys
 from tempfile import mkdtemp
 from shutil import rmtree
 
 from nipype.testing import (assert_equal, assert_true, assert_false,
                             assert_raises, skipif)
 import nipype.interfaces.matlab as mlab
+from nipype.interfaces.base import working_directory_lock
 
 matlab_cmd = mlab.get_matlab_command()
 no_matlab = matlab_cmd is None
@@ -83,3 +85,56 @@ def test_set_matlabcmd():
     mi.set_default_matlab_cmd('foo')
     yield assert_equal, mi._default_matlab_cmd, 'foo'
     mi.set_default_matlab_cmd(matlab_cmd)
+
+
+def test_session():
+    fake_matlab = '%s %s' % (sys.executable,
+                             os.path.join(os.path.dirname(__file__),
+                                          'fake_matlab.py'))
+    cwd = os.getcwd()
+    basedir = mkdtemp()
+    os.chdir(basedir)
+    pool = mlab.get_session_pool()
+    pool.close()
+    try:
+        pids = []
+        for idx in range(2):
+            mc = mlab.MatlabCommand(matlab_cmd=fake_matlab, use_session=True,
+                                    script='a=%d;' % idx, mfile=False,
+                                    script_file='script%d.m' % idx)
+            res = mc.run()
+            yield assert_equal, res.runtime.returncode, 0
+            yield assert_true, os.path.exists(os.path.join(basedir,
+                                                           'script%d.m' % idx))
+            yield assert_true, 'Fake MATLAB' not in res.runtime.stdout
+            pids.append(res.runtime.stdout.split()[-1])
+        # both scripts ran in the same process
+        yield assert_equal, pids[0], pids[1]
+        yield assert_equal, len(pool), 1
+        # the working directory lock is released while the script runs
+        run_script = mlab.MatlabSession.run_script
+        locked = []
+
+        def recording_run_script(self, *args):
+            locked.append(working_directory_lock._lock.locked())
+            return run_script(self, *args)
+        mlab.MatlabSession.run_script = recording_run_script
+        try:
+            with working_directory_lock:
+                mc.run()
+        finally:
+            mlab.MatlabSession.run_script = run_script
+        yield assert_equal, locked, [False]
+        mc = mlab.MatlabCommand(matlab_cmd=fake_matlab, use_session=True,
+                                script="error('failed');")
+        yield assert_raises, RuntimeError, mc.run
+        # the session survives errors
+        yield assert_equal, len(pool), 1
+        mlab.MatlabCommand.set_default_use_session(True)
+        yield assert_true, mlab.MatlabCommand().use_session
+        yield assert_false, mlab.MatlabCommand(use_session=False).use_session
+    finally:
+        mlab.MatlabCommand.set_default_use_session(None)
+        pool.close()
+        os.chdir(cwd)
+        rmtree(basedir)
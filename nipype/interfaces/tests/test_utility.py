@@ -113,3 +113,37 @@ def test_function_with_imports():
     finally:
         os.chdir(origdir)
         shutil.rmtree(tempdir)
+
+
+def test_function_by_reference():
+    tempdir = os.path.realpath(mkdtemp())
+    origdir = os.getcwd()
+    os.chdir(tempdir)
+
+    by_source = utility.Function(input_names=["size"],
+                                 output_names=["random_array"],
+                                 function=make_random_array)
+    by_reference = utility.Function(input_names=["size"],
+                                    output_names=["random_array"],
+                                    function=make_random_array,
+                                    by_reference=True)
+    try:
+        yield assert_equal, by_reference.inputs.get_hashval()[1], \
+            by_source.inputs.get_hashval()[1]
+        # the imported function sees the imports of its module
+        node = pe.Node(by_reference, name="by_reference")
+        node.inputs.size = 10
+        res = node.run()
+        yield assert_equal, res.outputs.random_array.shape, (10, 10)
+        # a new function string drops the reference
+        node.inputs.function_str = ("def make_random_array(size):\n"
+                                    "    return np.random.randn(size, size)\n")
+        failed = False
+        try:
+            node.run()
+        except NameError:
+            failed = True
+        yield assert_true, failed
+    finally:
+        os.chdir(origdir)
+        shutil.rmtree(tempdir)
@@ -12,7 +12,10 @@ from nipype.interfaces.base import (traits, TraitedSpec, DynamicTraitedSpec, Fil
     InputMultiPath, BaseInterface, BaseInterfaceInputSpec)
 from nipype.interfaces.io import IOBase, add_traits
 from nipype.testing import assert_equal
-from nipype.utils.misc import getsource, create_function_from_source
+from nipype.utils.misc import (getsource, create_function_from_source,
+                               function_reference, import_function)
+from nipype import logging
+iflogger = logging.getLogger('interface')
 
 
 class IdentityInterface(IOBase):
@@ -345,7 +348,7 @@ class Function(IOBase):
     output_spec = DynamicTraitedSpec
 
     def __init__(self, input_names, output_names, function=None, imports=None,
-                 **inputs):
+                 by_reference=False, **inputs):
         """
 
         Parameters
@@ -363,13 +366,20 @@ class Function(IOBase):
         imports : list of strings
             list of import statements that allow the function to execute
             in an otherwise empty namespace
+        by_reference : boolean
+            if the function can be imported from its module, run the
+            imported function (in its module namespace) instead of
+            compiling its source. The source is still used for hashing.
         """
 
         super(Function, self).__init__(**inputs)
+        self._by_reference = by_reference
+        self._function_ref = None
         if function:
             if hasattr(function, '__call__'):
                 try:
                     self.inputs.function_str = getsource(function)
+                    self._set_function_reference(function)
                 except IOError:
                     raise Exception('Interface Function does not accept ' \
                                     'function objects defined interactively ' \
@@ -388,8 +398,14 @@ class Function(IOBase):
         for name in self._output_names:
             self._out[name] = None
 
+    def _set_function_reference(self, function):
+        self._function_ref = None
+        if self._by_reference and hasattr(function, '__call__'):
+            self._function_ref = function_reference(function)
+
     def _set_function_string(self, obj, name, old, new):
         if name == 'function_str':
+            self._set_function_reference(new)
             if hasattr(new, '__call__'):
                 function_source = getsource(new)
             elif isinstance(new, str):
@@ -405,9 +421,18 @@ class Function(IOBase):
         base.trait_set(trait_change_notify=False, **undefined_traits)
         return base
 
+    def _get_function(self):
+        if self._function_ref:
+            try:
+                return import_function(self._function_ref)
+            except (ImportError, AttributeError):
+                iflogger.debug('Cannot import %s, compiling its source' %
+                               self._function_ref)
+        return create_function_from_source(self.inputs.function_str,
+                                           self.imports)
+
     def _run_interface(self, runtime):
-        function_handle = create_function_from_source(self.inputs.function_str,
-                                                      self.imports)
+        function_handle = self._get_function()
 
         args = {}
         for name in self._input_names:
@@ -14,6 +14,8 @@ The `Pipeline` class provides core functionality for batch processing.
 
 from glob import glob
 from collections import OrderedDict
+from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
 import gzip
 from copy import deepcopy
 import cPickle
@@ -27,6 +29,8 @@ from socket import gethostname
 from string import Template
 import sys
 from tempfile import mkdtemp
+from threading import Semaphore
+from traceback import format_exc
 from warnings import warn
 from hashlib import sha1
 from collections import defaultdict
@@ -37,12 +41,14 @@ from ..utils.misc import package_check, str2bool
 package_check('networkx', '1.3')
 import networkx as nx
 
-from .. import config, logging
+from .. import config, logging, __version__ as nipype_version
 logger = logging.getLogger('workflow')
 from ..interfaces.base import (traits, InputMultiPath, CommandLine,
-                               Undefined, TraitedSpec, DynamicTraitedSpec,
+                               Undefined, BaseTraitedSpec, TraitedSpec,
+                               DynamicTraitedSpec,
                                Bunch, InterfaceResult, md5, Interface,
-                               TraitDictObject, TraitListObject, isdefined)
+                               TraitDictObject, TraitListObject, isdefined,
+                               provenance_mode, working_directory_lock)
 from ..utils.misc import getsource, create_function_from_source
 from ..utils.filemanip import (save_json, FileNotFoundError,
                                filename_to_list, list_to_filename,
@@ -54,7 +60,28 @@ from ..utils.filemanip import (save_json, FileNotFoundError,
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir,
                     clean_working_directory, format_dot,
-                    get_print_name, merge_dict, evaluate_connect_function)
+                    get_print_name, merge_dict, evaluate_connect_function,
+                    write_prov)
+
+
+def _structure(value):
+    """Returns an order independent description of value
+
+    Traited specs are replaced by their values, dictionaries by their sorted
+    items and objects without a repr of their own by their class, so that the
+    repr of the description is stable across runs.
+    """
+    if isinstance(value, BaseTraitedSpec):
+        value = value.get()
+    if isinstance(value, dict):
+        return sorted((key, _structure(val)) for key, val in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_structure(val) for val in value]
+    if ' at 0x' in repr(value):
+        # the default repr contains the memory address of the object
+        return '%s.%s' % (value.__class__.__module__,
+                          value.__class__.__name__)
+    return value
 
 
 def _write_inputs(node):
@@ -616,7 +643,6 @@ class Workflow(WorkflowBase):
             else:
                 plugin_mod = getattr(sys.modules[name], '%sPlugin' % plugin)
                 runner = plugin_mod(plugin_args=plugin_args)
-        flatgraph = self._create_flat_graph()
         self.config = merge_dict(deepcopy(config._sections), self.config)
         if 'crashdump_dir' in self.config:
             warn(("Deprecated: workflow.config['crashdump_dir']\n"
@@ -625,23 +651,137 @@ class Workflow(WorkflowBase):
             self.config['execution']['crashdump_dir'] = crash_dir
             del self.config['crashdump_dir']
         logger.info(str(sorted(self.config)))
-        self._set_needed_outputs(flatgraph)
-        execgraph = self._generate_expanded_graph(deepcopy(flatgraph))
-        for index, node in enumerate(execgraph.nodes()):
-            node.config = merge_dict(deepcopy(self.config), node.config)
-            node.base_dir = self.base_dir
-            node.index = index
+        # an unknown provenance mode is reported before any node runs
+        prov_mode = provenance_mode(self.config)
+        plan_file = None
+        execgraph = None
+        if self.base_dir and str2bool(self.config['execution'].get(
+                'cache_execution_plan', 'false')):
+            plan_file = os.path.join(self.base_dir, self.name,
+                                     '_execution_plan.pkl')
+            hashvalue = self._get_plan_hashval()
+            execgraph = self._load_execution_plan(plan_file, hashvalue)
+        if execgraph is None:
+            execgraph = self._create_execution_plan()
+            if plan_file:
+                self._save_execution_plan(plan_file, hashvalue, execgraph)
+        for node in execgraph.nodes():
             if isinstance(node, MapNode):
                 node.use_plugin = (plugin, plugin_args)
-        self._configure_exec_nodes(execgraph)
         if str2bool(self.config['execution']['create_report']):
             self._write_report_info(self.base_dir, self.name, execgraph)
 
         runner.run(execgraph, updatehash=updatehash, config=self.config)
+        if prov_mode == 'workflow':
+            filename = None
+            if self.base_dir:
+                filename = os.path.join(self.base_dir, self.name,
+                                        'workflow_provenance')
+            write_prov(execgraph, filename=filename)
         return execgraph
 
     # PRIVATE API AND FUNCTIONS
 
+    def _create_execution_plan(self):
+        """Returns the configured execution graph of the workflow
+        """
+        flatgraph = self._create_flat_graph()
+        self._set_needed_outputs(flatgraph)
+        # the flat graph is a private copy of the workflow and is expanded
+        # in place
+        execgraph = self._generate_expanded_graph(flatgraph)
+        for index, node in enumerate(execgraph.nodes()):
+            # the nodes share the workflow config, except for the nodes that
+            # override some of its options
+            if node.config:
+                node.config = merge_dict(self.config, node.config)
+            else:
+                node.config = self.config
+            node.base_dir = self.base_dir
+            node.index = index
+        self._configure_exec_nodes(execgraph)
+        return execgraph
+
+    def _get_plan_structure(self, items, prefix):
+        """Appends the description of the nodes and connections of the
+        workflow hierarchy to items
+        """
+        for node in sorted(self._graph.nodes(), key=lambda node: node.name):
+            name = prefix + node.name
+            if isinstance(node, Workflow):
+                items.append((name, _structure(node.config)))
+                node._get_plan_structure(items, name + '.')
+                continue
+            # the interface is not copied, unlike with node.interface
+            interface = node._interface
+            try:
+                version = interface.version
+            except Exception:
+                version = None
+            attributes = dict((key, value)
+                              for key, value in node.__dict__.items()
+                              if key not in ['_interface',
+                                             '_interface_shared'])
+            items.append((name, node.__class__.__name__,
+                          interface.__class__.__module__,
+                          interface.__class__.__name__, str(version),
+                          _structure(interface.inputs),
+                          _structure(attributes)))
+        items.extend(sorted((prefix + source.name, prefix + destination.name,
+                             _structure(data))
+                            for source, destination, data
+                            in self._graph.edges(data=True)))
+
+    def _get_plan_hashval(self):
+        """Returns the hash of the workflow structure keying the execution
+        plan
+
+        The hash covers the nipype version, the configuration and base
+        directory of the workflow and the interfaces, inputs, iterables,
+        attributes and connections of all its nodes. Interfaces are described
+        by their class, version and inputs only. File inputs are hashed by
+        name only, since their content does not change the plan.
+        """
+        items = [nipype_version, self.base_dir, _structure(self.config)]
+        self._get_plan_structure(items, self.name + '.')
+        return sha1(repr(items)).hexdigest()
+
+    def _load_execution_plan(self, plan_file, hashvalue):
+        """Returns the execution graph cached in plan_file or None if it is
+        missing or was created for a different workflow structure
+        """
+        if not os.path.exists(plan_file):
+            return None
+        try:
+            plan_hashvalue, execgraph = cPickle.load(open(plan_file, 'rb'))
+        except Exception, msg:
+            logger.debug('Could not load execution plan %s: %s' % (plan_file,
+                                                                   msg))
+            return None
+        if plan_hashvalue != hashvalue:
+            logger.debug('Workflow %s changed, recreating its execution plan'
+                         % self.name)
+            return None
+        logger.info('Loaded execution plan of workflow %s' % self.name)
+        return execgraph
+
+    def _save_execution_plan(self, plan_file, hashvalue, execgraph):
+        """Saves the execution graph with the hash of the workflow structure
+        """
+        plan_dir = os.path.dirname(plan_file)
+        if not os.path.exists(plan_dir):
+            os.makedirs(plan_dir)
+        try:
+            plan_fp = open(plan_file, 'wb')
+            cPickle.dump((hashvalue, execgraph), plan_fp,
+                         cPickle.HIGHEST_PROTOCOL)
+            plan_fp.close()
+        except Exception, msg:
+            logger.warn('Could not save execution plan of workflow %s: %s'
+                        % (self.name, msg))
+            if os.path.exists(plan_file):
+                os.remove(plan_file)
+
     class GraphConnector(object):
         def __init__(self, workflow, graph):
             self._workflow = workflow
@@ -1116,9 +1256,16 @@ connected.
         return False
 
     def _create_flat_graph(self):
-        """Make a simple DAG where no node is a workflow."""
+        """Make a simple DAG where no node is a workflow.
+
+        The nodes of the graph are copies of the nodes of the workflow,
+        which share their interfaces until they access their inputs.
+        """
         logger.debug('Creating flat graph for workflow: %s', self.name)
-        workflowcopy = deepcopy(self)
+        memo = {}
+        for node in self._get_all_nodes():
+            node._share_interface(memo)
+        workflowcopy = deepcopy(self, memo)
         workflowcopy._generate_flatgraph()
         return workflowcopy._graph
 
@@ -1299,9 +1446,14 @@ class Node(WorkflowBase):
 
     """
 
+    # whether copies of the node can share the interface until they access
+    # its inputs (see _share_interface)
+    _copy_on_write = True
+
     def __init__(self, interface, name, iterables=None, itersource=None,
                  synchronize=False, iterconnect=None, overwrite=None,
-                 needed_outputs=None, run_without_submitting=False, **kwargs):
+                 needed_outputs=None, run_without_submitting=False,
+                 estimated_memory_gb=1, num_threads=1, **kwargs):
         """
         Parameters
         ----------
@@ -1369,6 +1521,14 @@ class Node(WorkflowBase):
             Run the node without submitting to a job engine or to a
             multiprocessing pool
 
+        estimated_memory_gb : float
+            Estimate of the peak memory (in GB) used by the node. Resource
+            aware plugins (e.g., MultiProc) use it to avoid oversubscribing
+            the memory of the host.
+
+        num_threads : int
+            Number of threads (cores) used by the node
+
         """
         super(Node, self).__init__(name, **kwargs)
         if interface is None:
@@ -1376,6 +1536,7 @@ class Node(WorkflowBase):
         if not isinstance(interface, Interface):
             raise IOError('interface must be an instance of an Interface')
         self._interface = interface
+        self._interface_shared = False
         self.name = name
         self._result = None
         self.iterables = iterables
@@ -1384,6 +1545,8 @@ class Node(WorkflowBase):
         self.overwrite = overwrite
         self.parameterization = None
         self.run_without_submitting = run_without_submitting
+        self.estimated_memory_gb = estimated_memory_gb
+        self.num_threads = num_threads
         self.input_source = {}
         self.needed_outputs = []
         self.plugin_args = {}
@@ -1395,6 +1558,7 @@ class Node(WorkflowBase):
     @property
     def interface(self):
         """Return the underlying interface object"""
+        self._own_interface()
         return self._interface
 
     @property
@@ -1409,6 +1573,7 @@ class Node(WorkflowBase):
     @property
     def inputs(self):
         """Return the inputs of the underlying interface"""
+        self._own_interface()
         return self._interface.inputs
 
     @property
@@ -1416,6 +1581,30 @@ class Node(WorkflowBase):
         """Return the output fields of the underlying interface"""
         return self._interface._outputs()
 
+    def _check_inputs(self, parameter):
+        if self._copy_on_write:
+            # does not copy a shared interface
+            return hasattr(self._interface.inputs, parameter)
+        return super(Node, self)._check_inputs(parameter)
+
+    def _share_interface(self, memo):
+        """Lets the deep copies of the node share its interface
+
+        The interface is registered in the memo dictionary passed to
+        deepcopy. The node and its copies then replace the shared interface
+        by a private copy before they access its inputs, which makes copies
+        of nodes replicated many times (e.g., by iterables) cheap.
+        """
+        if self._copy_on_write:
+            memo[id(self._interface)] = self._interface
+            self._interface_shared = True
+
+    def _own_interface(self):
+        """Replaces a shared interface by a private copy"""
+        if getattr(self, '_interface_shared', False):
+            self._interface = deepcopy(self._interface)
+            self._interface_shared = False
+
     def output_dir(self):
         """Return the location of the output directory for the node"""
         if self.base_dir is None:
@@ -1452,11 +1641,26 @@ class Node(WorkflowBase):
         """ Print interface help"""
         self._interface.help()
 
-    def hash_exists(self, updatehash=False):
+    def hash_exists(self, updatehash=False, hash_index=None):
+        """Checks whether the node has results for its current inputs
+
+        Parameters
+        ----------
+
+        updatehash: boolean
+            Update the hash stored in the output directory
+        hash_index: HashIndex
+            Workflow hash index consulted before listing the output
+            directory
+        """
         # Get a dictionary with hashed filenames and a hashvalue
         # of the dictionary itself.
         hashed_inputs, hashvalue = self._get_hashval()
         outdir = self.output_dir()
+        hashfile = os.path.join(outdir, '_0x%s.json' % hashvalue)
+        if (hash_index is not None and not updatehash and
+                hash_index.check(outdir, hashvalue)):
+            return True, hashvalue, hashfile, hashed_inputs
         hashfiles = glob(os.path.join(outdir, '_0x*.json'))
         if len(hashfiles) > 1:
             logger.info(hashfiles)
@@ -1480,11 +1684,14 @@ class Node(WorkflowBase):
         updatehash: boolean
             Update the hash stored in the output directory
         """
+        self._own_interface()
         # check to see if output directory and hash exist
         if self.config is None:
             self.config = deepcopy(config._sections)
         else:
             self.config = merge_dict(deepcopy(config._sections), self.config)
+        # the interface writes provenance according to the node config
+        self._interface._provenance_mode = provenance_mode(self.config)
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
@@ -1571,8 +1778,13 @@ class Node(WorkflowBase):
             except:
                 os.remove(hashfile_unfinished)
                 raise
-            shutil.move(hashfile_unfinished, hashfile)
-            self.write_report(report_type='postexec', cwd=outdir)
+            if self._is_deferred():
+                # the hash file is finished once the batch has run and the
+                # outputs have been collected (see MapNode._batch_runner)
+                logger.debug('%s: job deferred to a batch' % self.name)
+            else:
+                shutil.move(hashfile_unfinished, hashfile)
+                self.write_report(report_type='postexec', cwd=outdir)
         else:
             if not os.path.exists(os.path.join(outdir, '_inputs.pklz')):
                 logger.debug('%s: creating inputs file' % self.name)
@@ -1587,6 +1799,12 @@ class Node(WorkflowBase):
         return self._result
 
     # Private functions
+    def _is_deferred(self):
+        """Returns True if the interface deferred its job to an open batch
+        """
+        deferred = getattr(self._interface, '_deferred', None)
+        return deferred is not None and deferred()
+
     def _parameterization_dir(self, param):
         """
         Returns the directory name for the given parameterization string as follows:
@@ -1962,6 +2180,8 @@ class JoinNode(Node):
 
     """
 
+    _copy_on_write = False
+
     def __init__(self, interface, name, joinsource, joinfield=None,
         unique=False, **kwargs):
         """
@@ -2155,6 +2375,30 @@ class JoinNode(Node):
                          " to hold the %s value at index %d: %s"
                          % (self, slot_field, field, index, e))
 
+def _run_subnode(args):
+    """Runs a mapnode subnode in a pool process"""
+    i, node, updatehash = args
+    try:
+        node.run(updatehash=updatehash)
+    except Exception:
+        return i, RuntimeError(format_exc())
+    return i, None
+
+
+def _run_subnode_thread(args):
+    """Runs a mapnode subnode on a thread holding the working directory"""
+    i, node, updatehash = args
+    with working_directory_lock:
+        cwd = os.getcwd()
+        try:
+            node.run(updatehash=updatehash)
+        except Exception, err:
+            return i, err
+        finally:
+            os.chdir(cwd)
+    return i, None
+
+
 class MapNode(Node):
     """Wraps interface objects that need to be iterated on a list of inputs.
 
@@ -2170,7 +2414,10 @@ class MapNode(Node):
 
     """
 
-    def __init__(self, interface, iterfield, name, **kwargs):
+    _copy_on_write = False
+
+    def __init__(self, interface, iterfield, name, batch=False, n_procs=1,
+                 chunksize=1, cache_chunks=False, **kwargs):
         """
 
         Parameters
@@ -2184,6 +2431,27 @@ class MapNode(Node):
             paired (i.e. it does not compute a combinatorial product).
         name : alphanumeric string
             node specific name
+        batch : boolean
+            run the jobs of all subnodes at once if the interface supports
+            it (e.g., SPM interfaces run them in a single MATLAB process).
+            The mapnode is then submitted as a single job. Subnodes keep
+            their own working directories, hashes and results.
+        n_procs : integer
+            number of subnodes to run concurrently when the mapnode runs as
+            a whole (e.g., with the Linear plugin, run_without_submitting or
+            caching.Memory). Command line subnodes run on threads, other
+            subnodes in processes. The MultiProc plugin reserves at least
+            n_procs processors for the mapnode.
+        chunksize : integer
+            number of consecutive items run in sequence by each subnode.
+            Chunks of items are submitted as single jobs, which amortises
+            the scheduling and bookkeeping overhead of cheap items. Ignored
+            when batch is set.
+        cache_chunks : boolean
+            store hashes, results and reports once per chunk instead of once
+            per item. Items then run in their own directories without any
+            bookkeeping, but a change to any item of a chunk reruns all of
+            them.
 
         See Node docstring for additional keyword arguments.
         """
@@ -2191,6 +2459,15 @@ class MapNode(Node):
         if isinstance(iterfield, str):
             iterfield = [iterfield]
         self.iterfield = iterfield
+        self.batch = batch
+        self.n_procs = n_procs
+        self.chunksize = chunksize
+        self.cache_chunks = cache_chunks
+        # chunks name their subnodes after the items of the parent mapnode
+        self._is_chunk = False
+        self._item_name = None
+        self._item_offset = 0
+        self._cache_subnodes = True
         self._inputs = self._create_dynamic_traits(self._interface.inputs,
                                                    fields=self.iterfield)
         self._inputs.on_trait_change(self._set_mapnode_input)
@@ -2273,28 +2550,89 @@ class MapNode(Node):
         else:
             return None
 
+    def _subnode_template(self):
+        """Returns an interface without input values and the input values
+
+        Subnode interfaces are copied from the former, which is cheap, and
+        share the latter instead of holding deep copies of them.
+        """
+        interface = deepcopy(self._interface)
+        names = interface.inputs.copyable_trait_names()
+        values = dict((name, getattr(interface.inputs, name))
+                      for name in names if name not in self.iterfield)
+        interface.inputs.trait_set(trait_change_notify=False,
+                                   **dict((name, Undefined) for name in names))
+        return interface, values
+
+    def _num_items(self):
+        return len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
+
+    def _chunked(self):
+        return self.chunksize > 1 and not self.batch
+
+    def _subnode_names(self):
+        """Returns the names of the subnodes (or chunks) of the mapnode"""
+        nitems = self._num_items()
+        if self._chunked():
+            return ['_%s_chunk%d' % (self.name, k) for k in
+                    range(0, (nitems + self.chunksize - 1) // self.chunksize)]
+        return ['_%s%d' % (self._item_name or self.name,
+                           self._item_offset + i) for i in range(nitems)]
+
     def _make_nodes(self, cwd=None):
+        """Yields the index and node of each subnode as it is created"""
         if cwd is None:
             cwd = self.output_dir()
-        nitems = len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
-        for i in range(nitems):
-            nodename = '_' + self.name + str(i)
-            node = Node(deepcopy(self._interface), name=nodename)
+        if self._chunked():
+            for item in self._make_chunks(cwd):
+                yield item
+            return
+        template, values = self._subnode_template()
+        fieldvals = dict((field, filename_to_list(getattr(self.inputs, field)))
+                         for field in self.iterfield)
+        for i, nodename in enumerate(self._subnode_names()):
+            node = Node(deepcopy(template), name=nodename)
             node.overwrite = self.overwrite
             node.run_without_submitting = self.run_without_submitting
+            node.estimated_memory_gb = self.estimated_memory_gb
+            node.num_threads = self.num_threads
             node.plugin_args = self.plugin_args
-            node._interface.inputs.set(
-                **deepcopy(self._interface.inputs.get()))
+            node._interface.inputs.set(**values)
             for field in self.iterfield:
-                fieldvals = filename_to_list(getattr(self.inputs, field))
                 logger.debug('setting input %d %s %s' % (i, field,
-                                                         fieldvals[i]))
-                setattr(node.inputs, field,
-                        fieldvals[i])
+                                                         fieldvals[field][i]))
+                setattr(node.inputs, field, fieldvals[field][i])
             node.config = self.config
             node.base_dir = os.path.join(cwd, 'mapflow')
             yield i, node
 
+    def _make_chunks(self, cwd):
+        """Yields the index and mapnode of each chunk of items"""
+        template, values = self._subnode_template()
+        fieldvals = dict((field, filename_to_list(getattr(self.inputs, field)))
+                         for field in self.iterfield)
+        for k, nodename in enumerate(self._subnode_names()):
+            start = k * self.chunksize
+            interface = deepcopy(template)
+            interface.inputs.set(**values)
+            chunk = MapNode(interface, iterfield=self.iterfield, name=nodename)
+            for field in self.iterfield:
+                setattr(chunk.inputs, field,
+                        fieldvals[field][start:start + self.chunksize])
+            chunk.overwrite = self.overwrite
+            chunk.run_without_submitting = self.run_without_submitting
+            chunk.estimated_memory_gb = self.estimated_memory_gb
+            chunk.num_threads = self.num_threads
+            chunk.plugin_args = self.plugin_args
+            chunk.needed_outputs = self.needed_outputs
+            chunk._is_chunk = True
+            chunk._item_name = self.name
+            chunk._item_offset = start
+            chunk._cache_subnodes = not self.cache_chunks
+            chunk.config = self.config
+            chunk.base_dir = os.path.join(cwd, 'mapflow')
+            yield k, chunk
+
     def _node_runner(self, nodes, updatehash=False):
         for i, node in nodes:
             err = None
@@ -2306,6 +2644,201 @@ class MapNode(Node):
                     raise
             yield i, node, err
 
+    def _uncached_runner(self, nodes):
+        """Runs the interfaces of the subnodes without any bookkeeping
+
+        The subnodes get fresh working directories, but no hash files,
+        pickles or reports. Only the mapnode (a chunk) is cached.
+        """
+        stop = str2bool(self.config['execution']['stop_on_first_crash'])
+        for i, node in nodes:
+            err = None
+            outdir = node.output_dir()
+            if os.path.exists(outdir):
+                shutil.rmtree(outdir)
+            os.makedirs(outdir)
+            os.chdir(outdir)
+            node._result = InterfaceResult(
+                interface=node._interface.__class__,
+                runtime=Bunch(returncode=1, hostname=gethostname()),
+                inputs=node._interface.inputs.get_traitsfree())
+            try:
+                node._copyfiles_to_wd(outdir, True)
+                node._interface._provenance_mode = provenance_mode(
+                    node.config)
+                node._result = node._interface.run()
+            except Exception, err:
+                node._result.runtime.stderr = str(err)
+                if stop:
+                    self._result = node.result
+                    raise
+            yield i, node, err
+
+    def _pool_runner(self, nodes, updatehash=False):
+        """Runs the subnodes on a local pool of n_procs workers
+
+        Threads run command line subnodes concurrently while they wait for
+        their commands. Other subnodes run in processes, or serially within
+        a daemonic process, which cannot have children. Subnodes are
+        yielded in order. The pool is fed from the lazy nodes iterator and
+        holds at most twice n_procs subnodes that have not been yielded.
+        """
+        use_threads = isinstance(self._interface, CommandLine)
+        if not use_threads and current_process().daemon:
+            for item in self._node_runner(nodes, updatehash=updatehash):
+                yield item
+            return
+        cwd = os.getcwd()
+        window = Semaphore(2 * self.n_procs)
+        pending = {}
+        stopped = []
+
+        def tasks():
+            # runs on the task handler thread of the pool, which blocks
+            # until a slot of the window is free
+            for i, node in nodes:
+                window.acquire()
+                if stopped:
+                    return
+                pending[i] = node
+                yield i, node, updatehash
+        if use_threads:
+            pool = ThreadPool(self.n_procs)
+            results = pool.imap(_run_subnode_thread, tasks())
+        else:
+            pool = Pool(self.n_procs)
+            results = pool.imap(_run_subnode, tasks())
+        stop = str2bool(self.config['execution']['stop_on_first_crash'])
+        try:
+            for i, err in results:
+                node = pending.pop(i)
+                window.release()
+                if not use_threads:
+                    # the subnode ran in another process
+                    node._result = node.result
+                    if node._result is None:
+                        runtime = Bunch(returncode=1, stderr=str(err))
+                        node._result = InterfaceResult(
+                            interface=node._interface.__class__,
+                            runtime=runtime,
+                            inputs=node._interface.inputs.get_traitsfree())
+                if err is not None and stop:
+                    self._result = node.result
+                    raise err
+                yield i, node, err
+            pool.close()
+        except:
+            # unblocks the task handler so that the pool can terminate
+            stopped.append(True)
+            window.release()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            os.chdir(cwd)
+
+    def _create_batch(self):
+        """Returns the batch the interface runs its jobs in or None"""
+        if not self.batch or not hasattr(self._interface, 'create_batch'):
+            return None
+        return self._interface.create_batch()
+
+    def _batch_runner(self, nodes, batch, updatehash=False):
+        """Runs the subnodes, executing the jobs they defer to batch at once
+
+        Subnodes whose job was deferred keep an unfinished hash file until
+        the batch has run and their outputs have been collected.
+        """
+        finished = {}
+        deferred = []
+        with batch:
+            for i, node, err in self._node_runner(nodes,
+                                                  updatehash=updatehash):
+                if err is None and node._interface in batch:
+                    deferred.append((i, node))
+                else:
+                    finished[i] = (node, err)
+        if deferred:
+            logger.info('Running %d batched jobs of %s' % (len(deferred),
+                                                           self))
+            batch.run()
+        for i, node in deferred:
+            err = None
+            try:
+                self._finish_batched_node(node, batch)
+            except Exception, err:
+                if str2bool(self.config['execution']['stop_on_first_crash']):
+                    self._result = node.result
+                    raise
+            finished[i] = (node, err)
+        for i in sorted(finished):
+            yield (i,) + finished[i]
+
+    def _finish_batched_node(self, node, batch):
+        """Collects the outputs of a subnode once its batched job has run"""
+        outdir = node.output_dir()
+        unfinished = glob(op.join(outdir, '_0x*_unfinished.json'))
+        result = node.result
+        old_cwd = os.getcwd()
+        os.chdir(outdir)
+        try:
+            batch.update_runtime(node._interface, result.runtime)
+            outputs = node._interface.aggregate_outputs(
+                needed_outputs=node.needed_outputs)
+            result.outputs = clean_working_directory(outputs, outdir,
+                                                     node._interface.inputs,
+                                                     node.needed_outputs,
+                                                     node.config)
+            node._save_results(result, outdir)
+        except:
+            for hashfile in unfinished:
+                os.remove(hashfile)
+            raise
+        finally:
+            os.chdir(old_cwd)
+        for hashfile in unfinished:
+            shutil.move(hashfile,
+                        hashfile[:-len('_unfinished.json')] + '.json')
+        node.write_report(report_type='preexec', cwd=outdir)
+        node.write_report(report_type='postexec', cwd=outdir)
+
+    def _collate_chunks(self, chunks):
+        """Concatenates the results of the chunks of the mapnode"""
+        self._result = InterfaceResult(interface=[], runtime=[],
+                                       provenance=[], outputs=self.outputs)
+        keys = []
+        if self.outputs:
+            keys = [key for key, _ in self.outputs.items()]
+            rm_extra = self.config['execution']['remove_unnecessary_outputs']
+            if str2bool(rm_extra) and self.needed_outputs:
+                keys = [key for key in keys if key in self.needed_outputs]
+        values = dict((key, []) for key in keys)
+        msg = []
+        for _, chunk, err in chunks:
+            nitems = chunk._num_items()
+            result = chunk.result
+            if err is not None:
+                msg += ['Chunk %s failed' % chunk.name, 'Error:', str(err)]
+            if err is not None or not result:
+                self._result.runtime.extend([None] * nitems)
+                for key in keys:
+                    values[key].extend([None] * nitems)
+                continue
+            self._result.interface.extend(result.interface)
+            self._result.runtime.extend(result.runtime)
+            self._result.provenance.extend(result.provenance)
+            for key in keys:
+                chunk_values = getattr(result.outputs, key, Undefined)
+                if not isdefined(chunk_values):
+                    chunk_values = [Undefined] * nitems
+                values[key].extend(chunk_values)
+        for key in keys:
+            if any([isdefined(val) for val in values[key]]):
+                setattr(self._result.outputs, key, values[key])
+        if msg:
+            raise Exception('Subnodes of node: %s failed:\n%s' %
+                            (self.name, '\n'.join(msg)))
+
     def _collate_results(self, nodes):
         self._result = InterfaceResult(interface=[], runtime=[],
                                        provenance=[], outputs=self.outputs)
@@ -2356,11 +2889,8 @@ class MapNode(Node):
             report_file = os.path.join(report_dir, 'report.rst')
             fp = open(report_file, 'at')
             fp.writelines(write_rst_header('Subnode reports', level=1))
-            nitems = len(filename_to_list(
-                getattr(self.inputs, self.iterfield[0])))
             subnode_report_files = []
-            for i in range(nitems):
-                nodename = '_' + self.name + str(i)
+            for i, nodename in enumerate(self._subnode_names()):
                 subnode_report_files.insert(i, 'subnode %d' % i + ' : ' +
                                                os.path.join(cwd,
                                                             'mapflow',
@@ -2371,19 +2901,27 @@ class MapNode(Node):
             fp.close()
 
     def get_subnodes(self):
+        return list(self.iter_subnodes())
+
+    def iter_subnodes(self):
+        """Returns an iterator creating the subnodes on demand
+
+        Execution plugins use it to hold only the subnodes they are about
+        to run instead of all the subnodes of a large mapnode.
+        """
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
         self._check_iterfield()
         self.write_report(report_type='preexec', cwd=self.output_dir())
-        return [node for _, node in self._make_nodes()]
+        return (node for _, node in self._make_nodes())
 
     def num_subnodes(self):
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
         self._check_iterfield()
-        return len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
+        return len(self._subnode_names())
 
     def _get_inputs(self):
         old_inputs = self._inputs.get()
@@ -2423,12 +2961,23 @@ class MapNode(Node):
         os.chdir(cwd)
         self._check_iterfield()
         if execute:
-            nitems = len(filename_to_list(getattr(self.inputs,
-                                                  self.iterfield[0])))
-            nodenames = ['_' + self.name + str(i) for i in range(nitems)]
+            nodenames = self._subnode_names()
             # map-reduce formulation
-            self._collate_results(self._node_runner(self._make_nodes(cwd),
-                                                    updatehash=updatehash))
+            nodes = self._make_nodes(cwd)
+            batch = self._create_batch()
+            if batch is not None:
+                runner = self._batch_runner(nodes, batch,
+                                            updatehash=updatehash)
+            elif self.n_procs > 1:
+                runner = self._pool_runner(nodes, updatehash=updatehash)
+            elif not self._cache_subnodes:
+                runner = self._uncached_runner(nodes)
+            else:
+                runner = self._node_runner(nodes, updatehash=updatehash)
+            if self._chunked():
+                self._collate_chunks(runner)
+            else:
+                self._collate_results(runner)
             self._save_results(self._result, cwd)
             # remove any node directories no longer required
             dirs2remove = []
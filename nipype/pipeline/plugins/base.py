@@ -3,11 +3,16 @@
 """Common graph operations for execution
 """
 
-from copy import deepcopy
+from collections import deque
+import cPickle
 from glob import glob
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 import os
 import stat
 import pwd
+from Queue import Queue, Empty
+import re
 import shutil
 from socket import gethostname
 import sys
@@ -16,9 +21,8 @@ from traceback import format_exception, format_exc
 from warnings import warn
 
 import numpy as np
-import scipy.sparse as ssp
 
-from ..utils import (nx, dfs_preorder_function)
+from ..utils import (nx, dfs_preorder_function, HashIndex)
 from ..engine import (MapNode, str2bool)
 
 from nipype.utils.filemanip import savepkl, loadpkl
@@ -91,9 +95,42 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
-def create_pyscript(node, updatehash=False, store_exception=True):
-    # pickle node
-    timestamp = strftime('%Y%m%d_%H%M%S')
+def get_previous_runtime(node):
+    """Returns the duration (in seconds) of the previous run of a node
+
+    The duration is read from the node report or, for mapnodes, summed over
+    the runtimes stored in the results file. Returns None if the node has not
+    been run before.
+    """
+    if node.base_dir is None:
+        return None
+    outdir = node.output_dir()
+    if isinstance(node, MapNode):
+        resultsfile = os.path.join(outdir, 'result_%s.pklz' % node.name)
+        if not os.path.exists(resultsfile):
+            return None
+        try:
+            result = loadpkl(resultsfile)
+            return sum([runtime.duration for runtime in result.runtime
+                        if runtime is not None])
+        except Exception:
+            return None
+    report_file = os.path.join(outdir, '_report', 'report.rst')
+    try:
+        with open(report_file, 'rt') as fp:
+            report = fp.read()
+    except IOError:
+        return None
+    _, _, runtime_info = report.partition('Runtime info')
+    match = re.search(r'^\* duration : ([-+.0-9eE]+)\s*$', runtime_info, re.M)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def get_batch_dir(node, timestamp):
+    """Returns the batch directory of node and the suffix of its batch files
+    """
     if node._hierarchy:
         suffix = '%s_%s_%s' % (timestamp, node._hierarchy, node._id)
         batch_dir = os.path.join(node.base_dir,
@@ -102,6 +139,13 @@ def create_pyscript(node, updatehash=False, store_exception=True):
     else:
         suffix = '%s_%s' % (timestamp, node._id)
         batch_dir = os.path.join(node.base_dir, 'batch')
+    return batch_dir, suffix
+
+
+def create_pyscript(node, updatehash=False, store_exception=True):
+    # pickle node
+    timestamp = strftime('%Y%m%d_%H%M%S')
+    batch_dir, suffix = get_batch_dir(node, timestamp)
     if not os.path.exists(batch_dir):
         os.makedirs(batch_dir)
     pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
@@ -162,6 +206,72 @@ except Exception, e:
     return pyscript
 
 
+def create_node_payload(node, timestamp, updatehash=False):
+    """Pickles the config and the node for the runner script
+
+    The config is stored first so that the runner can apply it before
+    unpickling the node imports any interface module. Returns the name of the
+    payload file.
+    """
+    batch_dir, suffix = get_batch_dir(node, timestamp)
+    pkl_file = os.path.join(batch_dir, 'node_%s.pkl' % suffix)
+    payload = (cPickle.dumps(node.config, cPickle.HIGHEST_PROTOCOL) +
+               cPickle.dumps(dict(node=node, updatehash=updatehash),
+                             cPickle.HIGHEST_PROTOCOL))
+    # the file is written without holding the interpreter lock
+    pkl_fp = open(pkl_file, 'wb')
+    pkl_fp.write(payload)
+    pkl_fp.close()
+    return pkl_file
+
+
+def create_runner_script(batch_dir, timestamp):
+    """Writes the script running the node payload given as its argument
+
+    A single runner script is shared by all the nodes of a graph submission.
+    Crashes are reported like with create_pyscript(store_exception=False).
+    """
+    cmdstr = """import os
+import sys
+import cPickle
+from nipype import config, logging
+from nipype.utils.filemanip import savepkl
+from socket import gethostname
+from traceback import format_exception
+info = None
+pklfile = sys.argv[1]
+batchdir, name = os.path.split(pklfile)
+try:
+    pkl_fp = open(pklfile, 'rb')
+    config.update_config(cPickle.load(pkl_fp))
+    config.update_matplotlib()
+    logging.update_logging(config)
+    traceback=None
+    info = cPickle.load(pkl_fp)
+    pkl_fp.close()
+    result = info['node'].run(updatehash=info['updatehash'])
+except Exception, e:
+    etype, eval, etr = sys.exc_info()
+    traceback = format_exception(etype,eval,etr)
+    if info is None:
+        resultsfile = os.path.join(batchdir, 'crashdump_%s.pklz' %
+                                   name[len('node_'):-len('.pkl')])
+        savepkl(resultsfile, dict(result=None, hostname=gethostname(),
+                                  traceback=traceback))
+    else:
+        from nipype.pipeline.plugins.base import report_crash
+        report_crash(info['node'], traceback, gethostname())
+    raise Exception(e)
+"""
+    if not os.path.exists(batch_dir):
+        os.makedirs(batch_dir)
+    pyscript = os.path.join(batch_dir, 'pyscript_runner_%s.py' % timestamp)
+    fp = open(pyscript, 'wt')
+    fp.writelines(cmdstr)
+    fp.close()
+    return pyscript
+
+
 class PluginBase(object):
     """Base class for plugins"""
 
@@ -178,33 +288,76 @@ class PluginBase(object):
 
 class DistributedPluginBase(PluginBase):
     """Execute workflow with a distribution engine
+
+    Plugins that can detect the completion of a task asynchronously (e.g.,
+    through a multiprocessing callback or a monitoring thread) should set
+    `_use_notification` to True and call `_notify_task_done` with the task
+    id. The scheduler then wakes up as soon as a task finishes instead of
+    polling the pending tasks every `poll_interval` seconds.
+
+    The subnodes of a mapnode are created on demand: at most
+    `plugin_args['subnode_window']` (default 1000) unfinished subnodes of a
+    mapnode exist at any time, and finished subnodes are released.
     """
 
+    _use_notification = False
+
     def __init__(self, plugin_args=None):
         """Initialize runtime attributes to none
 
         procs: list (N) of underlying interface elements to be processed
-        proc_done: a boolean vector (N) signifying whether a process has been
+        proc_done: a boolean list (N) signifying whether a process has been
             executed
-        proc_pending: a boolean vector (N) signifying whether a
+        proc_pending: a boolean list (N) signifying whether a
             process is currently running. Note: A process is finished only when
             both proc_done==True and
         proc_pending==False
-        depidx: a boolean matrix (NxN) storing the dependency structure accross
-            processes. Process dependencies are derived from each column.
+        depcount: a list (N) with the number of unfinished dependencies of
+            each process
+        successors: a list (N) with the indices of the processes depending on
+            each process
+        readyqueue: a deque of processes whose dependencies are satisfied
+        refcount: a list (N) with the number of unfinished successors of each
+            process, used to remove node directories whose outputs have been
+            used up when execution.remove_node_directories is set
+        priority: a list (N) with the submission priority of each process when
+            a priority policy is selected with plugin_args['priority']:
+
+            - critical_path: processes with the longest downstream path,
+              weighted by the runtimes of previous runs, are submitted first
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
-        self.depidx = None
-        self.refidx = None
+        self.depcount = None
+        self.successors = None
+        self.readyqueue = None
+        self.refcount = None
+        self.predecessors = None
+        self._removable = None
         self.mapnodes = None
         self.mapnodesubids = None
+        self._subnodes = None
         self.proc_done = None
         self.proc_pending = None
+        self._hash_index = None
         self.max_jobs = np.inf
+        self._poll_interval = 2
+        self._done_queue = Queue()
         if plugin_args and 'max_jobs' in plugin_args:
             self.max_jobs = plugin_args['max_jobs']
             logger.debug("Maximum jobs is set to %d." % self.max_jobs)
+        if plugin_args and 'poll_interval' in plugin_args:
+            self._poll_interval = float(plugin_args['poll_interval'])
+        self._subnode_window = 1000
+        if plugin_args and 'subnode_window' in plugin_args:
+            self._subnode_window = int(plugin_args['subnode_window'])
+        self._priority_policy = None
+        self.priority = None
+        if plugin_args and plugin_args.get('priority'):
+            if plugin_args['priority'] not in ['critical_path']:
+                raise ValueError('Unknown job priority policy: %s' %
+                                 plugin_args['priority'])
+            self._priority_policy = plugin_args['priority']
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -213,15 +366,29 @@ class DistributedPluginBase(PluginBase):
         self._config = config
         # Generate appropriate structures for worker-manager model
         self._generate_dependency_list(graph)
+        self._hash_index = self._load_hash_index()
         self.pending_tasks = []
-        self.readytorun = []
-        self.mapnodes = []
+        self.mapnodes = set()
         self.mapnodesubids = {}
-        # setup polling - TODO: change to threaded model
+        self._subnodes = {}
         notrun = []
-        while np.any(self.proc_done == False) | \
-                    np.any(self.proc_pending == True):
+        try:
+            self._run_loop(graph, notrun, updatehash=updatehash)
+        finally:
+            if self._hash_index is not None:
+                self._hash_index.save()
+        self._remove_node_dirs()
+        report_nodes_not_run(notrun)
+
+    def _run_loop(self, graph, notrun, updatehash=False):
+        """Submits the ready jobs and collects the results until all the
+        processes are done
+        """
+        # all processes are done once nothing is left to submit or to wait for
+        while self.readyqueue or self.pending_tasks:
             toappend = []
+            self._poll_pending_tasks([taskid for taskid, _ in
+                                      self.pending_tasks])
             # trigger callbacks for any pending results
             while self.pending_tasks:
                 taskid, jobid = self.pending_tasks.pop()
@@ -232,6 +399,7 @@ class DistributedPluginBase(PluginBase):
                             notrun.append(self._clean_queue(jobid, graph,
                                                             result=result))
                         else:
+                            self._update_hash_index(jobid)
                             self._task_finished_cb(jobid)
                             self._remove_node_dirs()
                         self._clear_task(taskid)
@@ -252,9 +420,72 @@ class DistributedPluginBase(PluginBase):
                     slots = self.max_jobs - num_jobs
                 self._send_procs_to_workers(updatehash=updatehash,
                                             slots=slots, graph=graph)
-            sleep(2)
-        self._remove_node_dirs()
-        report_nodes_not_run(notrun)
+            if self.readyqueue or self.pending_tasks:
+                self._wait_for_tasks()
+
+    def _load_hash_index(self):
+        """Loads the hash index stored in the workflow directory
+        """
+        use_index = self._config['execution'].get('use_hash_index', 'false')
+        if not (self.procs and str2bool(use_index)):
+            return None
+        node = self.procs[0]
+        if node.base_dir is None:
+            return None
+        workflow_dir = node.base_dir
+        if node._hierarchy:
+            workflow_dir = os.path.join(workflow_dir,
+                                        node._hierarchy.split('.')[0])
+        if not os.path.exists(workflow_dir):
+            os.makedirs(workflow_dir)
+        return HashIndex(os.path.join(workflow_dir, '_hashindex.json'))
+
+    def _update_hash_index(self, jobid, hashvalue=None):
+        """Records the hash of a finished process in the hash index
+        """
+        if self._hash_index is None:
+            return
+        node = self.procs[jobid]
+        if hashvalue is None:
+            self._hash_index.update(node)
+        else:
+            outdir = node.output_dir()
+            self._hash_index.add(outdir, hashvalue,
+                                 os.path.join(outdir,
+                                              'result_%s.pklz' % node.name))
+
+    def _notify_task_done(self, taskid):
+        """Signals the scheduler that a task has finished
+
+        This method is thread-safe and can be called from a callback or a
+        monitoring thread of the plugin.
+        """
+        self._done_queue.put(taskid)
+
+    def _wait_for_tasks(self):
+        """Blocks until a task finishes or the poll interval expires
+        """
+        if not self._use_notification:
+            sleep(self._poll_interval)
+            return
+        try:
+            self._done_queue.get(True, self._poll_interval)
+        except Empty:
+            return
+        # consume any other notifications, since all the pending tasks are
+        # checked on the next pass
+        while True:
+            try:
+                self._done_queue.get_nowait()
+            except Empty:
+                break
+
+    def _poll_pending_tasks(self, taskids):
+        """Called on every scheduling pass with the ids of the pending tasks
+        before their results are collected, so that plugins can query the
+        states of all the tasks at once
+        """
+        pass
 
     def _get_result(self, taskid):
         raise NotImplementedError
@@ -283,106 +514,179 @@ class DistributedPluginBase(PluginBase):
             jobid = self.mapnodesubids[jobid]
             self.proc_pending[jobid] = False
             self.proc_done[jobid] = True
+            # the remaining subnodes are not created
+            self._subnodes.pop(jobid, None)
         # remove dependencies from queue
         return self._remove_node_deps(jobid, crashfile, graph)
 
     def _submit_mapnode(self, jobid):
         if jobid in self.mapnodes:
             return True
-        self.mapnodes.append(jobid)
-        mapnodesubids = self.procs[jobid].get_subnodes()
-        numnodes = len(mapnodesubids)
+        self.mapnodes.add(jobid)
+        numnodes = self.procs[jobid].num_subnodes()
         logger.info('Adding %d jobs for mapnode %s' % (numnodes,
                                                        self.procs[jobid]._id))
-        for i in range(numnodes):
-            self.mapnodesubids[self.depidx.shape[0] + i] = jobid
-        self.procs.extend(mapnodesubids)
-        self.depidx = ssp.vstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros((numnodes,
-                                                           self.depidx.shape[1])))),
-                                 'lil')
-        self.depidx = ssp.hstack((self.depidx,
-                                  ssp.lil_matrix(
-                                      np.zeros((self.depidx.shape[0],
-                                                numnodes)))),
-                                 'lil')
-        self.depidx[-numnodes:, jobid] = 1
-        self.proc_done = np.concatenate((self.proc_done,
-                                         np.zeros(numnodes, dtype=bool)))
-        self.proc_pending = np.concatenate((self.proc_pending,
-                                            np.zeros(numnodes, dtype=bool)))
+        # the mapnode becomes ready again once all the subnodes have finished
+        self.depcount[jobid] += numnodes
+        self._subnodes[jobid] = self.procs[jobid].iter_subnodes()
+        self._add_subnodes(jobid, self._subnode_window)
         return False
 
+    def _add_subnodes(self, jobid, count):
+        """Creates up to count more subnodes of a mapnode
+
+        The subnodes have no dependencies and are added to the ready queue.
+        """
+        subnodes = self._subnodes.get(jobid)
+        if subnodes is None:
+            return
+        added = 0
+        for subnode in islice(subnodes, count):
+            subid = len(self.procs)
+            self.procs.append(subnode)
+            self.mapnodesubids[subid] = jobid
+            self.depcount.append(0)
+            self.successors.append([jobid])
+            self.proc_done.append(False)
+            self.proc_pending.append(False)
+            if self.priority is not None:
+                self.priority.append(self.priority[jobid])
+            self.readyqueue.append(subid)
+            added += 1
+        if added < count:
+            del self._subnodes[jobid]
+
     def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
-        """ Sends jobs to workers using ipython's taskclient interface
+        """ Sends jobs to workers
+
+        Ready jobs are ordered by `_sort_jobs` and submitted until all the
+        available slots are used. Jobs for which the plugin does not have
+        enough resources are kept in the ready queue for the next pass.
         """
-        while np.any(self.proc_done == False):
-            # Check to see if a job is available
-            jobids = np.flatnonzero((self.proc_done == False) &
-                                    (self.depidx.sum(axis=0) == 0).__array__())
-            if len(jobids) > 0:
-                # send all available jobs
-                logger.info('Submitting %d jobs' % len(jobids))
-                for jobid in jobids[:slots]:
-                    if isinstance(self.procs[jobid], MapNode):
-                        try:
-                            num_subnodes = self.procs[jobid].num_subnodes()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue
-                        if num_subnodes > 1:
-                            submit = self._submit_mapnode(jobid)
-                            if not submit:
-                                continue
-                    # change job status in appropriate queues
-                    self.proc_done[jobid] = True
-                    self.proc_pending[jobid] = True
-                    # Send job to task manager and add to pending tasks
-                    logger.info('Submitting: %s ID: %d' %
-                               (self.procs[jobid]._id, jobid))
-                    if self._status_callback:
-                        self._status_callback(self.procs[jobid], 'start')
-                    continue_with_submission = True
-                    if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
-                        logger.debug('checking hash locally')
-                        try:
-                            hash_exists, _, _, _ = self.procs[
-                                jobid].hash_exists()
-                            logger.debug('Hash exists %s' % str(hash_exists))
-                            if (hash_exists and
-                               (self.procs[jobid].overwrite == False or
-                               (self.procs[jobid].overwrite == None and
-                                    not self.procs[jobid]._interface.always_run))):
-                                continue_with_submission = False
-                                self._task_finished_cb(jobid)
-                                self._remove_node_dirs()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue_with_submission = False
-                    logger.debug('Finished checking hash %s' %
-                                 str(continue_with_submission))
-                    if continue_with_submission:
-                        if self.procs[jobid].run_without_submitting:
-                            logger.debug('Running node %s on master thread' %
-                                         self.procs[jobid])
-                            try:
-                                self.procs[jobid].run()
-                            except Exception:
-                                self._clean_queue(jobid, graph)
-                            self._task_finished_cb(jobid)
-                            self._remove_node_dirs()
-                        else:
-                            tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                                   updatehash=updatehash)
-                            if tid is None:
-                                self.proc_done[jobid] = False
-                                self.proc_pending[jobid] = False
-                            else:
-                                self.pending_tasks.insert(0, (tid, jobid))
+        deferred = []
+        while self.readyqueue:
+            jobids = [jobid for jobid in self.readyqueue
+                      if not self.proc_done[jobid]]
+            self.readyqueue.clear()
+            for jobid in self._sort_jobs(jobids):
+                if self.proc_done[jobid]:
+                    continue
+                if slots is not None and slots <= 0:
+                    deferred.append(jobid)
+                    continue
+                if self._submit_ready_job(jobid, updatehash=updatehash,
+                                          graph=graph):
+                    if slots is not None:
+                        slots -= 1
+                elif not (self.proc_done[jobid] or self.depcount[jobid]):
+                    # expanded mapnodes wait for their subnodes instead
+                    deferred.append(jobid)
+        # jobs that could not be submitted are retried on the next pass
+        self.readyqueue.extendleft(reversed(deferred))
+
+    def _sort_jobs(self, jobids):
+        """Returns the ready jobs in the order they should be submitted
+        """
+        if self.priority is None:
+            return jobids
+        return sorted(jobids, key=lambda jobid: self.priority[jobid],
+                      reverse=True)
+
+    def _get_runtime(self, node):
+        """Returns the expected runtime of a node in seconds
+        """
+        runtime = get_previous_runtime(node)
+        if runtime is None:
+            return 1.
+        return runtime
+
+    def _critical_path_priority(self, graph):
+        """Returns the length of the longest downstream path of each process
+        """
+        pathlength = {}
+        for node in reversed(nx.topological_sort(graph)):
+            downstream = [pathlength[succ] for succ in
+                          graph.successors_iter(node)]
+            pathlength[node] = self._get_runtime(node) + max(downstream + [0])
+        return [pathlength[node] for node in self.procs]
+
+    def _check_resources(self, node):
+        """Checks whether there are enough resources to submit the node
+        """
+        return True
+
+    def _submit_ready_job(self, jobid, updatehash=False, graph=None):
+        """Submits a job whose dependencies are satisfied
+
+        Returns True if the job was sent to a worker. Jobs that are not sent
+        are either finished (e.g., a mapnode, a node whose hash exists) or
+        should be submitted again later.
+        """
+        if isinstance(self.procs[jobid], MapNode):
+            try:
+                num_subnodes = self.procs[jobid].num_subnodes()
+            except Exception:
+                self._clean_queue(jobid, graph)
+                self.proc_pending[jobid] = False
+                return False
+            # batched mapnodes and chunks of mapnodes run their subnodes in
+            # a single job
+            if num_subnodes > 1 and not (self.procs[jobid].batch or
+                                         self.procs[jobid]._is_chunk):
+                submit = self._submit_mapnode(jobid)
+                if not submit:
+                    return False
+        if (not self.procs[jobid].run_without_submitting and
+                not self._check_resources(self.procs[jobid])):
+            return False
+        # change job status in appropriate queues
+        self.proc_done[jobid] = True
+        self.proc_pending[jobid] = True
+        # Send job to task manager and add to pending tasks
+        logger.info('Submitting: %s ID: %d' %
+                    (self.procs[jobid]._id, jobid))
+        if self._status_callback:
+            self._status_callback(self.procs[jobid], 'start')
+        if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
+            logger.debug('checking hash locally')
+            try:
+                hash_exists, hashvalue, _, _ = self.procs[jobid].hash_exists(
+                    hash_index=self._hash_index)
+                logger.debug('Hash exists %s' % str(hash_exists))
+                if (hash_exists and
+                   (self.procs[jobid].overwrite == False or
+                   (self.procs[jobid].overwrite == None and
+                        not self.procs[jobid]._interface.always_run))):
+                    self._update_hash_index(jobid, hashvalue)
+                    self._task_finished_cb(jobid)
+                    self._remove_node_dirs()
+                    return False
+            except Exception:
+                self._clean_queue(jobid, graph)
+                self.proc_pending[jobid] = False
+                return False
+        logger.debug('Finished checking hash')
+        if self.procs[jobid].run_without_submitting:
+            logger.debug('Running node %s on master thread' %
+                         self.procs[jobid])
+            try:
+                self.procs[jobid].run()
+            except Exception:
+                self._clean_queue(jobid, graph)
             else:
-                break
+                self._update_hash_index(jobid)
+            self._task_finished_cb(jobid)
+            self._remove_node_dirs()
+            return False
+        # the node is not copied, since the plugins serialize it to send it
+        # to the workers
+        tid = self._submit_job(self.procs[jobid], updatehash=updatehash)
+        if tid is None:
+            self.proc_done[jobid] = False
+            self.proc_pending[jobid] = False
+            return False
+        self.pending_tasks.insert(0, (tid, jobid))
+        return True
 
     def _task_finished_cb(self, jobid):
         """ Extract outputs and assign to inputs of dependent tasks
@@ -396,29 +700,55 @@ class DistributedPluginBase(PluginBase):
         # Update job and worker queues
         self.proc_pending[jobid] = False
         # update the job dependency structure
-        rowview = self.depidx.getrowview(jobid)
-        rowview[rowview.nonzero()] = 0
-        if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+        for succid in self.successors[jobid]:
+            self.depcount[succid] -= 1
+            if self.depcount[succid] == 0:
+                self.readyqueue.append(succid)
+        self.successors[jobid] = []
+        if jobid in self.mapnodesubids:
+            # release the subnode and create the next one in its place
+            self.procs[jobid] = None
+            self._add_subnodes(self.mapnodesubids[jobid], 1)
+        if self.refcount is not None and jobid not in self.mapnodesubids:
+            for predid in self.predecessors[jobid]:
+                self.refcount[predid] -= 1
+                if self.refcount[predid] == 0:
+                    self._removable.append(predid)
+            if self.refcount[jobid] == 0:
+                self._removable.append(jobid)
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
         """
         self.procs = graph.nodes()
-        try:
-            self.depidx = nx.to_scipy_sparse_matrix(graph, format='lil')
-        except:
-            self.depidx = nx.to_scipy_sparse_matrix(graph)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
-        self.proc_done = np.zeros(len(self.procs), dtype=bool)
-        self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self._procidx = dict((node, idx) for idx, node in
+                             enumerate(self.procs))
+        # the reference counts are only needed to remove node directories
+        self.refcount = None
+        self.predecessors = None
+        self._removable = None
+        if str2bool(self._config['execution']['remove_node_directories']):
+            self.refcount = [graph.out_degree(node) for node in self.procs]
+            self.predecessors = [[self._procidx[pred] for pred in
+                                  graph.predecessors_iter(node)]
+                                 for node in self.procs]
+            self._removable = deque()
+        self.depcount = [graph.in_degree(node) for node in self.procs]
+        self.successors = [[self._procidx[succ] for succ in
+                            graph.successors_iter(node)]
+                           for node in self.procs]
+        self.readyqueue = deque(idx for idx, count in
+                                enumerate(self.depcount) if count == 0)
+        self.proc_done = [False] * len(self.procs)
+        self.proc_pending = [False] * len(self.procs)
+        if self._priority_policy == 'critical_path':
+            self.priority = self._critical_path_priority(graph)
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         dfs_preorder = dfs_preorder_function()
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
         for node in subnodes:
-            idx = self.procs.index(node)
+            idx = self._procidx[node]
             self.proc_done[idx] = True
             self.proc_pending[idx] = False
         return dict(node=self.procs[jobid],
@@ -428,27 +758,44 @@ class DistributedPluginBase(PluginBase):
     def _remove_node_dirs(self):
         """Removes directories whose outputs have already been used up
         """
-        if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero((self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
-                    continue
-                if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
-                    outdir = self.procs[idx]._output_directory()
-                    logger.info(('[node dependencies finished] '
-                                 'removing node: %s from directory %s') %
-                                (self.procs[idx]._id, outdir))
-                    shutil.rmtree(outdir)
+        if self._removable is None:
+            return
+        while self._removable:
+            idx = self._removable.popleft()
+            if self.refcount[idx] != 0:
+                continue
+            if self.proc_done[idx] and (not self.proc_pending[idx]):
+                self.refcount[idx] = -1
+                outdir = self.procs[idx]._output_directory()
+                logger.info(('[node dependencies finished] '
+                             'removing node: %s from directory %s') %
+                            (self.procs[idx]._id, outdir))
+                shutil.rmtree(outdir)
 
 
 class SGELikeBatchManagerBase(DistributedPluginBase):
     """Execute workflow with SGE/OGE/PBS like batch system
+
+    Plugins implementing `_get_pending_jobs` check the states of all the
+    pending tasks with a single scheduler query per scheduling pass instead of
+    calling `_is_pending` for every task. If that query fails, `_is_pending`
+    is called with the id of the whole array job for the tasks of array jobs,
+    which are then pending until all the tasks of their array have finished.
+
+    Plugins implementing `_submit_array_batchtask` and setting
+    `_array_index_variable` submit the nodes that become ready in the same
+    pass and have the same plugin_args as a single array job when
+    `plugin_args['array_jobs']` is True.
     """
 
+    # environment variable holding the index of an array job task
+    _array_index_variable = None
+
     def __init__(self, template, plugin_args=None):
         super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
         self._template = template
         self._qsub_args = None
+        self._array_jobs = False
         if plugin_args:
             if 'template' in plugin_args:
                 self._template = plugin_args['template']
@@ -456,22 +803,52 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
                     self._template = open(self._template).read()
             if 'qsub_args' in plugin_args:
                 self._qsub_args = plugin_args['qsub_args']
+            if 'array_jobs' in plugin_args:
+                self._array_jobs = plugin_args['array_jobs']
         self._pending = {}
+        self._pending_jobs = None
+        self._queued = []
+        # the ids of the array jobs of the submitted array tasks
+        self._array_jobids = {}
 
     def _is_pending(self, taskid):
         """Check if a task is pending in the batch system
         """
         raise NotImplementedError
 
+    def _get_pending_jobs(self):
+        """Returns the ids, as strings, of all the tasks pending in the batch
+        system or None if the tasks must be checked with `_is_pending`
+        """
+        return None
+
     def _submit_batchtask(self, scriptfile, node):
         """Submit a task to the batch system
         """
         raise NotImplementedError
 
+    def _submit_array_batchtask(self, scriptfile, nodes):
+        """Submit an array job running a task for each node to the batch
+        system and return the id of the array job, as accepted by
+        `_is_pending`, and the ids of its tasks
+        """
+        raise NotImplementedError
+
+    def _poll_pending_tasks(self, taskids):
+        self._pending_jobs = None
+        if taskids:
+            self._pending_jobs = self._get_pending_jobs()
+
+    def _task_pending(self, taskid):
+        if self._pending_jobs is not None:
+            return str(taskid) in self._pending_jobs
+        # the schedulers are queried about whole array jobs
+        return self._is_pending(self._array_jobids.get(taskid, taskid))
+
     def _get_result(self, taskid):
         if taskid not in self._pending:
-            raise Exception('Task %d not found' % taskid)
-        if self._is_pending(taskid):
+            raise Exception('Task %s not found' % taskid)
+        if self._task_pending(taskid):
             return None
         node_dir = self._pending[taskid]
         # MIT HACK
@@ -532,18 +909,79 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
         """submit job and return taskid
         """
         pyscript = create_pyscript(node, updatehash=updatehash)
+        if self._array_jobs and self._array_index_variable:
+            # submitted with the other ready nodes by _send_procs_to_workers
+            taskid = 'queued_%d' % len(self._queued)
+            self._queued.append((taskid, node, pyscript))
+            return taskid
+        return self._submit_pyscript(pyscript, node)
+
+    def _write_batchscript(self, pyscript, command):
         batch_dir, name = os.path.split(pyscript)
         name = '.'.join(name.split('.')[:-1])
-        batchscript = '\n'.join((self._template,
-                                 '%s %s' % (sys.executable, pyscript)))
+        batchscript = '\n'.join((self._template, command))
         batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
         fp = open(batchscriptfile, 'wt')
         fp.writelines(batchscript)
         fp.close()
         # Make the script executable
         os.chmod(batchscriptfile, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        return batchscriptfile
+
+    def _submit_pyscript(self, pyscript, node):
+        batchscriptfile = self._write_batchscript(
+            pyscript, '%s %s' % (sys.executable, pyscript))
         return self._submit_batchtask(batchscriptfile, node)
 
+    def _submit_array(self, pyscripts, nodes):
+        """Submits the pyscripts of nodes as an array job and returns the ids
+        of its tasks
+        """
+        batch_dir, name = os.path.split(pyscripts[0])
+        listfile = os.path.join(batch_dir, 'array_%s.txt' %
+                                '.'.join(name.split('.')[:-1]))
+        fp = open(listfile, 'wt')
+        fp.writelines([pyscript + '\n' for pyscript in pyscripts])
+        fp.close()
+        # the tasks of the array are numbered from 1
+        command = '%s $(sed -n "${%s}p" %s)' % (
+            sys.executable, self._array_index_variable, listfile)
+        batchscriptfile = self._write_batchscript(listfile, command)
+        jobid, taskids = self._submit_array_batchtask(batchscriptfile, nodes)
+        for taskid, node in zip(taskids, nodes):
+            self._pending[taskid] = node.output_dir()
+            self._array_jobids[taskid] = jobid
+        logger.debug('Submitted array job of %d tasks: %s' %
+                     (len(nodes), batchscriptfile))
+        return taskids
+
+    def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
+        super(SGELikeBatchManagerBase, self)._send_procs_to_workers(
+            updatehash=updatehash, slots=slots, graph=graph)
+        if not self._queued:
+            return
+        # nodes with the same plugin_args share the template and the
+        # submission arguments
+        groups = {}
+        keys = []
+        for queued in self._queued:
+            key = repr(sorted(queued[1].plugin_args.items()))
+            if key not in groups:
+                groups[key] = []
+                keys.append(key)
+            groups[key].append(queued)
+        self._queued = []
+        taskids = {}
+        for key in keys:
+            queuedids, nodes, pyscripts = zip(*groups[key])
+            if len(nodes) == 1:
+                newids = [self._submit_pyscript(pyscripts[0], nodes[0])]
+            else:
+                newids = self._submit_array(pyscripts, nodes)
+            taskids.update(zip(queuedids, newids))
+        self.pending_tasks = [(taskids.get(taskid, taskid), jobid)
+                              for taskid, jobid in self.pending_tasks]
+
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
             node._result = result['result']
@@ -555,31 +993,58 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
 
     def _clear_task(self, taskid):
         del self._pending[taskid]
+        self._array_jobids.pop(taskid, None)
 
 
 class GraphPluginBase(PluginBase):
     """Base class for plugins that distribute graphs to workflows
+
+    Every node is pickled with its config in a payload file, which a single
+    runner script shared by all the jobs executes (see `_get_command`). The
+    payloads are written by `plugin_args['payload_threads']` (default 4)
+    threads.
     """
 
     def __init__(self, plugin_args=None):
         if plugin_args and 'status_callback' in plugin_args:
             warn('status_callback not supported for Graph submission plugins')
         super(GraphPluginBase, self).__init__(plugin_args=plugin_args)
+        self._payload_threads = 4
+        if plugin_args and 'payload_threads' in plugin_args:
+            self._payload_threads = plugin_args['payload_threads']
 
     def run(self, graph, config, updatehash=False):
-        pyfiles = []
-        dependencies = {}
         self._config = config
         nodes = nx.topological_sort(graph)
-        logger.debug('Creating executable python files for each node')
+        index = dict((node, idx) for idx, node in enumerate(nodes))
+        dependencies = {}
         for idx, node in enumerate(nodes):
-            pyfiles.append(create_pyscript(node,
-                                           updatehash=updatehash,
-                                           store_exception=False))
-            dependencies[idx] = [nodes.index(prevnode) for prevnode in
+            dependencies[idx] = [index[prevnode] for prevnode in
                                  graph.predecessors(node)]
+        timestamp = strftime('%Y%m%d_%H%M%S')
+        batch_dirs = set(get_batch_dir(node, timestamp)[0] for node in nodes)
+        for batch_dir in batch_dirs:
+            if not os.path.exists(batch_dir):
+                os.makedirs(batch_dir)
+        self._runner = None
+        if nodes:
+            self._runner = create_runner_script(
+                get_batch_dir(nodes[0], timestamp)[0], timestamp)
+        logger.debug('Creating payload files for each node')
+        pool = ThreadPool(max(1, self._payload_threads))
+        try:
+            pyfiles = pool.map(lambda node: create_node_payload(
+                node, timestamp, updatehash=updatehash), nodes)
+        finally:
+            pool.close()
+            pool.join()
         self._submit_graph(pyfiles, dependencies, nodes)
 
+    def _get_command(self, pyfile):
+        """Returns the command running the node payload pyfile
+        """
+        return '%s %s %s' % (sys.executable, self._runner, pyfile)
+
     def _get_args(self, node, keywords):
         values = ()
         for keyword in keywords:
@@ -609,7 +1074,8 @@ class GraphPluginBase(PluginBase):
 
     def _submit_graph(self, pyfiles, dependencies, nodes):
         """
-        pyfiles: list of files corresponding to a topological sort
+        pyfiles: list of node payload files corresponding to a topological
+            sort, run with the command returned by `_get_command`
         dependencies: dictionary of dependencies based on the toplogical sort
         """
         raise NotImplementedError
@@ -31,7 +31,8 @@ class CondorDAGManPlugin(GraphPluginBase):
                  script. This is useful for wrapper script that execute certain
                  functionality prior or after a node runs. If this option is
                  given the wrapper command is called with the respective Python
-                 exectuable and the path to the node script as final arguments
+                 exectuable, the path to the runner script and the path to the
+                 node file as final arguments
     - wrapper_args : optional additional arguments to a wrapper command
     - dagman_args : arguments to be prepended to the arguments of the
                     condor_submit_dag call
@@ -122,16 +123,15 @@ getenv = True
                     # TODO make parameter for this,
                     initial_specs=initial_specs,
                     executable=sys.executable,
-                    nodescript=pyscript,
+                    nodescript='%s %s' % (self._runner, pyscript),
                     basename=os.path.join(batch_dir, name),
                     override_specs=override_specs
                     )
                 if not wrapper_cmd is None:
                     specs['executable'] = wrapper_cmd
                     specs['nodescript'] = \
-                            '%s %s %s' % (wrapper_args % specs, # give access to variables
-                                          sys.executable,
-                                          pyscript)
+                            '%s %s' % (wrapper_args % specs, # give access to variables
+                                       self._get_command(pyscript))
                 submitspec = template % specs
                 # write submit spec for this job
                 submitfile = os.path.join(batch_dir,
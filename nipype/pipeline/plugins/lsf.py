@@ -2,6 +2,7 @@
 """
 
 import os
+import subprocess
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -12,6 +13,36 @@ from time import sleep
 import re
 
 
+def parse_bjobs_output(output):
+    """Returns the ids of the unfinished jobs and array elements listed by
+    bjobs -w
+
+    Array elements are identified as ``<job id>[<index>]``. Jobs with a DONE
+    or EXIT status are left out.
+
+    >>> output = '''JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME SUBMIT_TIME
+    ... 12    user RUN  normal host1     host2     job1     Jan 1 10:00
+    ... 13    user PEND normal host1               job2[2]  Jan 1 10:00
+    ... 13    user DONE normal host1     host2     job2[1]  Jan 1 10:00
+    ... '''
+    >>> sorted(parse_bjobs_output(output))
+    ['12', '13[2]']
+    """
+    jobs = set()
+    for line in output.split('\n'):
+        items = line.split()
+        if len(items) < 3 or not items[0].isdigit():
+            continue
+        if items[2] in ['DONE', 'EXIT']:
+            continue
+        match = re.search(r'\[(\d+)\]', line)
+        if match:
+            jobs.add('%s[%s]' % (items[0], match.groups()[0]))
+        else:
+            jobs.add(items[0])
+    return jobs
+
+
 class LSFPlugin(SGELikeBatchManagerBase):
     """Execute using LSF Cluster Submission
 
@@ -21,9 +52,14 @@ class LSFPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - bsub_args : arguments to be prepended to the job execution script in the
                   bsub call
+    - array_jobs : submit the ready nodes with the same plugin_args as job
+                   arrays
 
+    The jobs are polled with a single bjobs call per scheduling pass.
     """
 
+    _array_index_variable = 'LSB_JOBINDEX'
+
     def __init__(self, **kwargs):
         template = """
 #$ -S /bin/sh
@@ -45,7 +81,7 @@ class LSFPlugin(SGELikeBatchManagerBase):
         or 'RUN'"""
         cmd = CommandLine('bjobs',
                           terminal_output='allatonce')
-        cmd.inputs.args = '%d' % taskid
+        cmd.inputs.args = '%s' % taskid
         # check lsf task
         oldlevel = iflogger.level
         iflogger.setLevel(logging.getLevelName('CRITICAL'))
@@ -53,14 +89,25 @@ class LSFPlugin(SGELikeBatchManagerBase):
         iflogger.setLevel(oldlevel)
         # logger.debug(result.runtime.stdout)
         if 'DONE' in result.runtime.stdout or 'EXIT' in result.runtime.stdout:
-            return False
+            # an array job is listed with one line per element, which may
+            # not all have finished
+            return bool(parse_bjobs_output(result.runtime.stdout))
         else:
             return True
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('bsub', environ=os.environ.data,
-                          terminal_output='allatonce')
-        path = os.path.dirname(scriptfile)
+    def _get_pending_jobs(self):
+        proc = subprocess.Popen(['bjobs', '-w'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        if 'No unfinished job found' in e:
+            return set()
+        if proc.returncode:
+            logger.debug('bjobs failed: %s' % e)
+            return None
+        return parse_bjobs_output(o)
+
+    def _get_bsubargs(self, node, logfile):
         bsubargs = ''
         if self._bsub_args:
             bsubargs = self._bsub_args
@@ -71,9 +118,12 @@ class LSFPlugin(SGELikeBatchManagerBase):
             else:
                 bsubargs += (" " + node.plugin_args['bsub_args'])
         if '-o' not in bsubargs:  # -o outfile
-            bsubargs = '%s -o %s' % (bsubargs, scriptfile + ".log")
+            bsubargs = '%s -o %s' % (bsubargs, logfile)
         if '-e' not in bsubargs:
-            bsubargs = '%s -e %s' % (bsubargs, scriptfile + ".log")  # -e error file
+            bsubargs = '%s -e %s' % (bsubargs, logfile)  # -e error file
+        return bsubargs
+
+    def _get_jobname(self, node):
         if node._hierarchy:
             jobname = '.'.join((os.environ.data['LOGNAME'],
                                 node._hierarchy,
@@ -83,10 +133,12 @@ class LSFPlugin(SGELikeBatchManagerBase):
                                 node._id))
         jobnameitems = jobname.split('.')
         jobnameitems.reverse()
-        jobname = '.'.join(jobnameitems)
-        cmd.inputs.args = '%s -J %s sh %s' % (bsubargs,
-                                              jobname,
-                                              scriptfile)  # -J job_name_spec
+        return '.'.join(jobnameitems)
+
+    def _run_bsub(self, args, node):
+        cmd = CommandLine('bsub', environ=os.environ.data,
+                          terminal_output='allatonce')
+        cmd.inputs.args = args
         logger.debug('bsub ' + cmd.inputs.args)
         oldlevel = iflogger.level
         iflogger.setLevel(logging.getLevelName('CRITICAL'))
@@ -110,10 +162,27 @@ class LSFPlugin(SGELikeBatchManagerBase):
         # retrieve lsf taskid
         match = re.search('<(\d*)>', result.runtime.stdout)
         if match:
-            taskid = int(match.groups()[0])
-        else:
-            raise ScriptError("Can't parse submission job output id: %s" %
-                              result.runtime.stdout)
+            return int(match.groups()[0])
+        raise ScriptError("Can't parse submission job output id: %s" %
+                          result.runtime.stdout)
+
+    def _submit_batchtask(self, scriptfile, node):
+        bsubargs = self._get_bsubargs(node, scriptfile + ".log")
+        taskid = self._run_bsub('%s -J %s sh %s' % (bsubargs,
+                                                    self._get_jobname(node),
+                                                    scriptfile),  # -J job_name_spec
+                                node)
         self._pending[taskid] = node.output_dir()
         logger.debug('submitted lsf task: %d for node %s' % (taskid, node._id))
         return taskid
+
+    def _submit_array_batchtask(self, scriptfile, nodes):
+        # %I is replaced by the index of the array element
+        bsubargs = self._get_bsubargs(nodes[0], scriptfile + ".%I.log")
+        jobid = self._run_bsub('%s -J "%s[1-%d]" sh %s' % (
+            bsubargs, self._get_jobname(nodes[0]), len(nodes), scriptfile),
+            nodes[0])
+        logger.debug('submitted lsf job array: %d for nodes %s' % (
+            jobid, ', '.join(node._id for node in nodes)))
+        return str(jobid), ['%d[%d]' % (jobid, task)
+                            for task in range(1, len(nodes) + 1)]
@@ -6,20 +6,114 @@ Support for child processes running as non-daemons based on
 http://stackoverflow.com/a/8963618/1183453
 """
 
+from copy import deepcopy
+from functools import partial
+import inspect
 from multiprocessing import Process, Pool, cpu_count, pool
+import os
 from traceback import format_exception
 import sys
 
-from .base import (DistributedPluginBase, report_crash)
+import numpy as np
 
-def run_node(node, updatehash):
+from .base import (DistributedPluginBase, logger, report_crash)
+from ..engine import Node
+from ..utils import merge_dict
+
+# workflow configuration shared by the tasks of a worker process
+_worker_config = None
+# attributes of a freshly constructed interface, per interface class
+_interface_defaults = {}
+
+def init_worker(config):
+    """Initializes a pool worker with the workflow configuration"""
+    global _worker_config
+    _worker_config = config
+
+def _get_interface_defaults(klass):
+    """Returns the non-input attributes of a new instance of an interface
+
+    Returns None if the interface cannot be constructed without arguments.
+    """
+    if klass not in _interface_defaults:
+        defaults = None
+        try:
+            args, varargs, _, _ = inspect.getargspec(klass.__init__)
+            if args == ['self'] and varargs is None:
+                defaults = klass().__dict__.copy()
+                del defaults['inputs']
+        except Exception:
+            pass
+        _interface_defaults[klass] = defaults
+    return _interface_defaults[klass]
+
+def create_task(node, config):
+    """Returns a lightweight task descriptor of a node
+
+    A plain node whose interface can be reconstructed from its class and
+    inputs is described by the node class, the interface class, the
+    interface inputs as a dictionary, the remaining node attributes (e.g.,
+    the output location) and the node config values that differ from the
+    workflow config. Other nodes are returned as is.
+    """
+    if type(node) is not Node:
+        return node
+    interface = node._interface
+    defaults = _get_interface_defaults(interface.__class__)
+    if defaults is None:
+        return node
+    attributes = interface.__dict__.copy()
+    del attributes['inputs']
+    try:
+        if attributes != defaults:
+            return node
+    except Exception:
+        return node
+    state = node.__dict__.copy()
+    for key in ['_interface', '_result', 'config']:
+        state.pop(key, None)
+    overrides = {}
+    for section, options in (node.config or {}).items():
+        if not isinstance(options, dict) or section not in config:
+            overrides[section] = options
+            continue
+        changed = dict([(key, value) for key, value in options.items()
+                        if config[section].get(key) != value])
+        if changed:
+            overrides[section] = changed
+    return dict(node_class=node.__class__,
+                interface_class=interface.__class__,
+                inputs=node.inputs.get_traitsfree(),
+                state=state,
+                config=overrides)
+
+def load_task(task):
+    """Rebuilds a node from a task descriptor"""
+    if not isinstance(task, dict):
+        return task
+    node = task['node_class'].__new__(task['node_class'])
+    node.__dict__.update(task['state'])
+    node._interface = task['interface_class'](**task['inputs'])
+    node._result = None
+    node.config = merge_dict(deepcopy(_worker_config or {}), task['config'])
+    return node
+
+def run_node(task, updatehash):
     result = dict(result=None, traceback=None)
+    node = None
     try:
+        node = load_task(task)
+        try:
+            if node.inputs.terminal_output == 'stream':
+                node.inputs.terminal_output = 'file'
+        except:
+            pass
         result['result'] = node.run(updatehash=updatehash)
     except:
         etype, eval, etr = sys.exc_info()
         result['traceback'] = format_exception(etype,eval,etr)
-        result['result'] = node.result
+        if node is not None:
+            result['result'] = node.result
     return result
 
 class NonDaemonProcess(Process):
@@ -38,51 +132,148 @@ class NonDaemonPool(pool.Pool):
     """
     Process = NonDaemonProcess
 
+def get_system_memory_gb():
+    """Returns the physical memory of the host in GB or inf if unknown"""
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return np.inf
+    return pages * page_size / float(1024 ** 3)
+
 class MultiProcPlugin(DistributedPluginBase):
     """Execute workflow with multiprocessing
 
     The plugin_args input to run can be used to control the multiprocessing
     execution. Currently supported options are:
 
-    - n_procs : number of processes to use
+    - n_procs : number of processes (cores) to use
+    - memory_gb : total memory (in GB) available to the jobs. Defaults to
+      the physical memory of the host.
     - non_daemon : boolean flag to execute as non-daemon processes
 
+    Ready jobs are packed against the core and memory budgets using the
+    `num_threads` and `estimated_memory_gb` attributes of the nodes, biggest
+    jobs first. A job requesting more than the budget runs alone.
+
+    Finished tasks are reported back to the scheduler by the pool callback,
+    so dependent nodes are submitted as soon as their inputs are available.
+
+    The worker processes are started once per run with the workflow config.
+    Plain nodes are then sent to them as lightweight task descriptors (see
+    `create_task`) instead of pickled copies of the nodes.
+
     """
 
+    _use_notification = True
+
     def __init__(self, plugin_args=None):
         super(MultiProcPlugin, self).__init__(plugin_args=plugin_args)
         self._taskresult = {}
+        self._finished = {}
         self._taskid = 0
+        self._running = {}
         non_daemon = True
         n_procs = cpu_count()
+        memory_gb = get_system_memory_gb()
         if plugin_args:
             if 'n_procs' in plugin_args:
                 n_procs = plugin_args['n_procs']
+            if 'memory_gb' in plugin_args:
+                memory_gb = float(plugin_args['memory_gb'])
             if 'non_daemon' in plugin_args:
                 non_daemon = plugin_args['non_daemon']
-        if non_daemon:
+        self.processors = n_procs
+        self.memory_gb = memory_gb
+        logger.debug('MultiProc resources: %d processors, %s GB memory' %
+                     (self.processors, str(self.memory_gb)))
+        self._non_daemon = non_daemon
+        self.pool = None
+
+    def run(self, graph, config, updatehash=False):
+        if self._non_daemon:
             # run the execution using the non-daemon pool subclass
-            self.pool = NonDaemonPool(processes=n_procs)
+            pool_class = NonDaemonPool
+        else:
+            pool_class = Pool
+        self.pool = pool_class(processes=self.processors,
+                               initializer=init_worker, initargs=(config,))
+        try:
+            super(MultiProcPlugin, self).run(graph, config,
+                                             updatehash=updatehash)
+        except:
+            self.pool.terminate()
+            raise
         else:
-            self.pool = Pool(processes=n_procs)
+            self.pool.close()
+        finally:
+            self.pool.join()
+
+    def _task_done(self, taskid, result):
+        """Pool callback storing the result of a finished task
+
+        The callback is run by the pool before the async result is flagged as
+        ready, hence the result is kept here for `_get_result`.
+        """
+        self._finished[taskid] = result
+        self._notify_task_done(taskid)
+
+    def _node_resources(self, node):
+        """Returns the (memory, threads) requested by a node
+
+        Requests are capped to the budgets, so that oversized jobs can still
+        run on an otherwise idle host. Mapnodes running their subnodes on a
+        pool of n_procs workers request at least n_procs threads.
+        """
+        memory = getattr(node, 'estimated_memory_gb', 1)
+        threads = max(getattr(node, 'num_threads', 1),
+                      getattr(node, 'n_procs', 1))
+        return min(memory, self.memory_gb), min(threads, self.processors)
+
+    def _free_resources(self):
+        used_memory = sum([memory for memory, _ in self._running.values()])
+        used_threads = sum([threads for _, threads in self._running.values()])
+        return self.memory_gb - used_memory, self.processors - used_threads
+
+    def _check_resources(self, node):
+        memory, threads = self._node_resources(node)
+        free_memory, free_threads = self._free_resources()
+        return memory <= free_memory and threads <= free_threads
+
+    def _sort_jobs(self, jobids):
+        """Submits the jobs requesting the most resources first
+
+        If a priority policy is selected, it takes precedence over the
+        resources.
+        """
+        jobids = sorted(jobids,
+                        key=lambda jobid: self._node_resources(self.procs[jobid]),
+                        reverse=True)
+        return super(MultiProcPlugin, self)._sort_jobs(jobids)
 
     def _get_result(self, taskid):
         if taskid not in self._taskresult:
             raise RuntimeError('Multiproc task %d not found'%taskid)
+        if taskid in self._finished:
+            return self._finished[taskid]
         if not self._taskresult[taskid].ready():
             return None
-        return self._taskresult[taskid].get()
+        try:
+            return self._taskresult[taskid].get()
+        except:
+            # the task will not be cleared, release its resources now
+            self._running.pop(taskid, None)
+            raise
 
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
-        try:
-            if node.inputs.terminal_output == 'stream':
-                node.inputs.terminal_output = 'file'
-        except:
-            pass
+        self._running[self._taskid] = self._node_resources(node)
+        callback = partial(self._task_done, self._taskid)
+        task = create_task(node, self._config)
         self._taskresult[self._taskid] = self.pool.apply_async(run_node,
-                                                               (node,
-                                                                updatehash,))
+                                                               (task,
+                                                                updatehash,),
+                                                               callback=callback)
         return self._taskid
 
     def _report_crash(self, node, result=None):
@@ -96,3 +287,5 @@ class MultiProcPlugin(DistributedPluginBase):
 
     def _clear_task(self, taskid):
         del self._taskresult[taskid]
+        self._finished.pop(taskid, None)
+        self._running.pop(taskid, None)
@@ -2,6 +2,7 @@
 """
 
 import os
+import re
 from time import sleep
 import subprocess
 
@@ -10,6 +11,33 @@ from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 from nipype.interfaces.base import CommandLine
 
 
+def parse_qstat_output(output):
+    """Returns the ids of the unfinished jobs and array subjobs listed by
+    qstat -t
+
+    Jobs are identified without their server name. Completed (C) and
+    finished (F) jobs are left out.
+
+    >>> output = '''Job id            Name             User   Time Use S Queue
+    ... ----------------  ---------------- ------ -------- - -----
+    ... 12.server         job1             user   00:00:01 R batch
+    ... 13[].server       job2             user          0 B batch
+    ... 13[1].server      job2             user   00:00:01 C batch
+    ... 13[2].server      job2             user          0 Q batch
+    ... '''
+    >>> sorted(parse_qstat_output(output))
+    ['12', '13[2]', '13[]']
+    """
+    jobs = set()
+    for line in output.split('\n'):
+        items = line.split()
+        if len(items) < 5 or not re.match(r'\d', items[0]):
+            continue
+        if items[4] not in ['C', 'F']:
+            jobs.add(items[0].split('.')[0])
+    return jobs
+
+
 class PBSPlugin(SGELikeBatchManagerBase):
     """Execute using PBS/Torque
 
@@ -20,9 +48,19 @@ class PBSPlugin(SGELikeBatchManagerBase):
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
     - max_jobname_len: maximum length of the job name.  Default 15.
+    - array_jobs : submit the ready nodes with the same plugin_args as array
+                   jobs
+    - pbs_flavour : 'torque' (default) submits array jobs with qsub -t,
+                    'pro' (PBS Professional) with qsub -J
 
+    The jobs are polled with a single qstat -t call per scheduling pass.
     """
 
+    # qsub option submitting an array job and environment variable holding
+    # the index of its tasks for each flavour of PBS
+    _array_options = {'torque': ('-t', 'PBS_ARRAYID'),
+                      'pro': ('-J', 'PBS_ARRAY_INDEX')}
+
     # Addtional class variables
     _max_jobname_len = 15
 
@@ -33,6 +71,7 @@ class PBSPlugin(SGELikeBatchManagerBase):
         self._retry_timeout = 2
         self._max_tries = 2
         self._max_jobname_length = 15
+        flavour = 'torque'
         if 'plugin_args' in kwargs and kwargs['plugin_args']:
             if 'retry_timeout' in kwargs['plugin_args']:
                 self._retry_timeout = kwargs['plugin_args']['retry_timeout']
@@ -40,6 +79,13 @@ class PBSPlugin(SGELikeBatchManagerBase):
                 self._max_tries = kwargs['plugin_args']['max_tries']
             if  'max_jobname_len' in kwargs['plugin_args']:
                 self._max_jobname_len = kwargs['plugin_args']['max_jobname_len']
+            if 'pbs_flavour' in kwargs['plugin_args']:
+                flavour = kwargs['plugin_args']['pbs_flavour']
+        if flavour not in self._array_options:
+            raise ValueError('Unknown PBS flavour %s, expected one of %s' %
+                             (flavour, ', '.join(sorted(self._array_options))))
+        self._array_option, self._array_index_variable = \
+            self._array_options[flavour]
         super(PBSPlugin, self).__init__(template, **kwargs)
 
     def _is_pending(self, taskid):
@@ -51,10 +97,17 @@ class PBSPlugin(SGELikeBatchManagerBase):
         errmsg = 'Unknown Job Id' # %s' % taskid
         return  errmsg not in e
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('qsub', environ=os.environ.data,
-                          terminal_output='allatonce')
-        path = os.path.dirname(scriptfile)
+    def _get_pending_jobs(self):
+        proc = subprocess.Popen(['qstat', '-t'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        if proc.returncode:
+            logger.debug('qstat -t failed: %s' % e)
+            return None
+        return parse_qstat_output(o)
+
+    def _get_qsubargs(self, node, path):
         qsubargs = ''
         if self._qsub_args:
             qsubargs = self._qsub_args
@@ -68,6 +121,9 @@ class PBSPlugin(SGELikeBatchManagerBase):
             qsubargs = '%s -o %s' % (qsubargs, path)
         if '-e' not in qsubargs:
             qsubargs = '%s -e %s' % (qsubargs, path)
+        return qsubargs
+
+    def _get_jobname(self, node):
         if node._hierarchy:
             jobname = '.'.join((os.environ.data['LOGNAME'],
                                 node._hierarchy,
@@ -78,11 +134,12 @@ class PBSPlugin(SGELikeBatchManagerBase):
         jobnameitems = jobname.split('.')
         jobnameitems.reverse()
         jobname = '.'.join(jobnameitems)
-        jobname = jobname[0:self._max_jobname_len]
-        cmd.inputs.args = '%s -N %s %s' % (qsubargs,
-                                           jobname,
-                                           scriptfile)
+        return jobname[0:self._max_jobname_len]
 
+    def _run_qsub(self, args, node):
+        cmd = CommandLine('qsub', environ=os.environ.data,
+                          terminal_output='allatonce')
+        cmd.inputs.args = args
         oldlevel = iflogger.level
         iflogger.setLevel(logging.getLevelName('CRITICAL'))
         tries = 0
@@ -101,9 +158,30 @@ class PBSPlugin(SGELikeBatchManagerBase):
             else:
                 break
         iflogger.setLevel(oldlevel)
+        return result.runtime.stdout
+
+    def _submit_batchtask(self, scriptfile, node):
+        path = os.path.dirname(scriptfile)
+        qsubargs = self._get_qsubargs(node, path)
+        stdout = self._run_qsub('%s -N %s %s' % (qsubargs,
+                                                 self._get_jobname(node),
+                                                 scriptfile), node)
         # retrieve pbs taskid
-        taskid = result.runtime.stdout.split('.')[0]
+        taskid = stdout.split('.')[0]
         self._pending[taskid] = node.output_dir()
         logger.debug('submitted pbs task: %s for node %s' % (taskid, node._id))
 
         return taskid
+
+    def _submit_array_batchtask(self, scriptfile, nodes):
+        path = os.path.dirname(scriptfile)
+        qsubargs = self._get_qsubargs(nodes[0], path)
+        stdout = self._run_qsub('%s %s 1-%d -N %s %s' % (
+            qsubargs, self._array_option, len(nodes),
+            self._get_jobname(nodes[0]), scriptfile), nodes[0])
+        # the array job id has the form 12[].server
+        jobid = stdout.split('[')[0].strip()
+        logger.debug('submitted pbs array job: %s for nodes %s' % (
+            jobid, ', '.join(node._id for node in nodes)))
+        return '%s[]' % jobid, ['%s[%d]' % (jobid, task)
+                                for task in range(1, len(nodes) + 1)]
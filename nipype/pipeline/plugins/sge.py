@@ -5,6 +5,7 @@ import os
 import re
 import subprocess
 from time import sleep
+from xml.etree import ElementTree
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -25,6 +26,36 @@ def qsubSanitizeJobName(testjobname):
     else:
         return 'J'+testjobname
 
+def parse_qstat_xml(xml):
+    """Returns the ids of the jobs and array tasks listed by qstat -xml
+
+    Array tasks are identified as ``<job id>.<task id>``.
+
+    >>> xml = ('<job_info><queue_info><job_list state="running">'
+    ...        '<JB_job_number>12</JB_job_number><tasks>3</tasks></job_list>'
+    ...        '</queue_info><job_info><job_list state="pending">'
+    ...        '<JB_job_number>13</JB_job_number></job_list>'
+    ...        '<job_list state="pending"><JB_job_number>12</JB_job_number>'
+    ...        '<tasks>4-8:2,10</tasks></job_list></job_info></job_info>')
+    >>> sorted(parse_qstat_xml(xml))
+    ['12', '12.10', '12.3', '12.4', '12.6', '12.8', '13']
+    """
+    jobs = set()
+    for job in ElementTree.fromstring(xml).getiterator('job_list'):
+        jobid = job.findtext('JB_job_number').strip()
+        jobs.add(jobid)
+        tasks = job.findtext('tasks')
+        if not tasks:
+            continue
+        for taskrange in tasks.strip().split(','):
+            match = re.match(r'(\d+)(?:-(\d+)(?::(\d+))?)?$', taskrange)
+            first, last, step = match.groups()
+            for task in range(int(first), int(last or first) + 1,
+                              int(step or 1)):
+                jobs.add('%s.%d' % (jobid, task))
+    return jobs
+
+
 class SGEPlugin(SGELikeBatchManagerBase):
     """Execute using SGE (OGE not tested)
 
@@ -34,9 +65,14 @@ class SGEPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - array_jobs : submit the ready nodes with the same plugin_args as array
+                   jobs (qsub -t)
 
+    The jobs are polled with a single qstat -xml call per scheduling pass.
     """
 
+    _array_index_variable = 'SGE_TASK_ID'
+
     def __init__(self, **kwargs):
         template = """
 #$ -V
@@ -59,10 +95,21 @@ class SGEPlugin(SGELikeBatchManagerBase):
         o, _ = proc.communicate()
         return o.startswith('=')
 
-    def _submit_batchtask(self, scriptfile, node):
-        cmd = CommandLine('qsub', environ=os.environ.data,
-                          terminal_output='allatonce')
-        path = os.path.dirname(scriptfile)
+    def _get_pending_jobs(self):
+        proc = subprocess.Popen(['qstat', '-xml'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        if proc.returncode:
+            logger.debug('qstat -xml failed: %s' % e)
+            return None
+        try:
+            return parse_qstat_xml(o)
+        except Exception, e:
+            logger.debug('Could not parse the output of qstat -xml: %s' % e)
+            return None
+
+    def _get_qsubargs(self, node, path):
         qsubargs = ''
         if self._qsub_args:
             qsubargs = self._qsub_args
@@ -76,6 +123,9 @@ class SGEPlugin(SGELikeBatchManagerBase):
             qsubargs = '%s -o %s' % (qsubargs, path)
         if '-e' not in qsubargs:
             qsubargs = '%s -e %s' % (qsubargs, path)
+        return qsubargs
+
+    def _get_jobname(self, node):
         if node._hierarchy:
             jobname = '.'.join((os.environ.data['LOGNAME'],
                                 node._hierarchy,
@@ -86,10 +136,12 @@ class SGEPlugin(SGELikeBatchManagerBase):
         jobnameitems = jobname.split('.')
         jobnameitems.reverse()
         jobname = '.'.join(jobnameitems)
-        jobname = qsubSanitizeJobName(jobname)
-        cmd.inputs.args = '%s -N %s %s' % (qsubargs,
-                                           jobname,
-                                           scriptfile)
+        return qsubSanitizeJobName(jobname)
+
+    def _run_qsub(self, args, node):
+        cmd = CommandLine('qsub', environ=os.environ.data,
+                          terminal_output='allatonce')
+        cmd.inputs.args = args
         oldlevel = iflogger.level
         iflogger.setLevel(logging.getLevelName('CRITICAL'))
         tries = 0
@@ -108,11 +160,31 @@ class SGEPlugin(SGELikeBatchManagerBase):
             else:
                 break
         iflogger.setLevel(oldlevel)
+        return [line for line in result.runtime.stdout.split('\n') if line]
+
+    def _submit_batchtask(self, scriptfile, node):
+        path = os.path.dirname(scriptfile)
+        qsubargs = self._get_qsubargs(node, path)
+        lines = self._run_qsub('%s -N %s %s' % (qsubargs,
+                                                self._get_jobname(node),
+                                                scriptfile), node)
         # retrieve sge taskid
-        lines = [line for line in result.runtime.stdout.split('\n') if line]
         taskid = int(re.match("Your job ([0-9]*) .* has been submitted",
                               lines[-1]).groups()[0])
         self._pending[taskid] = node.output_dir()
         logger.debug('Submitted the SGE task: %d for node %s with qsub'
                      ' arguments %s' % (taskid, node._id, qsubargs))
         return taskid
+
+    def _submit_array_batchtask(self, scriptfile, nodes):
+        path = os.path.dirname(scriptfile)
+        qsubargs = self._get_qsubargs(nodes[0], path)
+        lines = self._run_qsub('%s -t 1-%d -N %s %s' % (
+            qsubargs, len(nodes), self._get_jobname(nodes[0]), scriptfile),
+            nodes[0])
+        jobid = re.match("Your job-array ([0-9]*)\.", lines[-1]).groups()[0]
+        logger.debug('Submitted the SGE array job: %s for nodes %s with qsub'
+                     ' arguments %s' % (jobid, ', '.join(node._id for node in
+                                                         nodes), qsubargs))
+        return jobid, ['%s.%d' % (jobid, task)
+                       for task in range(1, len(nodes) + 1)]
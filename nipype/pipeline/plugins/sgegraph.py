@@ -2,7 +2,6 @@
 """
 
 import os
-import sys
 
 from .base import (GraphPluginBase, logger)
 
@@ -51,7 +50,7 @@ class SGEGraphPlugin(GraphPluginBase):
                 batch_dir, name = os.path.split(pyscript)
                 name = '.'.join(name.split('.')[:-1])
                 batchscript = '\n'.join((template,
-                                         '%s %s' % (sys.executable, pyscript)))
+                                         self._get_command(pyscript)))
                 batchscriptfile = os.path.join(batch_dir,
                                                'batchscript_%s.sh' % name)
 
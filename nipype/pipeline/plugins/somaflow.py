@@ -28,8 +28,7 @@ class SomaFlowPlugin(GraphPluginBase):
         soma_deps = []
         for idx, fname in enumerate(pyfiles):
             name = os.path.splitext(os.path.split(fname)[1])[0]
-            jobs.append(Job(command=[sys.executable,
-                                     fname],
+            jobs.append(Job(command=[sys.executable, self._runner, fname],
                             name=name))
         for key, values in dependencies.items():
             for val in values:
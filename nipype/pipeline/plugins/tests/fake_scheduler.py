@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Stand-in for the qsub and qstat commands of SGE in tests
+
+Usage: fake_scheduler.py <qsub|qstat> [arguments]
+
+The jobs are stored in the directory given by the FAKE_SCHEDULER_DIR
+environment variable, which also receives a ``calls.log`` file with one line
+per command. ``qsub [-t 1-N] ... script`` queues a job or an array job and
+prints the SGE submission message. Every ``qstat`` call first runs the
+oldest queued task with ``sh`` (setting SGE_TASK_ID for array tasks), then
+``qstat -xml`` lists the remaining tasks and ``qstat -j <job id>`` prints a
+line starting with ``=`` if any task of the job is queued. ``qstat -xml``
+fails if the FAKE_SCHEDULER_FAIL_XML environment variable is set, and
+``qstat -j`` fails for ids that are not job ids. The output of the jobs is
+appended to ``jobs.log``.
+"""
+import os
+import re
+import subprocess
+import sys
+import cPickle
+
+
+def state_file():
+    return os.path.join(os.environ['FAKE_SCHEDULER_DIR'], 'jobs.pkl')
+
+
+def load_jobs():
+    if not os.path.exists(state_file()):
+        return 1, []
+    return cPickle.load(open(state_file(), 'rb'))
+
+
+def save_jobs(nextid, jobs):
+    cPickle.dump((nextid, jobs), open(state_file(), 'wb'))
+
+
+def qsub(args):
+    nextid, jobs = load_jobs()
+    script = args[-1]
+    name = args[args.index('-N') + 1] if '-N' in args else 'job'
+    tasks = [None]
+    if '-t' in args:
+        first, last = re.match(r'(\d+)-(\d+)$',
+                               args[args.index('-t') + 1]).groups()
+        tasks = range(int(first), int(last) + 1)
+    jobs.extend([(nextid, task, script) for task in tasks])
+    if tasks == [None]:
+        print 'Your job %d ("%s") has been submitted' % (nextid, name)
+    else:
+        print 'Your job-array %d.%d-%d:1 ("%s") has been submitted' % (
+            nextid, tasks[0], tasks[-1], name)
+    save_jobs(nextid + 1, jobs)
+
+
+def run_task(jobs):
+    jobid, task, script = jobs.pop(0)
+    env = dict(os.environ)
+    if task is not None:
+        env['SGE_TASK_ID'] = str(task)
+    # the output of the jobs goes to a log file, as with the -o option
+    log = open(os.path.join(os.environ['FAKE_SCHEDULER_DIR'], 'jobs.log'),
+               'at')
+    subprocess.call(['sh', script], env=env, stdout=log,
+                    stderr=subprocess.STDOUT)
+    log.close()
+
+
+def qstat(args):
+    nextid, jobs = load_jobs()
+    if jobs:
+        run_task(jobs)
+        save_jobs(nextid, jobs)
+    if '-xml' in args:
+        if os.environ.get('FAKE_SCHEDULER_FAIL_XML'):
+            sys.stderr.write('qstat: XML output is not available\n')
+            sys.exit(1)
+        print '<?xml version="1.0"?>\n<job_info><queue_info>'
+        for jobid, task, _ in jobs:
+            print '<job_list state="running">'
+            print '<JB_job_number>%d</JB_job_number>' % jobid
+            if task is not None:
+                print '<tasks>%d</tasks>' % task
+            print '</job_list>'
+        print '</queue_info><job_info></job_info></job_info>'
+    elif '-j' in args:
+        jobid = args[args.index('-j') + 1]
+        if not jobid.isdigit():
+            sys.stderr.write('qstat: invalid job id %s\n' % jobid)
+            sys.exit(1)
+        jobid = int(jobid)
+        if jobid in [job[0] for job in jobs]:
+            print '=' * 62
+
+
+def main():
+    command, args = sys.argv[1], sys.argv[2:]
+    log = open(os.path.join(os.environ['FAKE_SCHEDULER_DIR'], 'calls.log'),
+               'at')
+    log.write(' '.join([command] + args) + '\n')
+    log.close()
+    {'qsub': qsub, 'qstat': qstat}[command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Tests for the engine module
 """
+from time import time
+
+import networkx as nx
 import numpy as np
 import scipy.sparse as ssp
 
@@ -9,12 +12,253 @@ from nipype.testing import (assert_raises, assert_equal, assert_true,
                             assert_false, skipif)
 import nipype.pipeline.plugins.base as pb
 
+class FakeInterface(object):
+    always_run = False
+
+class FakeNode(object):
+    def __init__(self, name, config):
+        self._id = name
+        self.config = config
+        self.overwrite = None
+        self.run_without_submitting = False
+        self._interface = FakeInterface()
+
+class InstantPlugin(pb.DistributedPluginBase):
+    """Records the submitted nodes and finishes them immediately"""
+    _use_notification = True
+
+    def __init__(self, plugin_args=None):
+        super(InstantPlugin, self).__init__(plugin_args=plugin_args)
+        self.submitted = []
+        self.max_pending = 0
+
+    def _submit_job(self, node, updatehash=False):
+        self.submitted.append(node._id)
+        self.max_pending = max(self.max_pending, len(self.pending_tasks) + 1)
+        self._notify_task_done(len(self.submitted))
+        return len(self.submitted)
+
+    def _get_result(self, taskid):
+        return dict(result=None, traceback=None)
+
+    def _clear_task(self, taskid):
+        pass
+
+def fake_graph():
+    config = dict(execution=dict(local_hash_check='false',
+                                 remove_node_directories='false',
+                                 stop_on_first_crash='false'))
+    nodes = dict((name, FakeNode(name, config)) for name in 'abcde')
+    graph = nx.DiGraph()
+    graph.add_edges_from([(nodes['a'], nodes['b']), (nodes['a'], nodes['c']),
+                          (nodes['b'], nodes['d']), (nodes['c'], nodes['d']),
+                          (nodes['e'], nodes['d'])])
+    return graph, config
+
 def test_scipy_sparse():
     foo = ssp.lil_matrix(np.eye(3, k=1))
     goo = foo.getrowview(0)
     goo[goo.nonzero()] = 0
     yield assert_equal, foo[0,1], 0
 
+def test_wait_for_tasks():
+    plugin = pb.DistributedPluginBase(plugin_args=dict(poll_interval=0.1))
+    t0 = time()
+    plugin._wait_for_tasks()
+    yield assert_true, time() - t0 >= 0.1
+    # notified plugins wake up as soon as a task finishes
+    plugin = pb.DistributedPluginBase(plugin_args=dict(poll_interval=60))
+    plugin._use_notification = True
+    plugin._notify_task_done(1)
+    plugin._notify_task_done(2)
+    t0 = time()
+    plugin._wait_for_tasks()
+    yield assert_true, time() - t0 < 10
+    yield assert_true, plugin._done_queue.empty()
+
+def test_dependency_order():
+    graph, config = fake_graph()
+    plugin = InstantPlugin(plugin_args=dict(max_jobs=1, poll_interval=0))
+    plugin.run(graph, config)
+    order = plugin.submitted
+    yield assert_equal, sorted(order), list('abcde')
+    yield assert_true, order.index('a') < order.index('b')
+    yield assert_true, order.index('a') < order.index('c')
+    yield assert_equal, order[-1], 'd'
+    yield assert_equal, plugin.max_pending, 1
+    yield assert_equal, plugin.depcount, [0] * 5
+    yield assert_true, all(plugin.proc_done)
+    yield assert_false, any(plugin.proc_pending)
+
+def test_critical_path_priority():
+    config = dict(execution=dict(local_hash_check='false',
+                                 remove_node_directories='false',
+                                 stop_on_first_crash='false'))
+    nodes = dict((name, FakeNode(name, config)) for name in 'abcdef')
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes.values())
+    graph.add_edges_from([(nodes['a'], nodes['b']), (nodes['b'], nodes['c']),
+                          (nodes['d'], nodes['e'])])
+    runtimes = dict(a=1, b=100, c=10, d=50, e=1, f=80)
+
+    class PriorityPlugin(InstantPlugin):
+        def _get_runtime(self, node):
+            return runtimes[node._id]
+
+    plugin = PriorityPlugin(plugin_args=dict(max_jobs=1, poll_interval=0,
+                                             priority='critical_path'))
+    plugin.run(graph, config)
+    priority = dict((node._id, plugin.priority[idx])
+                    for idx, node in enumerate(plugin.procs))
+    yield assert_equal, priority, dict(a=111, b=110, c=10, d=51, e=1, f=80)
+    yield assert_equal, plugin.submitted, list('abfdce')
+    yield (assert_raises, ValueError, InstantPlugin,
+           dict(priority='shortest_first'))
+
+def test_remove_node_directories():
+    import os
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    temp_dir = mkdtemp(prefix='test_refcount_')
+    graph, config = fake_graph()
+    config['execution']['remove_node_directories'] = 'true'
+    plugin = InstantPlugin(plugin_args=dict(max_jobs=1, poll_interval=0))
+    removed = []
+    for node in graph.nodes():
+        outdir = os.path.join(temp_dir, node._id)
+        os.mkdir(outdir)
+        def output_directory(node=node, outdir=outdir):
+            # record whether all the nodes using the outputs have run
+            removed.append((node._id, all(succ._id in plugin.submitted for
+                                          succ in graph.successors(node))))
+            return outdir
+        node._output_directory = output_directory
+    plugin.run(graph, config)
+    yield assert_equal, sorted(removed), [(name, True) for name in 'abcde']
+    yield assert_equal, os.listdir(temp_dir), []
+    yield assert_equal, removed[-1][0], 'd'
+    yield assert_equal, plugin.refcount, [-1] * 5
+    rmtree(temp_dir)
+
+def test_subnode_window():
+    import os
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import IdentityInterface
+    temp_dir = mkdtemp(prefix='test_window_')
+    mapnode = pe.MapNode(IdentityInterface(fields=['a']), iterfield=['a'],
+                         name='m', base_dir=temp_dir)
+    mapnode.inputs.a = range(10)
+    mapnode.config = pe.config._sections
+    graph = nx.DiGraph()
+    graph.add_node(mapnode)
+    config = dict(execution=dict(remove_node_directories='false',
+                                 stop_on_first_crash='false'))
+
+    class WindowPlugin(InstantPlugin):
+        def _add_subnodes(self, jobid, count):
+            super(WindowPlugin, self)._add_subnodes(jobid, count)
+            self.max_pending = max(self.max_pending,
+                                   len([node for node in self.procs[1:]
+                                        if node is not None]))
+
+    plugin = WindowPlugin(plugin_args=dict(subnode_window=3,
+                                           poll_interval=0))
+    plugin.run(graph, config)
+    yield assert_equal, plugin.submitted, ['_m%d' % i for i in range(10)] + \
+        ['m']
+    # finished subnodes are released as the next ones are created
+    yield assert_equal, plugin.max_pending, 3
+    yield assert_equal, plugin.procs[1:], [None] * 10
+    yield assert_equal, plugin._subnodes, {}
+    rmtree(temp_dir)
+
+def test_previous_runtime():
+    import os
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import IdentityInterface
+    temp_dir = mkdtemp(prefix='test_runtime_')
+    node = pe.Node(IdentityInterface(fields=['a']), name='ident',
+                   base_dir=temp_dir)
+    node.inputs.a = 1
+    yield assert_equal, pb.get_previous_runtime(node), None
+    node.run()
+    yield assert_true, pb.get_previous_runtime(node) >= 0
+    rmtree(temp_dir)
+
+def add(a, b):
+    return a + b
+
+try:
+    import matplotlib
+    no_matplotlib = False
+except ImportError:
+    no_matplotlib = True
+
+# the runner script sets the matplotlib backend
+@skipif(no_matplotlib)
+def test_graph_plugin_payloads():
+    import os
+    import subprocess
+    from glob import glob
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    import nipype
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import Function
+    temp_dir = mkdtemp(prefix='test_graph_')
+
+    class LocalGraphPlugin(pb.GraphPluginBase):
+        """Runs the jobs in topological order in subprocesses"""
+        def _submit_graph(self, pyfiles, dependencies, nodes):
+            self.dependencies = dependencies
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(os.path.dirname(nipype.__file__)),
+                 env.get('PYTHONPATH', '')])
+            for pyfile in pyfiles:
+                subprocess.check_call(self._get_command(pyfile), shell=True,
+                                      env=env)
+
+    wf = pe.Workflow(name='graph', base_dir=temp_dir)
+    nodes = [pe.Node(Function(input_names=['a', 'b'], output_names=['out'],
+                              function=add), name=name)
+             for name in 'abcd']
+    nodes[0].inputs.a = 1
+    nodes[0].inputs.b = 2
+    nodes[1].inputs.b = 1
+    nodes[2].inputs.b = 2
+    wf.connect([(nodes[0], nodes[1], [('out', 'a')]),
+                (nodes[0], nodes[2], [('out', 'a')]),
+                (nodes[1], nodes[3], [('out', 'a')]),
+                (nodes[2], nodes[3], [('out', 'b')])])
+    wf.config['execution'] = {'create_report': 'false'}
+    plugin = LocalGraphPlugin(plugin_args=dict(payload_threads=2))
+    execgraph = wf.run(plugin=plugin)
+    last = [node for node in execgraph.nodes() if node.name == 'd'][0]
+    yield assert_equal, last.result.outputs.out, 9
+    deps = sorted(len(values) for values in plugin.dependencies.values())
+    yield assert_equal, deps, [0, 1, 1, 2]
+    # a single runner script and a payload per node
+    batch_dir = os.path.join(temp_dir, 'graph', 'batch')
+    yield assert_equal, len(glob(os.path.join(batch_dir, 'pyscript_*'))), 1
+    yield assert_equal, len(glob(os.path.join(batch_dir, 'node_*.pkl'))), 4
+    rmtree(temp_dir)
+
+
+def test_graph_plugin_empty_graph():
+    submitted = []
+
+    class RecordGraphPlugin(pb.GraphPluginBase):
+        def _submit_graph(self, pyfiles, dependencies, nodes):
+            submitted.append((pyfiles, dependencies, nodes))
+
+    RecordGraphPlugin().run(nx.DiGraph(), config={})
+    yield assert_equal, submitted, [([], {}, [])]
+
 '''
 Can use the following code to test that a mapnode crash continues successfully
 Need to put this into a nose-test with a timeout
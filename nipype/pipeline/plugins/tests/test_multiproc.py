@@ -3,7 +3,7 @@ import nipype.interfaces.base as nib
 from tempfile import mkdtemp
 from shutil import rmtree
 
-from nipype.testing import assert_equal
+from nipype.testing import assert_equal, assert_true
 import nipype.pipeline.engine as pe
 
 class InputSpec(nib.TraitedSpec):
@@ -45,4 +45,122 @@ def test_run_multiproc():
     result = node.get_output('output1')
     yield assert_equal, result, [1, 1]
     os.chdir(cur_dir)
-    rmtree(temp_dir)
\ No newline at end of file
+    rmtree(temp_dir)
+
+
+def test_resource_packing():
+    from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+    plugin = MultiProcPlugin(plugin_args=dict(n_procs=4, memory_gb=8))
+    small = pe.Node(interface=TestInterface(), name='small')
+    big = pe.Node(interface=TestInterface(), name='big',
+                  estimated_memory_gb=6, num_threads=2)
+    huge = pe.Node(interface=TestInterface(), name='huge',
+                   estimated_memory_gb=64, num_threads=32)
+    plugin.procs = [small, big, huge]
+    yield assert_equal, plugin._sort_jobs([0, 1, 2]), [2, 1, 0]
+    # oversized requests are capped to the budgets
+    yield assert_equal, plugin._node_resources(huge), (8, 4)
+    yield assert_equal, plugin._check_resources(huge), True
+    plugin._running[1] = plugin._node_resources(big)
+    yield assert_equal, plugin._check_resources(small), True
+    yield assert_equal, plugin._check_resources(big), False
+    yield assert_equal, plugin._check_resources(huge), False
+    plugin._running[2] = plugin._node_resources(small)
+    plugin._running[3] = plugin._node_resources(small)
+    yield assert_equal, plugin._check_resources(small), False
+    # mapnodes with a pool of workers request a thread per worker
+    pool = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='pool', n_procs=3)
+    yield assert_equal, plugin._node_resources(pool), (1, 3)
+
+
+def test_run_multiproc_resources():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(), name='mod1',
+                   estimated_memory_gb=2, num_threads=2)
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2', estimated_memory_gb=1.5)
+    pipe.connect([(mod1, mod2, [('output1', 'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    execgraph = pipe.run(plugin="MultiProc",
+                         plugin_args=dict(n_procs=2, memory_gb=2))
+    names = ['.'.join((node._hierarchy, node.name))
+             for node in execgraph.nodes()]
+    node = execgraph.nodes()[names.index('pipe.mod2')]
+    result = node.get_output('output1')
+    yield assert_equal, result, [[1, 1], [1, 1]]
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+
+def test_task_descriptor():
+    from nipype.pipeline.plugins import multiproc as mp
+    from nipype.interfaces.utility import IdentityInterface
+    config = dict(execution=dict(hash_method='timestamp',
+                                 stop_on_first_crash='false'))
+    node = pe.Node(interface=TestInterface(), name='mod1')
+    node.inputs.input1 = 3
+    node.config = dict(execution=dict(hash_method='content',
+                                      stop_on_first_crash='false'))
+    task = mp.create_task(node, config)
+    yield assert_equal, type(task), dict
+    yield assert_equal, task['inputs'], dict(input1=3)
+    yield assert_equal, task['config'], dict(execution=dict(
+        hash_method='content'))
+    mp.init_worker(config)
+    newnode = mp.load_task(task)
+    yield assert_equal, newnode.name, 'mod1'
+    yield assert_equal, newnode.inputs.input1, 3
+    yield assert_equal, newnode.config['execution'],  node.config['execution']
+    # nodes whose interface needs constructor arguments are sent as is
+    node = pe.Node(interface=IdentityInterface(fields=['a']), name='ident')
+    yield assert_equal, mp.create_task(node, config), node
+    node = pe.MapNode(interface=TestInterface(), iterfield=['input1'],
+                      name='mod2')
+    yield assert_equal, mp.create_task(node, config), node
+
+
+def _last(values):
+    return values[-1]
+
+
+def test_hash_index():
+    from nipype.pipeline.utils import HashIndex
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(), name='mod1')
+    mod2 = pe.Node(interface=TestInterface(), name='mod2')
+    pipe.connect([(mod1, mod2, [(('output1', _last), 'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    mod2.inputs.input2 = 2
+    pipe.run(plugin="MultiProc")
+    index_file = os.path.join(temp_dir, 'pipe', '_hashindex.json')
+    yield assert_true, os.path.exists(index_file)
+    index = HashIndex(index_file)
+    yield assert_equal, len(index), 2
+    outdir = os.path.join(temp_dir, 'pipe', 'mod1')
+    hashvalue, resultsfile = index.get(outdir)
+    yield assert_equal, resultsfile, os.path.join(outdir, 'result_mod1.pklz')
+    yield assert_true, index.check(outdir, hashvalue)
+    yield assert_equal, index.check(outdir, 'otherhash'), False
+    # a rerun confirms the hashes through the index
+    execgraph = pipe.run(plugin="MultiProc")
+    node = [node for node in execgraph.nodes() if node.name == 'mod1'][0]
+    hash_exists, _, _, _ = node.hash_exists(hash_index=index)
+    yield assert_true, hash_exists
+    # stale entries are dropped
+    os.remove(os.path.join(outdir, '_0x%s.json' % hashvalue))
+    yield assert_equal, index.check(outdir, hashvalue), False
+    yield assert_equal, index.get(outdir), None
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
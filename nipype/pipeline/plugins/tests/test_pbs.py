@@ -4,7 +4,7 @@ from tempfile import mkdtemp
 from time import sleep
 
 import nipype.interfaces.base as nib
-from nipype.testing import assert_equal, skipif
+from nipype.testing import assert_equal, assert_raises, skipif
 import nipype.pipeline.engine as pe
 
 class InputSpec(nib.TraitedSpec):
@@ -47,4 +47,28 @@ def test_run_pbsgraph():
     result = node.get_output('output1')
     yield assert_equal, result, [1, 1]
     os.chdir(cur_dir)
-    rmtree(temp_dir)
\ No newline at end of file
+    rmtree(temp_dir)
+
+
+def test_pbs_array_flavours():
+    from nipype.pipeline.plugins.pbs import PBSPlugin
+    os.environ.setdefault('LOGNAME', 'nipype')
+    node = pe.Node(interface=TestInterface(), name='mod1')
+    for flavour, option, variable in [('torque', '-t', 'PBS_ARRAYID'),
+                                      ('pro', '-J', 'PBS_ARRAY_INDEX')]:
+        plugin = PBSPlugin(plugin_args=dict(pbs_flavour=flavour))
+        calls = []
+
+        def run_qsub(args, node):
+            calls.append(args.split())
+            return '12[].server\n'
+        plugin._run_qsub = run_qsub
+        jobid, taskids = plugin._submit_array_batchtask(
+            '/tmp/batch/batch.sh', [node, node])
+        yield assert_equal, jobid, '12[]'
+        yield assert_equal, taskids, ['12[1]', '12[2]']
+        yield assert_equal, calls[0][calls[0].index(option) + 1], '1-2'
+        yield assert_equal, plugin._array_index_variable, variable
+    yield assert_equal, PBSPlugin()._array_index_variable, 'PBS_ARRAYID'
+    yield assert_raises, ValueError, lambda: PBSPlugin(
+        plugin_args=dict(pbs_flavour='lsf'))
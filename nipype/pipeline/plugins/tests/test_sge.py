@@ -0,0 +1,122 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+import stat
+import sys
+from tempfile import mkdtemp
+
+import nipype
+from nipype.testing import assert_equal, assert_true, skipif
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+from nipype.pipeline.plugins.sge import parse_qstat_xml
+
+try:
+    import matplotlib
+    no_matplotlib = False
+except ImportError:
+    no_matplotlib = True
+
+
+def add(a, b):
+    return a + b
+
+
+def test_parse_qstat_xml():
+    xml = ('<job_info><queue_info><job_list state="running">'
+           '<JB_job_number>7</JB_job_number></job_list></queue_info>'
+           '<job_info><job_list state="pending">'
+           '<JB_job_number>8</JB_job_number><tasks>1-3:1</tasks>'
+           '</job_list></job_info></job_info>')
+    yield assert_equal, sorted(parse_qstat_xml(xml)), ['7', '8', '8.1',
+                                                        '8.2', '8.3']
+    yield assert_equal, parse_qstat_xml('<job_info></job_info>'), set()
+
+
+def run_fake_sge(plugin_args, fail_xml=False):
+    """Runs a workflow of a node feeding three nodes with the fake scheduler
+    and returns the outputs of the three nodes and the scheduler calls
+
+    With fail_xml, the qstat -xml calls polling all the jobs fail.
+    """
+    temp_dir = mkdtemp(prefix='test_sge_')
+    bin_dir = os.path.join(temp_dir, 'bin')
+    os.makedirs(bin_dir)
+    fake_scheduler = os.path.join(os.path.dirname(__file__),
+                                  'fake_scheduler.py')
+    for command in ['qsub', 'qstat']:
+        script = os.path.join(bin_dir, command)
+        fp = open(script, 'wt')
+        fp.write('#!/bin/sh\nexec %s %s %s "$@"\n' % (
+            sys.executable, fake_scheduler, command))
+        fp.close()
+        os.chmod(script, stat.S_IRWXU)
+    environ = dict(os.environ)
+    os.environ['PATH'] = os.pathsep.join([bin_dir, environ['PATH']])
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__)),
+         environ.get('PYTHONPATH', '')])
+    os.environ['FAKE_SCHEDULER_DIR'] = temp_dir
+    os.environ.setdefault('LOGNAME', 'nipype')
+    if fail_xml:
+        os.environ['FAKE_SCHEDULER_FAIL_XML'] = '1'
+    try:
+        wf = pe.Workflow(name='sge', base_dir=temp_dir)
+        first = pe.Node(Function(input_names=['a', 'b'],
+                                 output_names=['out'], function=add),
+                        name='first')
+        first.inputs.a = 1
+        first.inputs.b = 1
+        for b in range(3):
+            node = pe.Node(Function(input_names=['a', 'b'],
+                                    output_names=['out'], function=add),
+                           name='add%d' % b)
+            node.inputs.b = b
+            wf.connect(first, 'out', node, 'a')
+        wf.config['execution'] = {'create_report': 'false',
+                                  'local_hash_check': 'false'}
+        execgraph = wf.run(plugin='SGE', plugin_args=plugin_args)
+        outputs = sorted(node.result.outputs.out
+                         for node in execgraph.nodes()
+                         if node.name.startswith('add'))
+        calls = [line.split() for line in
+                 open(os.path.join(temp_dir, 'calls.log'))]
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        rmtree(temp_dir)
+    return outputs, calls
+
+
+# the job scripts set the matplotlib backend
+@skipif(no_matplotlib)
+def test_sge_array_jobs():
+    plugin_args = dict(array_jobs=True, poll_interval=0)
+    outputs, calls = run_fake_sge(plugin_args)
+    yield assert_equal, outputs, [2, 3, 4]
+    # the three ready nodes are submitted as a single array job
+    qsub_calls = [call for call in calls if call[0] == 'qsub']
+    yield assert_equal, len(qsub_calls), 2
+    yield assert_equal, ['-t' in call for call in qsub_calls], [False, True]
+    # the jobs are polled with one qstat call per pass
+    yield assert_equal, set(call[1] for call in calls
+                            if call[0] == 'qstat'), set(['-xml'])
+
+
+@skipif(no_matplotlib)
+def test_sge_array_jobs_without_xml():
+    plugin_args = dict(array_jobs=True, poll_interval=0)
+    outputs, calls = run_fake_sge(plugin_args, fail_xml=True)
+    yield assert_equal, outputs, [2, 3, 4]
+    # the array tasks are checked with the id of their array job
+    jobids = [call[2] for call in calls if call[:2] == ['qstat', '-j']]
+    yield assert_true, len(jobids) > 0
+    yield assert_true, all(jobid.isdigit() for jobid in jobids)
+
+
+@skipif(no_matplotlib)
+def test_sge_single_jobs():
+    outputs, calls = run_fake_sge(dict(poll_interval=0))
+    yield assert_equal, outputs, [2, 3, 4]
+    yield assert_equal, len([call for call in calls if call[0] == 'qsub']), 4
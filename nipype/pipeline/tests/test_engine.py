@@ -11,7 +11,7 @@ from tempfile import mkdtemp
 import networkx as nx
 
 from nipype.testing import (assert_raises, assert_equal, assert_true,
-                            assert_false)
+                            assert_false, assert_not_equal)
 import nipype.interfaces.base as nib
 import nipype.pipeline.engine as pe
 from nipype import logging
@@ -213,6 +213,136 @@ def test_iterable_expansion():
     wf3._flatgraph = wf3._create_flat_graph()
     yield assert_equal, len(pe.generate_expanded_graph(wf3._flatgraph).nodes()),12
 
+def test_iterable_expansion_shares_interfaces():
+    wf1 = pe.Workflow(name='test')
+    node1 = pe.Node(TestInterface(), name='node1')
+    node2 = pe.Node(TestInterface(), name='node2')
+    node1.iterables = ('input1', [1, 2, 3])
+    node2.inputs.input1 = 5
+    wf1.connect(node1, 'output1', node2, 'input2')
+    wf1._flatgraph = wf1._create_flat_graph()
+    execgraph = pe.generate_expanded_graph(wf1._flatgraph)
+    nodes1 = sorted([node for node in execgraph.nodes()
+                     if node.name == 'node1'], key=lambda node: node._id)
+    nodes2 = [node for node in execgraph.nodes() if node.name == 'node2']
+    yield assert_equal, [node.inputs.input1 for node in nodes1], [1, 2, 3]
+    # the node2 replicates share their interface until they access it
+    interfaces = set([id(node._interface) for node in nodes2])
+    yield assert_equal, len(nodes2), 3
+    yield assert_equal, len(interfaces), 1
+    nodes2[0].inputs.input1 = 6
+    yield assert_false, id(nodes2[0]._interface) in interfaces
+    yield assert_equal, [node.inputs.input1 for node in nodes2], [6, 5, 5]
+    yield assert_equal, node2.inputs.input1, 5
+
+def test_run_shares_interfaces_and_config():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    wf = pe.Workflow(name='shared', base_dir=wd)
+    inner = pe.Workflow(name='inner')
+    mod1 = pe.Node(TestInterface(), name='mod1')
+    mod1.inputs.input1 = 1
+    mod2 = pe.Node(TestInterface(), name='mod2')
+    mod2.config = {'execution': {'remove_unnecessary_outputs': 'false'}}
+    inner.connect(mod1, 'output2', mod2, 'input1')
+    wf.add_nodes([inner])
+    wf.config['execution']['create_report'] = 'false'
+
+    class RecordPlugin(object):
+        def run(self, graph, config, updatehash=False):
+            self.graph = graph
+    plugin = RecordPlugin()
+    wf.run(plugin=plugin)
+    nodes = dict((node.name, node) for node in plugin.graph.nodes())
+    # the nodes without config overrides share the workflow config
+    yield assert_true, nodes['mod1'].config is wf.config
+    yield assert_equal, \
+        nodes['mod2'].config['execution']['remove_unnecessary_outputs'], \
+        'false'
+    yield assert_equal, wf.config['execution']['remove_unnecessary_outputs'], \
+        'true'
+    # the nodes share the interfaces of the workflow until they are changed
+    yield assert_true, nodes['mod1']._interface is mod1._interface
+    mod1.inputs.input1 = 2
+    yield assert_equal, nodes['mod1'].inputs.input1, 1
+    nodes = dict((node.name, node) for node in wf.run().nodes())
+    yield assert_equal, nodes['mod2'].result.outputs.output2, 2
+    os.chdir(cwd)
+    rmtree(wd)
+
+def test_execution_plan_cache():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    wf = pe.Workflow(name='plan', base_dir=wd)
+    mod1 = pe.Node(TestInterface(), name='mod1')
+    mod1.iterables = ('input1', [1, 2])
+    mod2 = pe.Node(TestInterface(), name='mod2')
+    wf.connect(mod1, 'output2', mod2, 'input1')
+    wf.config['execution'] = {'create_report': 'false',
+                              'cache_execution_plan': 'true'}
+    execgraph = wf.run()
+    plan_file = os.path.join(wd, 'plan', '_execution_plan.pkl')
+    yield assert_true, os.path.exists(plan_file)
+    hashvalue = wf._get_plan_hashval()
+
+    def create_execution_plan():
+        raise Exception('the cached execution plan was not used')
+    wf._create_execution_plan = create_execution_plan
+    execgraph = wf.run()
+    outputs = sorted(node.result.outputs.output2 for node in execgraph.nodes()
+                     if node.name == 'mod2')
+    yield assert_equal, outputs, [1, 2]
+    # changing the iterables invalidates the plan
+    del wf._create_execution_plan
+    mod1.iterables = ('input1', [1, 2, 3])
+    yield assert_not_equal, wf._get_plan_hashval(), hashvalue
+    execgraph = wf.run()
+    outputs = sorted(node.result.outputs.output2 for node in execgraph.nodes()
+                     if node.name == 'mod2')
+    yield assert_equal, outputs, [1, 2, 3]
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+plan_hash_script = """
+import nipype.pipeline.engine as pe
+from nipype.pipeline.tests.test_engine import TestInterface
+
+# shifts the addresses of the objects created below
+padding = [object() for _ in range(%d)]
+wf = pe.Workflow(name='plan', base_dir=%r)
+node = pe.Node(TestInterface(), name='mod1')
+node.inputs.input2 = 1
+node.iterables = ('input1', [1, 2])
+# like the Matlab command of the SPM interfaces
+node._interface.helper = object()
+wf.add_nodes([node])
+print wf._get_plan_hashval()
+"""
+
+def test_execution_plan_hash_is_stable():
+    import subprocess
+    import sys
+    import nipype
+    wd = mkdtemp()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(nipype.__file__))),
+         env.get('PYTHONPATH', '')])
+    # the hash is computed in separate interpreters, where the objects of
+    # the interfaces live at different addresses
+    hashvalues = [subprocess.Popen([sys.executable, '-c',
+                                    plan_hash_script % (npadding, wd)],
+                                   env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE).communicate()[0]
+                  for npadding in [0, 1000]]
+    yield assert_true, len(hashvalues[0].strip()) == 40
+    yield assert_equal, hashvalues[0], hashvalues[1]
+    rmtree(wd)
+
 def test_synchronize_expansion():
     import nipype.pipeline.engine as pe
     wf1 = pe.Workflow(name='test')
@@ -732,6 +862,198 @@ def test_mapnode_json():
     rmtree(wd)
 
 
+
+def test_write_provenance():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+    def func1():
+        return 1
+    def func2(a):
+        return a+1
+    n1 = pe.Node(Function(input_names=[],
+                          output_names=['a'],
+                          function=func1),
+                 name='n1')
+    n2 = pe.Node(Function(input_names=['a'],
+                          output_names=['b'],
+                          function=func2),
+                 name='n2')
+    w1 = pe.Workflow(name='test')
+    w1.connect(n1, 'a', n2, 'a')
+    w1.base_dir = wd
+    w1.config['execution'] = {'write_provenance': 'off'}
+    w1.run()
+    yield assert_equal, glob(os.path.join(wd, 'test', '*', 'provenance.*')), []
+    yield (assert_equal, glob(os.path.join(wd, 'test',
+                                           'workflow_provenance.*')), [])
+    w1.config['execution'] = {'write_provenance': 'workflow'}
+    eg = w1.run()
+    yield (assert_true, len(glob(os.path.join(wd, 'test',
+                                              'workflow_provenance.*'))) > 0)
+    yield assert_equal, glob(os.path.join(wd, 'test', '*', 'provenance.*')), []
+    w1.config['execution'] = {'write_provenance': 'node',
+                              'stop_on_first_rerun': 'false'}
+    n1.inputs.a = 2
+    n2.overwrite = True
+    w1.run()
+    yield (assert_true, len(glob(os.path.join(wd, 'test', 'n2',
+                                              'provenance.*'))) > 0)
+    w1.config['execution'] = {'write_provenance': 'everything'}
+    yield assert_raises, ValueError, w1.run
+    os.chdir(cwd)
+    rmtree(wd)
+
+def test_mapnode_n_procs():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from time import time
+    from nipype.interfaces.utility import Function
+    # command line subnodes run on threads
+    sleep = pe.MapNode(nib.CommandLine(command='sleep'), iterfield=['args'],
+                       name='sleep', n_procs=4, base_dir=wd)
+    sleep.inputs.args = ['0.5'] * 4
+    t0 = time()
+    res = sleep.run()
+    yield assert_true, time() - t0 < 1.5
+    yield assert_equal, [runtime.cmdline for runtime in res.runtime], \
+        ['sleep 0.5'] * 4
+    yield assert_equal, os.getcwd(), wd
+    # the pool draws the subnodes lazily
+    sleep.inputs.args = ['0.1'] * 20
+    drawn = []
+
+    def nodes():
+        for i, node in sleep._make_nodes(wd):
+            drawn.append(i)
+            yield i, node
+    runner = sleep._pool_runner(nodes())
+    yield assert_equal, runner.next()[0], 0
+    yield assert_true, len(drawn) <= 10
+    runner.close()
+    os.chdir(wd)
+
+    # other subnodes run in processes
+    def func1(in1):
+        import os
+        return in1 + 1, os.getpid()
+    n1 = pe.MapNode(Function(input_names=['in1'], output_names=['out', 'pid'],
+                             function=func1),
+                    iterfield=['in1'], name='n1', n_procs=2, base_dir=wd)
+    n1.inputs.in1 = range(5)
+    res = n1.run()
+    yield assert_equal, res.outputs.out, [1, 2, 3, 4, 5]
+    yield assert_false, os.getpid() in res.outputs.pid
+    # the subnodes are cached
+    n1.inputs.in1 = range(6)
+    res2 = n1.run()
+    yield assert_equal, res2.outputs.pid[:5], res.outputs.pid
+    # failures are reported per subnode
+    n1.inputs.in1 = [1, None]
+    error = None
+    try:
+        n1.run()
+    except Exception, error:
+        pass
+    yield assert_true, 'Subnode 1 failed' in str(error)
+    yield assert_false, 'Subnode 0 failed' in str(error)
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_iter_subnodes():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+
+    def func1(in1, in2):
+        return in1
+    n1 = pe.MapNode(Function(input_names=['in1', 'in2'], output_names=['out'],
+                             function=func1),
+                    iterfield=['in1'], name='n1', base_dir=wd)
+    n1.inputs.in1 = range(3)
+    n1.inputs.in2 = dict(a=range(100))
+    n1.config = deepcopy(pe.config._sections)
+    subnodes = n1.iter_subnodes()
+    first = subnodes.next()
+    yield assert_equal, first.name, '_n10'
+    yield assert_equal, first.inputs.in1, 0
+    nodes = [first] + list(subnodes)
+    yield assert_equal, [node.inputs.in1 for node in nodes], [0, 1, 2]
+    # the subnodes share a single copy of the other inputs
+    yield assert_equal, nodes[0].inputs.in2, n1.inputs.in2
+    yield assert_false, nodes[0].inputs.in2 is n1.inputs.in2
+    yield assert_true, nodes[0].inputs.in2 is nodes[2].inputs.in2
+    yield assert_equal, nodes[1].inputs.function_str, n1.inputs.function_str
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_mapnode_chunksize():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+
+    def func1(in1, log):
+        import os
+        open(os.path.join(log, str(in1)), 'wt').close()
+        return in1 + 1
+    # the runs are logged in a directory, since the contents of input files
+    # are hashed
+    log = os.path.join(wd, 'log')
+    os.mkdir(log)
+
+    def runs():
+        items = sorted([int(item) for item in os.listdir(log)])
+        for item in items:
+            os.remove(os.path.join(log, str(item)))
+        return items
+    for cache_chunks in [False, True]:
+        name = 'n%d' % cache_chunks
+        n1 = pe.MapNode(Function(input_names=['in1', 'log'],
+                                 output_names=['out'], function=func1),
+                        iterfield=['in1'], name=name, chunksize=3,
+                        cache_chunks=cache_chunks, base_dir=wd)
+        n1.inputs.in1 = range(7)
+        n1.inputs.log = log
+        res = n1.run()
+        yield assert_equal, res.outputs.out, range(1, 8)
+        yield assert_equal, len(res.runtime), 7
+        yield assert_equal, n1.num_subnodes(), 3
+        mapflow = os.path.join(wd, name, 'mapflow')
+        yield assert_equal, sorted(os.listdir(mapflow)), \
+            ['_%s_chunk%d' % (name, k) for k in range(3)]
+        items = os.listdir(os.path.join(mapflow, '_%s_chunk1' % name,
+                                        'mapflow'))
+        yield assert_equal, sorted(items), ['_%s%d' % (name, i)
+                                            for i in range(3, 6)]
+        yield assert_equal, runs(), range(7)
+        # only the chunk of the changed item reruns, and with per item
+        # caching only the changed item
+        n1.inputs.in1 = [0, 1, 2, 3, 4, 10, 6]
+        res = n1.run()
+        yield assert_equal, res.outputs.out, [1, 2, 3, 4, 5, 11, 7]
+        if cache_chunks:
+            yield assert_equal, runs(), [3, 4, 10]
+        else:
+            yield assert_equal, runs(), [10]
+    # failures are reported per chunk
+    n1.inputs.in1 = [1, None, 3, 4]
+    error = None
+    try:
+        n1.run()
+    except Exception, error:
+        pass
+    yield assert_true, 'Chunk _n1_chunk0 failed' in str(error)
+    yield assert_false, 'Chunk _n1_chunk1 failed' in str(error)
+    os.chdir(cwd)
+    rmtree(wd)
+
+
 if __name__ == "__main__":
     import nose
 
@@ -13,7 +13,7 @@ import nipype.pipeline.engine as pe
 import nipype.interfaces.base as nib
 import nipype.interfaces.utility as niu
 from ... import config
-from ..utils import merge_dict
+from ..utils import merge_dict, _prefix_matcher
 
 
 def test_identitynode_removal():
@@ -291,3 +291,15 @@ def test_multi_disconnected_iterable():
     eg = metawf.run(plugin='Linear')
     yield assert_equal, len(eg.nodes()), 60
     rmtree(out_dir)
+
+
+def test_prefix_matcher():
+    match = _prefix_matcher(['/a/b', '/a/b/c', '/a/d', '/e'])
+    yield assert_true, match('/a/b/file')
+    yield assert_true, match('/a/bc/file')
+    yield assert_true, match('/a/d')
+    yield assert_true, match('/e/f/g')
+    yield assert_false, match('/a/c/file')
+    yield assert_false, match('/a')
+    yield assert_false, match('/')
+    yield assert_false, _prefix_matcher([])('/a')
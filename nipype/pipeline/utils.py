@@ -3,6 +3,7 @@
 """Utility routines for workflow graphs
 """
 
+from bisect import bisect_right
 from copy import deepcopy
 from glob import glob
 from collections import defaultdict
@@ -22,7 +23,7 @@ from socket import gethostname, getfqdn
 import networkx as nx
 
 from ..utils.filemanip import (fname_presuffix, FileNotFoundError,
-                               filename_to_list)
+                               filename_to_list, load_json, save_json)
 from ..utils.misc import create_function_from_source, str2bool
 from ..interfaces.base import CommandLine, isdefined, Undefined, Bunch
 from ..interfaces.base import pm as prov, safe_encode
@@ -394,23 +395,21 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     # nodes of the supergraph.
     supernodes = supergraph.nodes()
     ids = ['.'.join((n._hierarchy, n._id)) for n in supernodes]
-    if len(np.unique(ids)) != len(ids):
+    idmap = dict(zip(ids, supernodes))
+    if len(idmap) != len(ids):
         # This should trap the problem of miswiring when multiple iterables are
         # used at the same level. The use of the template below for naming
         # updates to nodes is the general solution.
         raise Exception(("Execution graph does not have a unique set of node "
                          "names. Please rerun the workflow"))
     edgeinfo = {}
-    for n in subgraph.nodes():
+    for n in subgraph.nodes_iter():
         nid = '.'.join((n._hierarchy, n._id))
-        nidx = ids.index(nid)
-        for edge in supergraph.in_edges_iter(supernodes[nidx]):
+        for edge in supergraph.in_edges_iter(idmap[nid]):
             # make sure the edge is not part of the subgraph
-            if edge[0] not in subgraph.nodes():
-                if nid not in edgeinfo.keys():
-                    edgeinfo[nid] = []
-                edgeinfo[nid].append((edge[0],
-                                      supergraph.get_edge_data(*edge)))
+            if not subgraph.has_node(edge[0]):
+                edgeinfo.setdefault(nid, []).append(
+                    (edge[0], supergraph.get_edge_data(*edge)))
     supergraph.remove_nodes_from(nodes)
     # Add copies of the subgraph depending on the number of iterables
     iterable_params = expand_iterables(iterables, synchronize)
@@ -420,19 +419,23 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     # Make an iterable subgraph node id template
     count = len(iterable_params)
     template = '.%s%%0%dd' % (prefix, np.ceil(np.log10(count)))
+    # the levels and the root node are the same in every copy
+    levels = get_levels(subgraph)
+    rootnode = idmap[nodeid]
     # Copy the iterable subgraphs
     for i, params in enumerate(iterable_params):
-        Gc = deepcopy(subgraph)
-        ids = ['.'.join((n._hierarchy, n._id)) for n in Gc.nodes()]
-        nodeidx = ids.index(nodeid)
-        rootnode = Gc.nodes()[nodeidx]
+        # the copies share the interfaces of the nodes until they access
+        # their inputs
+        memo = {}
+        for n in subgraph.nodes_iter():
+            n._share_interface(memo)
+        Gc = deepcopy(subgraph, memo)
         paramstr = ''
         for key, val in sorted(params.items()):
             paramstr = '_'.join((paramstr, _get_valid_pathstr(key),
                                  _get_valid_pathstr(str(val))))
-            rootnode.set_input(key, val)
-        levels = get_levels(Gc)
-        for n in Gc.nodes():
+            memo[id(rootnode)].set_input(key, val)
+        for n in subgraph.nodes_iter():
             """
             update parameterization of the node to reflect the location of
             the output directory.  For example, if the iterables along a
@@ -445,17 +448,17 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
             # enter as negative numbers so that earlier iterables with longer
             # path lengths get precedence in a sort
             paramlist = [(-path_length, paramstr)]
-            if n.parameterization:
-                n.parameterization = paramlist + n.parameterization
+            node = memo[id(n)]
+            if node.parameterization:
+                node.parameterization = paramlist + node.parameterization
             else:
-                n.parameterization = paramlist
-        supergraph.add_nodes_from(Gc.nodes())
-        supergraph.add_edges_from(Gc.edges(data=True))
-        for node in Gc.nodes():
+                node.parameterization = paramlist
+        supergraph.add_nodes_from(Gc.nodes_iter())
+        supergraph.add_edges_from(Gc.edges_iter(data=True))
+        for node in Gc.nodes_iter():
             nid = '.'.join((node._hierarchy, node._id))
-            if nid in edgeinfo.keys():
-                for info in edgeinfo[nid]:
-                    supergraph.add_edges_from([(info[0], node, info[1])])
+            for info in edgeinfo.get(nid, []):
+                supergraph.add_edges_from([(info[0], node, info[1])])
             node._id += template % i
     logger.debug('Expanded %d iterables in node %s.' % (count, nodeid))
     return supergraph
@@ -1011,6 +1014,85 @@ def make_output_dir(outdir):
     return outdir
 
 
+class HashIndex(object):
+    """Index of the node hashes of a workflow
+
+    Maps the output directory of each node to the hash value of its inputs
+    and its results file. The index is kept in memory and stored in a single
+    json file, so that an unchanged node can be confirmed with a single
+    stat of its hash file instead of a listing of its output directory.
+
+    >>> index = HashIndex()
+    >>> index.add('/tmp/wf/node', 'abc', '/tmp/wf/node/result_node.pklz')
+    >>> index.get('/tmp/wf/node')
+    ['abc', '/tmp/wf/node/result_node.pklz']
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._index = {}
+        self._modified = False
+        if filename and os.path.exists(filename):
+            try:
+                self._index = load_json(filename)
+            except Exception, e:
+                logger.debug('Could not load the hash index %s: %s' %
+                             (filename, e))
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, outdir):
+        """Returns the [hashvalue, resultsfile] entry of a node directory
+        """
+        return self._index.get(outdir)
+
+    def add(self, outdir, hashvalue, resultsfile):
+        entry = [hashvalue, resultsfile]
+        if self._index.get(outdir) != entry:
+            self._index[outdir] = entry
+            self._modified = True
+
+    def remove(self, outdir):
+        if self._index.pop(outdir, None) is not None:
+            self._modified = True
+
+    def check(self, outdir, hashvalue):
+        """Checks whether the node directory holds results for a hash value
+        """
+        entry = self._index.get(outdir)
+        if entry is None or entry[0] != hashvalue:
+            return False
+        if os.path.exists(os.path.join(outdir, '_0x%s.json' % hashvalue)):
+            return True
+        self.remove(outdir)
+        return False
+
+    def update(self, node):
+        """Records the hash of a node that has finished running
+        """
+        outdir = node.output_dir()
+        hashfiles = [hashfile for hashfile in
+                     glob(os.path.join(outdir, '_0x*.json'))
+                     if not hashfile.endswith('_unfinished.json')]
+        if len(hashfiles) != 1:
+            self.remove(outdir)
+            return
+        hashvalue = os.path.basename(hashfiles[0])[len('_0x'):-len('.json')]
+        self.add(outdir, hashvalue,
+                 os.path.join(outdir, 'result_%s.pklz' % node.name))
+
+    def save(self):
+        if not (self.filename and self._modified):
+            return
+        try:
+            save_json(self.filename, self._index)
+            self._modified = False
+        except IOError, e:
+            logger.debug('Could not save the hash index %s: %s' %
+                         (self.filename, e))
+
+
 def get_all_files(infile):
     """Return a list of files based on the given input file as follows:
     
@@ -1061,6 +1143,23 @@ def walk_files(cwd):
             yield os.path.join(path, f)
 
 
+def _prefix_matcher(prefixes):
+    """Returns a function telling whether a string starts with any prefix
+
+    Prefixes extending a shorter prefix are dropped, so that the remaining
+    sorted prefixes are searched with a single bisection per string.
+    """
+    minimal = []
+    for prefix in sorted(set(prefixes)):
+        if not minimal or not prefix.startswith(minimal[-1]):
+            minimal.append(prefix)
+
+    def match(path):
+        idx = bisect_right(minimal, path)
+        return idx > 0 and path.startswith(minimal[idx - 1])
+    return match
+
+
 def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
                             files2keep=None, dirs2keep=None):
     """Removes all files not needed for further analysis from the directory
@@ -1076,18 +1175,18 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
     outputdict = outputs.get()
     for output in outputs_to_keep:
         output_files.extend(walk_outputs(outputdict[output]))
-    needed_files = [path for path, type in output_files if type == 'f']
+    needed_files = set(path for path, type in output_files if type == 'f')
     if str2bool(config['execution']['keep_inputs']):
         input_files = []
         inputdict = inputs.get()
         input_files.extend(walk_outputs(inputdict))
-        needed_files += [path for path, type in input_files if type == 'f']
+        needed_files.update(path for path, type in input_files if type == 'f')
     for extra in ['_0x*.json', 'provenance.*', 'pyscript*.m',
                   'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz']:
-        needed_files.extend(glob(os.path.join(cwd, extra)))
+        needed_files.update(glob(os.path.join(cwd, extra)))
     if files2keep:
         keep_files = [os.path.abspath(f) for f in filename_to_list(files2keep)]
-        needed_files.extend(keep_files)
+        needed_files.update(keep_files)
     needed_dirs = [path for path, type in output_files if type == 'd']
     if dirs2keep:
         keep_dirs = [os.path.abspath(d) for d in filename_to_list(dirs2keep)]
@@ -1098,18 +1197,17 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
     logger.debug('Needed dirs: %s' % (';'.join(needed_dirs)))
     files2remove = []
     if str2bool(config['execution']['remove_unnecessary_outputs']):
+        in_needed_dir = _prefix_matcher(needed_dirs)
         for f in walk_files(cwd):
-            if f not in needed_files:
-                if len(needed_dirs) == 0:
-                    files2remove.append(f)
-                elif not any([f.startswith(dname) for dname in needed_dirs]):
-                    files2remove.append(f)
+            if f not in needed_files and not in_needed_dir(f):
+                files2remove.append(f)
     else:
         if not str2bool(config['execution']['keep_inputs']):
             input_files = []
             inputdict = inputs.get()
             input_files.extend(walk_outputs(inputdict))
-            input_files = [path for path, type in input_files if type == 'f']
+            input_files = set(path for path, type in input_files
+                              if type == 'f')
             for f in walk_files(cwd):
                 if f in input_files and f not in needed_files:
                     files2remove.append(f)
@@ -1156,9 +1254,19 @@ def merge_dict(d1, d2, merge=lambda x, y: y):
 
 def write_prov(graph, filename=None, format='turtle'):
     """Write W3C PROV Model JSON file
+
+    The result of every node is loaded once; nodes without results (e.g.,
+    nodes that crashed or were not run) are left out.
     """
     if not filename:
         filename = os.path.join(os.getcwd(), 'workflow_provenance')
+    results = {}
+    for node in graph.nodes():
+        result = node.result
+        if result is not None:
+            results[node] = result
+    fullgraph = graph
+    graph = graph.subgraph(results.keys())
     foaf = prov.Namespace("foaf", "http://xmlns.com/foaf/0.1/")
     dcterms = prov.Namespace("dcterms", "http://purl.org/dc/terms/")
     nipype = prov.Namespace("nipype", "http://nipy.org/nipype/terms/")
@@ -1187,8 +1295,9 @@ def write_prov(graph, filename=None, format='turtle'):
 
     processes = []
     nodes = graph.nodes()
+    nodeidx = dict((node, idx) for idx, node in enumerate(nodes))
     for idx, node in enumerate(nodes):
-        result = node.result
+        result = results[node]
         classname = node._interface.__class__.__name__
         _, hashval, _, _ = node.hash_exists()
         if isinstance(result.runtime, list):
@@ -1281,13 +1390,13 @@ def write_prov(graph, filename=None, format='turtle'):
                 {prov.PROV["Role"]: "LoggedInUser"})
         g.wasAssociatedWith(process, software_agent, None, None,
                 {prov.PROV["Role"]: prov.PROV["SoftwareAgent"]})
+        used_ports = set()
+        for _, _, d in fullgraph.in_edges_iter([node], data=True):
+            for _, dest in d['connect']:
+                used_ports.add(dest)
         for inidx, inputval in enumerate(sorted(node.inputs.get().items())):
             if isdefined(inputval[1]):
                 inport = inputval[0]
-                used_ports = []
-                for _, _, d in graph.in_edges_iter([node], data=True):
-                    for _, dest in d['connect']:
-                        used_ports.append(dest)
                 if inport not in used_ports:
                     param = g.entity(uuid1().hex,
                                      {prov.PROV["type"]: nipype['input'],
@@ -1301,12 +1410,13 @@ def write_prov(graph, filename=None, format='turtle'):
     # add artifacts (files)
     counter = 0
     for idx, node in enumerate(nodes):
-        if node.result.outputs is None:
+        result = results[node]
+        if result.outputs is None:
             continue
-        if isinstance(node.result.outputs, Bunch):
-            outputs = node.result.outputs.dictcopy()
+        if isinstance(result.outputs, Bunch):
+            outputs = result.outputs.dictcopy()
         else:
-            outputs = node.result.outputs.get()
+            outputs = result.outputs.get()
         used_ports = {}
         for _, v, d in graph.out_edges_iter([node], data=True):
             for src, dest in d['connect']:
@@ -1332,12 +1442,12 @@ def write_prov(graph, filename=None, format='turtle'):
                     counter += 1
                     # Used: Artifact->Process
                     attrs = {prov.PROV["label"]: portname}
-                    g.used(processes[nodes.index(destnode)], artifact,
+                    g.used(processes[nodeidx[destnode]], artifact,
                            other_attributes=attrs)
     # Process->Process
     for idx, edgeinfo in enumerate(graph.in_edges_iter()):
-        g.wasStartedBy(processes[nodes.index(edgeinfo[1])],
-                       starter=processes[nodes.index(edgeinfo[0])])
+        g.wasStartedBy(processes[nodeidx[edgeinfo[1]]],
+                       starter=processes[nodeidx[edgeinfo[0]]])
     # write provenance
     try:
         if format in ['turtle', 'all']:
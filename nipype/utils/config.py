@@ -4,7 +4,7 @@
 Created on 20 Apr 2010
 
 logging options : INFO, DEBUG
-hash_method : content, timestamp
+hash_method : content, content_fast, content_sampled, timestamp
 
 @author: Chris Filo Gorgolewski
 '''
@@ -30,26 +30,36 @@ log_size = 16384000
 log_rotate = 4
 
 [execution]
+cache_execution_plan = false
 create_report = true
 crashdump_dir = %s
 display_variable = :1
+hash_cache = false
+hash_cache_file = %s
+hash_cache_size = 1000000
 hash_method = timestamp
+hash_threads = 4
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = true
 matplotlib_backend = Agg
+persist_tool_versions = false
 plugin = Linear
 remove_node_directories = false
 remove_unnecessary_outputs = true
+runtime_capture = full
 single_thread_matlab = true
 stop_on_first_crash = false
 stop_on_first_rerun = false
 use_relative_paths = false
+write_provenance = off
 stop_on_unknown_version = false
+use_hash_index = true
 
 [check]
 interval = 1209600
-""" % (homedir, os.getcwd())
+""" % (homedir, os.getcwd(),
+       os.path.join(homedir, '.nipype', 'hashcache.sqlite'))
 
 class NipypeConfig(object):
     """Base nipype config class
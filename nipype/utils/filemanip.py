@@ -10,6 +10,8 @@ import gzip
 import os
 import re
 import shutil
+import zlib
+from stat import S_ISREG
 
 # The md5 module is deprecated in Python 2.6, but hashlib is only
 # available as an external package for versions of python before 2.6.
@@ -31,6 +33,7 @@ import numpy as np
 
 from nipype.interfaces.traits_extension import isdefined
 from nipype.utils.misc import is_container
+from nipype.utils.hashcache import get_hash_cache
 
 from .. import logging, config
 fmlogger = logging.getLogger("filemanip")
@@ -151,20 +154,144 @@ def check_forhash(filename):
         return False, None
 
 
-def hash_infile(afile, chunk_len=8192):
-    """ Computes md5 hash of a file"""
-    md5hex = None
-    if os.path.isfile(afile):
-        md5obj = md5()
-        fp = file(afile, 'rb')
+# Process-wide memo of content hashes keyed by (method, path, inode, size,
+# mtime)
+_content_hashes = {}
+
+# Read size of the content hashers
+HASH_CHUNK_LEN = 1024 * 1024
+
+# Sampling parameters of the content_sampled hash method
+SAMPLE_HEADER_LEN = 64 * 1024
+SAMPLE_BLOCK_LEN = 64 * 1024
+SAMPLE_NBLOCKS = 16
+
+_hash_pool = None
+_hash_pool_pid = None
+
+
+def _file_hash_key(afile, method='content'):
+    """Returns the memo key of a file or None if it is not a regular file"""
+    try:
+        stat = os.stat(afile)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    # the ctime also catches rewrites of the same size within the mtime
+    # resolution
+    return (method, os.path.abspath(afile), stat.st_ino, stat.st_size,
+            stat.st_mtime, stat.st_ctime)
+
+
+def clear_hash_cache():
+    """Forgets the content hashes memoised by hash_infile"""
+    _content_hashes.clear()
+
+
+def _memoised_hash(afile, method, hasher):
+    key = _file_hash_key(afile, method)
+    if key is None:
+        return None
+    hashval = _content_hashes.get(key)
+    if hashval is None:
+        cache = get_hash_cache()
+        if cache is not None:
+            hashval = cache.get(afile, method)
+        if hashval is None:
+            hashval = hasher(afile)
+            if cache is not None:
+                cache.set(afile, hashval, method)
+        _content_hashes[key] = hashval
+    return hashval
+
+
+def _md5_content(afile, chunk_len=HASH_CHUNK_LEN):
+    md5obj = md5()
+    fp = file(afile, 'rb')
+    try:
         while True:
             data = fp.read(chunk_len)
             if not data:
                 break
             md5obj.update(data)
+    finally:
         fp.close()
-        md5hex = md5obj.hexdigest()
-    return md5hex
+    return md5obj.hexdigest()
+
+
+def _zlib_content(afile, chunk_len=HASH_CHUNK_LEN):
+    crc = 0
+    adler = 1
+    fp = file(afile, 'rb')
+    try:
+        while True:
+            data = fp.read(chunk_len)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            adler = zlib.adler32(data, adler)
+    finally:
+        fp.close()
+    return 'crc32adler32:%08x%08x' % (crc & 0xffffffff, adler & 0xffffffff)
+
+
+def _sampled_content(afile):
+    size = os.path.getsize(afile)
+    md5obj = md5()
+    md5obj.update(str(size))
+    fp = file(afile, 'rb')
+    try:
+        md5obj.update(fp.read(SAMPLE_HEADER_LEN))
+        body = size - SAMPLE_HEADER_LEN
+        if body > SAMPLE_NBLOCKS * SAMPLE_BLOCK_LEN:
+            stride = body // SAMPLE_NBLOCKS
+            for idx in range(SAMPLE_NBLOCKS):
+                fp.seek(SAMPLE_HEADER_LEN + idx * stride)
+                md5obj.update(fp.read(SAMPLE_BLOCK_LEN))
+            # the tail usually holds the last volume of a series
+            fp.seek(size - SAMPLE_BLOCK_LEN)
+            md5obj.update(fp.read(SAMPLE_BLOCK_LEN))
+        else:
+            while True:
+                data = fp.read(HASH_CHUNK_LEN)
+                if not data:
+                    break
+                md5obj.update(data)
+    finally:
+        fp.close()
+    return 'sampledmd5:%s' % md5obj.hexdigest()
+
+
+def hash_infile(afile, chunk_len=HASH_CHUNK_LEN):
+    """ Computes md5 hash of a file
+
+    Hashes are memoised for the lifetime of the process, keyed by the path,
+    inode, size and modification time of the file, so that a file is read
+    only once however many nodes use it. They are also looked up in and
+    stored to the persistent hash cache (see execution.hash_cache).
+    """
+    return _memoised_hash(afile, 'content',
+                          lambda afile: _md5_content(afile, chunk_len))
+
+
+def hash_infile_fast(afile):
+    """ Computes a non-cryptographic crc32/adler32 digest of a file
+
+    The digest is prefixed with the name of its algorithm so that it never
+    compares equal to an md5 hash.
+    """
+    return _memoised_hash(afile, 'content_fast', _zlib_content)
+
+
+def hash_infile_sampled(afile):
+    """ Computes md5 hash of the size, header and strided blocks of a file
+
+    Only about 1 MB of a large file is read. Files too small to be sampled
+    are hashed in full. The digest is prefixed with the name of its algorithm.
+    """
+    return _memoised_hash(afile, 'content_sampled', _sampled_content)
+
 
 def hash_timestamp(afile):
     """ Computes md5 hash of the timestamp of a file """
@@ -177,6 +304,62 @@ def hash_timestamp(afile):
         md5hex = md5obj.hexdigest()
     return md5hex
 
+
+_hash_functions = {'timestamp': hash_timestamp,
+                   'content': hash_infile,
+                   'content_fast': hash_infile_fast,
+                   'content_sampled': hash_infile_sampled}
+
+
+def hash_file(afile, hash_method=None):
+    """ Computes the hash of a file with the given method
+
+    Parameters
+    ----------
+    afile : str
+        file to hash
+    hash_method : str
+        one of ``timestamp``, ``content``, ``content_fast`` and
+        ``content_sampled`` (default: execution.hash_method)
+    """
+    if hash_method is None:
+        hash_method = config.get('execution', 'hash_method')
+    try:
+        hasher = _hash_functions[hash_method.lower()]
+    except KeyError:
+        raise Exception("Unknown hash method: %s" % hash_method)
+    return hasher(afile)
+
+
+def _get_hash_pool():
+    global _hash_pool, _hash_pool_pid
+    # a pool inherited through fork has no live threads
+    if _hash_pool is None or _hash_pool_pid != os.getpid():
+        from multiprocessing.pool import ThreadPool
+        _hash_pool = ThreadPool(int(config.get('execution', 'hash_threads')))
+        _hash_pool_pid = os.getpid()
+    return _hash_pool
+
+
+def hash_infiles(files, hash_method=None):
+    """ Hashes files concurrently and returns a dict of file -> hash
+
+    Content hashes are computed on a pool of ``execution.hash_threads``
+    threads; hashlib and zlib release the GIL while digesting.
+    """
+    if hash_method is None:
+        hash_method = config.get('execution', 'hash_method')
+    files = sorted(set(files))
+    if (len(files) < 2 or hash_method.lower() == 'timestamp' or
+            int(config.get('execution', 'hash_threads')) < 2):
+        hashes = [hash_file(afile, hash_method) for afile in files]
+    else:
+        hashes = _get_hash_pool().map(lambda afile: hash_file(afile,
+                                                              hash_method),
+                                      files)
+    return dict(zip(files, hashes))
+
+
 def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=None):
     """Copy or symlink ``originalfile`` to ``newfile``.
 
@@ -215,10 +398,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
         hashmethod = config.get('execution', 'hash_method').lower()
 
     elif os.path.exists(newfile):
-        if hashmethod == 'timestamp':
-            newhash = hash_timestamp(newfile)
-        elif hashmethod == 'content':
-            newhash = hash_infile(newfile)
+        newhash = hash_file(newfile, hashmethod)
         fmlogger.debug("File: %s already exists,%s, copy:%d" \
                            % (newfile, newhash, copy))
     #the following seems unnecessary
@@ -228,10 +408,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
     #        newhash = None
     if os.name is 'posix' and not copy:
         if os.path.lexists(newfile):
-            if hashmethod == 'timestamp':
-                orighash = hash_timestamp(originalfile)
-            elif hashmethod == 'content':
-                orighash = hash_infile(originalfile)
+            orighash = hash_file(originalfile, hashmethod)
             fmlogger.debug('Original hash: %s, %s'%(originalfile, orighash))
             if newhash != orighash:
                 os.unlink(newfile)
@@ -239,10 +416,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False, hashmethod=Non
             os.symlink(originalfile,newfile)
     else:
         if newhash:
-            if hashmethod == 'timestamp':
-                orighash = hash_timestamp(originalfile)
-            elif hashmethod == 'content':
-                orighash = hash_infile(originalfile)
+            orighash = hash_file(originalfile, hashmethod)
         if (newhash is None) or (newhash != orighash):
             try:
                 fmlogger.debug("Copying File: %s->%s" \
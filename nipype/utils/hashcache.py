@@ -0,0 +1,179 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Persistent cache of file content hashes
+
+The cache is a SQLite database mapping (hash method, real path, device,
+inode, size, mtime, ctime) to the digest of a file, so that a file whose
+metadata has not changed since an earlier run is not read again. Least
+recently used entries are evicted when the cache grows beyond its maximum
+number of entries.
+
+Every process and thread opens its own connection; SQLite serialises the
+writers. Errors accessing the database are logged and treated as cache
+misses, so a broken cache never fails a workflow.
+"""
+import os
+import sqlite3
+import threading
+from time import time
+
+from .. import logging, config
+from .misc import str2bool
+fmlogger = logging.getLogger("filemanip")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS hashes (
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime TEXT NOT NULL,
+    ctime TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    atime REAL NOT NULL,
+    PRIMARY KEY (method, path, device, inode, size, mtime, ctime)
+);
+CREATE INDEX IF NOT EXISTS hashes_atime ON hashes (atime);
+"""
+
+# Version of the database layout; databases of other versions are emptied
+SCHEMA_VERSION = 2
+
+# Access times are refreshed at most this often (seconds) to avoid a write
+# for every cache hit
+ATIME_RESOLUTION = 3600.
+
+
+class HashCache(object):
+    """SQLite backed cache of file hashes
+
+    Parameters
+    ----------
+    filename : str
+        path of the database file, created on first use
+    max_entries : int
+        number of entries kept when evicting least recently used entries
+    timeout : float
+        seconds to wait for a lock held by another process
+    """
+
+    def __init__(self, filename, max_entries=1000000, timeout=30.):
+        self.filename = os.path.abspath(filename)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+        self._inserts = 0
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        # connections must not be shared with forked children
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.filename, timeout=self.timeout)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # e.g. network file systems without shared memory
+            pass
+        if conn.execute('PRAGMA user_version').fetchone()[0] != \
+                SCHEMA_VERSION:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS hashes')
+                conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+        conn.executescript(_schema)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _key(self, afile, method):
+        stat = os.stat(afile)
+        # the ctime changes with every write, which the mtime misses on
+        # file systems with a coarse timestamp resolution if the size is
+        # unchanged
+        return (method, os.path.realpath(afile), stat.st_dev, stat.st_ino,
+                stat.st_size, repr(stat.st_mtime), repr(stat.st_ctime))
+
+    def get(self, afile, method='content'):
+        """Returns the cached digest of afile or None"""
+        try:
+            key = self._key(afile, method)
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT digest, atime FROM hashes WHERE method=? AND path=? '
+                'AND device=? AND inode=? AND size=? AND mtime=? '
+                'AND ctime=?', key).fetchone()
+            if row is None:
+                return None
+            now = time()
+            if now - row[1] > ATIME_RESOLUTION:
+                with conn:
+                    conn.execute(
+                        'UPDATE hashes SET atime=? WHERE method=? AND path=? '
+                        'AND device=? AND inode=? AND size=? AND mtime=? '
+                        'AND ctime=?',
+                        (now,) + key)
+            return row[0]
+        except (OSError, sqlite3.Error), e:
+            fmlogger.debug('Hash cache lookup of %s failed: %s' % (afile, e))
+            return None
+
+    def set(self, afile, digest, method='content'):
+        """Stores the digest of afile"""
+        try:
+            key = self._key(afile, method)
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO hashes VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             key + (digest, time()))
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                self.evict()
+        except (OSError, sqlite3.Error), e:
+            fmlogger.debug('Hash cache update of %s failed: %s' % (afile, e))
+
+    def evict(self):
+        """Removes the least recently used entries beyond max_entries"""
+        conn = self._connect()
+        count = conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.max_entries:
+            with conn:
+                conn.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid '
+                             'FROM hashes ORDER BY atime LIMIT ?)',
+                             (count - self.max_entries,))
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def clear(self):
+        """Removes all entries"""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM hashes')
+
+
+_cache = None
+
+
+def get_hash_cache():
+    """Returns the process-wide persistent hash cache or None if disabled
+
+    The cache is configured by the execution options hash_cache,
+    hash_cache_file and hash_cache_size.
+    """
+    global _cache
+    if not str2bool(config.get('execution', 'hash_cache')):
+        return None
+    filename = os.path.abspath(os.path.expanduser(
+        config.get('execution', 'hash_cache_file')))
+    max_entries = int(config.get('execution', 'hash_cache_size'))
+    if _cache is None or _cache.filename != filename:
+        _cache = HashCache(filename, max_entries=max_entries)
+    _cache.max_entries = max_entries
+    return _cache
+
@@ -3,6 +3,7 @@
 """Miscellaneous utility functions
 """
 from cPickle import dumps, loads
+from importlib import import_module
 import inspect
 
 from distutils.version import LooseVersion
@@ -57,9 +58,21 @@ def getsource(function):
     src = dumps(dedent(inspect.getsource(function)))
     return src
 
+# functions compiled by create_function_from_source in this process
+_function_cache = {}
+
+
+def clear_function_cache():
+    """Forgets the functions compiled in this process"""
+    _function_cache.clear()
+
+
 def create_function_from_source(function_source, imports=None):
     """Return a function object from a function source
 
+    Functions are compiled once per process and source; later calls with
+    the same source and imports return the same function object.
+
     Parameters
     ----------
     function_source : pickled string
@@ -68,6 +81,15 @@ def create_function_from_source(function_source, imports=None):
         list of import statements in string form that allow the function
         to be executed in an otherwise empty namespace
     """
+    key = (function_source, tuple(imports or []))
+    func = _function_cache.get(key)
+    if func is None:
+        func = _compile_function(function_source, imports)
+        _function_cache[key] = func
+    return func
+
+
+def _compile_function(function_source, imports=None):
     ns = {}
     import_keys = []
     try:
@@ -92,6 +114,26 @@ def create_function_from_source(function_source, imports=None):
     func = ns[funcname]
     return func
 
+
+def function_reference(function):
+    """Returns 'module:name' if function can be imported by name or None"""
+    module = getattr(function, '__module__', None)
+    name = getattr(function, '__name__', None)
+    if module in [None, '__main__'] or name in [None, '<lambda>']:
+        return None
+    try:
+        if getattr(import_module(module), name, None) is function:
+            return '%s:%s' % (module, name)
+    except ImportError:
+        pass
+    return None
+
+
+def import_function(reference):
+    """Returns the function named by a reference from function_reference"""
+    module, name = reference.split(':')
+    return getattr(import_module(module), name)
+
 def find_indices(condition):
    "Return the indices where ravel(condition) is true"
    res, = np.nonzero(np.ravel(condition))
@@ -9,7 +9,10 @@ from nipype.utils.filemanip import (save_json, load_json, loadflat,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    cleandir, split_filename)
+                                    cleandir, split_filename, hash_infile,
+                                    clear_hash_cache, hash_infile_sampled,
+                                    hash_infiles)
+import nipype.utils.filemanip as fm
 
 import numpy as np
 
@@ -65,6 +68,72 @@ def _temp_analyze_files():
     fp.close()
     return orig_img, orig_hdr
 
+def test_hash_infile_memo():
+    fd, name = mkstemp(suffix='.txt')
+    os.write(fd, 'some data')
+    os.close(fd)
+    clear_hash_cache()
+    hashval = hash_infile(name)
+    yield assert_equal, hashval, '1e50210a0202497fb79bc38b6ade6c34'
+    yield assert_equal, len(fm._content_hashes), 1
+    yield assert_equal, hash_infile(name), hashval
+    yield assert_equal, len(fm._content_hashes), 1
+    # a modified file gets a new key
+    fp = file(name, 'w')
+    fp.write('other data!')
+    fp.close()
+    yield assert_equal, hash_infile(name), '8508936207212889d38855c5a436107e'
+    # including a rewrite of the same size with the same mtime
+    os.utime(name, (1e9, 1e9))
+    hashval = hash_infile(name)
+    fp = file(name, 'w')
+    fp.write('OTHER DATA!')
+    fp.close()
+    os.utime(name, (1e9, 1e9))
+    yield assert_false, hash_infile(name) == hashval
+    yield assert_equal, hash_infile(name + 'missing'), None
+    os.unlink(name)
+    clear_hash_cache()
+    yield assert_equal, len(fm._content_hashes), 0
+
+def test_hash_infile_sampled():
+    fd, name = mkstemp(suffix='.nii')
+    blocklen = fm.SAMPLE_BLOCK_LEN
+    os.write(fd, '\0' * (fm.SAMPLE_HEADER_LEN + 64 * blocklen))
+    os.close(fd)
+    clear_hash_cache()
+    hashval = hash_infile_sampled(name)
+    yield assert_true, hashval.startswith('sampledmd5:')
+    # changes to sampled blocks are seen, changes between them are not
+    fp = file(name, 'r+b')
+    fp.seek(fm.SAMPLE_HEADER_LEN + blocklen + 1)
+    fp.write('x')
+    fp.close()
+    clear_hash_cache()
+    yield assert_equal, hash_infile_sampled(name), hashval
+    fp = file(name, 'r+b')
+    fp.seek(1)
+    fp.write('x')
+    fp.close()
+    clear_hash_cache()
+    yield assert_false, hash_infile_sampled(name) == hashval
+    os.unlink(name)
+
+def test_hash_infiles():
+    names = []
+    for idx in range(3):
+        fd, name = mkstemp(suffix='.txt')
+        os.write(fd, 'data %d' % idx)
+        os.close(fd)
+        names.append(name)
+    clear_hash_cache()
+    hashes = hash_infiles(names + names[:1], 'content')
+    yield assert_equal, sorted(hashes.keys()), sorted(names)
+    for name in names:
+        yield assert_equal, hashes[name], hash_infile(name)
+    for name in names:
+        os.unlink(name)
+
 def test_copyfile():
     orig_img, orig_hdr = _temp_analyze_files()
     pth, fname = os.path.split(orig_img)
@@ -0,0 +1,80 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal
+from nipype import config
+import nipype.utils.filemanip as fm
+from nipype.utils.hashcache import HashCache, get_hash_cache
+
+
+def _write(fname, data):
+    fp = file(fname, 'wb')
+    fp.write(data)
+    fp.close()
+
+
+def test_hash_cache():
+    tmpdir = mkdtemp()
+    cache = HashCache(os.path.join(tmpdir, 'cache', 'hashes.sqlite'),
+                      max_entries=2)
+    fname = os.path.join(tmpdir, 'data.nii')
+    _write(fname, 'some data')
+    yield assert_equal, cache.get(fname), None
+    cache.set(fname, 'abc')
+    yield assert_equal, cache.get(fname), 'abc'
+    # entries are tagged with their hash method
+    yield assert_equal, cache.get(fname, 'content_fast'), None
+    # the entry is keyed by the file metadata
+    _write(fname, 'other data!')
+    yield assert_equal, cache.get(fname), None
+    # including a rewrite of the same size within the mtime resolution
+    os.utime(fname, (1e9, 1e9))
+    cache.set(fname, 'abc')
+    _write(fname, 'OTHER DATA!')
+    os.utime(fname, (1e9, 1e9))
+    yield assert_equal, cache.get(fname), None
+    yield assert_equal, cache.get(os.path.join(tmpdir, 'missing')), None
+    # least recently used entries are evicted
+    for idx in range(3):
+        name = os.path.join(tmpdir, 'file%d' % idx)
+        _write(name, str(idx))
+        cache.set(name, str(idx))
+    cache.evict()
+    yield assert_equal, len(cache), 2
+    yield assert_equal, cache.get(os.path.join(tmpdir, 'file2')), '2'
+    yield assert_equal, cache.get(fname), None
+    cache.clear()
+    yield assert_equal, len(cache), 0
+    rmtree(tmpdir)
+
+
+def test_hash_infile_uses_cache():
+    tmpdir = mkdtemp()
+    cache_file = os.path.join(tmpdir, 'hashes.sqlite')
+    old_cache = config.get('execution', 'hash_cache')
+    old_cache_file = config.get('execution', 'hash_cache_file')
+    config.set('execution', 'hash_cache', 'true')
+    config.set('execution', 'hash_cache_file', cache_file)
+    fname = os.path.join(tmpdir, 'data.nii')
+    _write(fname, 'some data')
+    fm.clear_hash_cache()
+    try:
+        hashval = fm.hash_infile(fname)
+        cache = get_hash_cache()
+        yield assert_equal, cache.filename, cache_file
+        yield assert_equal, cache.get(fname), hashval
+        # a fresh process finds the digest on disk
+        fm.clear_hash_cache()
+        cache.set(fname, 'cached')
+        yield assert_equal, fm.hash_infile(fname), 'cached'
+        config.set('execution', 'hash_cache', 'false')
+        fm.clear_hash_cache()
+        yield assert_equal, fm.hash_infile(fname), hashval
+    finally:
+        config.set('execution', 'hash_cache', old_cache)
+        config.set('execution', 'hash_cache_file', old_cache_file)
+        fm.clear_hash_cache()
+    rmtree(tmpdir)
@@ -3,7 +3,9 @@
 from nipype.testing import assert_equal, assert_true, assert_false
 
 from nipype.utils.misc import (container_to_string, getsource,
-                               create_function_from_source, str2bool)
+                               create_function_from_source, str2bool,
+                               clear_function_cache, function_reference,
+                               import_function)
 
 def test_cont_to_str():
     # list
@@ -40,6 +42,26 @@ def test_func_to_str():
         f_recreated = create_function_from_source(f_src)
         yield assert_equal, f(2.3), f_recreated(2.3)
 
+def test_function_cache():
+    f_src = getsource(_func1)
+    func = create_function_from_source(f_src)
+    yield assert_true, create_function_from_source(f_src) is func
+    with_imports = create_function_from_source(f_src, ['import os'])
+    yield assert_false, with_imports is func
+    yield assert_true, 'os' in with_imports.func_globals
+    clear_function_cache()
+    yield assert_false, create_function_from_source(f_src) is func
+
+def test_function_reference():
+    ref = function_reference(_func1)
+    yield assert_equal, ref, '%s:_func1' % __name__
+    yield assert_true, import_function(ref) is _func1
+    yield assert_equal, function_reference(lambda x: x), None
+
+    def func1(x):
+        return x**2
+    yield assert_equal, function_reference(func1), None
+
 def test_str2bool():
     yield assert_true, str2bool("yes")
     yield assert_true, str2bool("true")
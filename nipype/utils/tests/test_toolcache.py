@@ -0,0 +1,77 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from nipype.testing import assert_equal
+from nipype.interfaces.base import CommandLine
+from nipype.utils.toolcache import (cached_version, clear_tool_cache,
+                                    get_cached)
+
+
+def test_cached_version():
+    calls = []
+
+    @cached_version('faketool', env_vars=['FAKETOOLDIR'])
+    def version(flag=None):
+        calls.append(flag)
+        return '1.%d' % len(calls)
+
+    clear_tool_cache()
+    old_dir = os.environ.pop('FAKETOOLDIR', None)
+    yield assert_equal, version(), '1.1'
+    yield assert_equal, version(), '1.1'
+    yield assert_equal, version('-v'), '1.2'
+    # the environment locating the tool is part of the key
+    os.environ['FAKETOOLDIR'] = '/opt/faketool'
+    yield assert_equal, version(), '1.3'
+    yield assert_equal, version(), '1.3'
+    del os.environ['FAKETOOLDIR']
+    yield assert_equal, version(), '1.1'
+    yield assert_equal, len(calls), 3
+    clear_tool_cache()
+    yield assert_equal, version(), '1.4'
+    if old_dir is not None:
+        os.environ['FAKETOOLDIR'] = old_dir
+    clear_tool_cache()
+
+
+def test_cached_version_values():
+    found = []
+
+    @cached_version('faketool')
+    def version():
+        if not found:
+            return None
+        return {'name': 'faketool', 'release': found[0]}
+
+    clear_tool_cache()
+    # a missing tool is looked up again
+    yield assert_equal, version(), None
+    found.append('1.0')
+    yield assert_equal, version(), {'name': 'faketool', 'release': '1.0'}
+    # callers get their own copy of the cached value
+    version()['release'] = '2.0'
+    found[0] = '3.0'
+    yield assert_equal, version(), {'name': 'faketool', 'release': '1.0'}
+    clear_tool_cache()
+
+
+def test_exists_in_path_cache():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'faketool')
+    open(fname, 'wt').close()
+    clear_tool_cache()
+    environ = dict(PATH=tmpdir)
+    cmd = CommandLine(command='faketool')
+    yield assert_equal, cmd._exists_in_path('faketool', environ), (True, fname)
+    yield (assert_equal, get_cached(('exists_in_path', 'faketool', tmpdir,
+                                     os.environ.get('PATHEXT', ''))), fname)
+    yield assert_equal, cmd._exists_in_path('faketool', environ), (True, fname)
+    # removed executables are not reported from the cache
+    os.remove(fname)
+    yield (assert_equal, cmd._exists_in_path('faketool', environ),
+           (False, None))
+    clear_tool_cache()
+    rmtree(tmpdir)
@@ -0,0 +1,105 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Process-wide cache of tool versions and executable locations
+
+Querying the version of a package can be expensive: SPM starts a MATLAB
+session, FSL and AFNI run a subprocess. The lookups are memoised per
+process, keyed by the tool, the arguments of the lookup and the
+environment variables locating the tool, and can optionally be persisted
+in the nipype data file (``~/.nipype/nipype.json``) by setting
+``execution.persist_tool_versions``.
+
+>>> from nipype.utils.toolcache import cached_version
+>>> @cached_version('mytool', env_vars=['MYTOOLDIR'])
+... def version():
+...     return '1.0'
+>>> version()
+'1.0'
+"""
+from copy import deepcopy
+from functools import wraps
+from hashlib import md5
+import os
+import threading
+
+from .. import config, logging
+from .misc import str2bool
+iflogger = logging.getLogger('interface')
+
+_cache = {}
+_lock = threading.Lock()
+_missing = object()
+
+
+def get_cached(key, default=None):
+    """Returns the value cached under key"""
+    return _cache.get(key, default)
+
+
+def set_cached(key, value):
+    """Caches value under key for the lifetime of the process"""
+    with _lock:
+        _cache[key] = value
+
+
+def clear_tool_cache():
+    """Forgets all the memoised versions and executable locations"""
+    with _lock:
+        _cache.clear()
+
+
+def _persist():
+    return str2bool(config.get('execution', 'persist_tool_versions'))
+
+
+def _data_key(key):
+    return 'tool_version_%s' % md5(repr(key)).hexdigest()
+
+
+def _copy(value):
+    """Returns a copy of mutable values so that callers cannot alter the
+    cached one"""
+    if isinstance(value, (dict, list)):
+        return deepcopy(value)
+    return value
+
+
+def cached_version(tool, env_vars=None):
+    """Decorates a version lookup of tool to memoise its result
+
+    Parameters
+    ----------
+    tool : str
+        name of the tool
+    env_vars : list of str
+        environment variables locating the tool; PATH is always included
+
+    Exceptions raised by the lookup and None results (e.g., the tool is not
+    installed yet) are not cached. Dictionaries and lists are returned as
+    copies.
+    """
+    env_vars = ['PATH'] + [var for var in (env_vars or []) if var != 'PATH']
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (tool, tuple((var, os.environ.get(var))
+                               for var in env_vars),
+                   args, tuple(sorted(kwargs.items())))
+            value = get_cached(key, _missing)
+            if value is not _missing:
+                return _copy(value)
+            value = None
+            persist = _persist()
+            if persist:
+                value = config.get_data(_data_key(key))
+            if value is None:
+                value = func(*args, **kwargs)
+                if persist and value is not None:
+                    config.save_data(_data_key(key), value)
+            iflogger.debug('%s version: %s' % (tool, value))
+            if value is not None:
+                set_cached(key, value)
+            return _copy(value)
+        return wrapper
+    return decorator
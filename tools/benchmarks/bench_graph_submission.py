@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the submission phase of the graph plugins.
+
+Expands a workflow of Function nodes that all depend on a common first
+node, then runs a graph plugin that writes the job files of every node but
+does not submit them, and reports the time taken by the plugin.
+
+Example::
+
+    python tools/benchmarks/bench_graph_submission.py -n 20000 -t 1,4
+"""
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+from nipype.pipeline.plugins.base import GraphPluginBase
+
+
+def increment(a):
+    return a + 1
+
+
+class NullGraphPlugin(GraphPluginBase):
+    """Graph plugin that does not submit the jobs
+    """
+    def _submit_graph(self, pyfiles, dependencies, nodes):
+        self.njobs = len(pyfiles)
+
+
+class GraphRecorder(object):
+    """Execution plugin that only records the execution graph
+    """
+    def run(self, graph, config, updatehash=False):
+        self.graph = graph
+        self.config = config
+
+
+def fanout_workflow(nnodes, base_dir):
+    """Returns a workflow of nnodes function nodes fed by a first node
+    """
+    wf = pe.Workflow(name='fanout', base_dir=base_dir)
+    first = pe.Node(Function(input_names=['a'], output_names=['a'],
+                             function=increment), name='first')
+    first.inputs.a = 0
+    nodes = [pe.Node(Function(input_names=['a'], output_names=['a'],
+                              function=increment),
+                     name='increment%d' % idx) for idx in range(nnodes - 1)]
+    wf.connect([(first, node, [('a', 'a')]) for node in nodes])
+    wf.config['execution'] = {'create_report': 'false'}
+    return wf
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--nodes', dest='nnodes', type='int',
+                      default=20000, help='number of nodes in the workflow')
+    parser.add_option('-t', '--threads', dest='threads', default='1,4',
+                      help='comma separated numbers of payload threads')
+    options, _ = parser.parse_args()
+    logging.getLogger('workflow').setLevel('ERROR')
+    base_dir = mkdtemp()
+    wf = fanout_workflow(options.nnodes, base_dir)
+    recorder = GraphRecorder()
+    wf.run(plugin=recorder)
+    print '%8s %8s %12s' % ('nodes', 'threads', 'submit (s)')
+    for threads in [int(count) for count in options.threads.split(',')]:
+        plugin = NullGraphPlugin(plugin_args=dict(payload_threads=threads))
+        t0 = time()
+        plugin.run(recorder.graph, recorder.config)
+        elapsed = time() - t0
+        print '%8d %8d %12.2f' % (plugin.njobs, threads, elapsed)
+    rmtree(base_dir)
+
+if __name__ == '__main__':
+    main()
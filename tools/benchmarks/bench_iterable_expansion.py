@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the expansion of iterables into the execution graph.
+
+Builds a subjects x sessions x parameters workflow for increasing numbers
+of subjects and reports the time taken by generate_expanded_graph and the
+size of the expanded graph.
+
+Example::
+
+    python tools/benchmarks/bench_iterable_expansion.py -s 10,100,1000
+"""
+from optparse import OptionParser
+from time import time
+
+from nipype import logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function, IdentityInterface
+
+
+def smooth(in_file, fwhm):
+    return '%s_%s' % (in_file, fwhm)
+
+
+def fanout_workflow(nsubjects, nsessions, nparams):
+    """Returns a workflow iterating over subjects, sessions and parameters
+    """
+    wf = pe.Workflow(name='fanout')
+    subjects = pe.Node(IdentityInterface(fields=['subject']), name='subjects')
+    subjects.iterables = ('subject', ['sub%04d' % i
+                                      for i in range(nsubjects)])
+    sessions = pe.Node(IdentityInterface(fields=['subject', 'session']),
+                       name='sessions')
+    sessions.iterables = ('session', range(nsessions))
+    select = pe.Node(Function(input_names=['in_file', 'fwhm'],
+                              output_names=['out'], function=smooth),
+                     name='select')
+    select.inputs.fwhm = 0
+    sweep = pe.Node(Function(input_names=['in_file', 'fwhm'],
+                             output_names=['out'], function=smooth),
+                    name='sweep')
+    sweep.iterables = ('fwhm', range(nparams))
+    report = pe.Node(Function(input_names=['in_file', 'fwhm'],
+                              output_names=['out'], function=smooth),
+                     name='report')
+    report.inputs.fwhm = 0
+    wf.connect([(subjects, sessions, [('subject', 'subject')]),
+                (sessions, select, [('subject', 'in_file')]),
+                (select, sweep, [('out', 'in_file')]),
+                (sweep, report, [('out', 'in_file')])])
+    return wf
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--subjects', dest='subjects',
+                      default='10,30,100,300',
+                      help='comma separated numbers of subjects')
+    parser.add_option('-e', '--sessions', dest='nsessions', type='int',
+                      default=4, help='number of sessions')
+    parser.add_option('-p', '--params', dest='nparams', type='int',
+                      default=3, help='number of parameter values')
+    options, _ = parser.parse_args()
+    logging.getLogger('workflow').setLevel('ERROR')
+    print '%8s %8s %10s %12s' % ('subjects', 'nodes', 'expand (s)',
+                                 'ms/node')
+    for nsubjects in [int(count) for count in options.subjects.split(',')]:
+        wf = fanout_workflow(nsubjects, options.nsessions, options.nparams)
+        flatgraph = wf._create_flat_graph()
+        t0 = time()
+        execgraph = pe.generate_expanded_graph(flatgraph)
+        elapsed = time() - t0
+        nnodes = len(execgraph)
+        print '%8d %8d %10.2f %12.3f' % (nsubjects, nnodes, elapsed,
+                                         1e3 * elapsed / nnodes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the chunksize option of MapNode.
+
+Runs a MapNode of a trivial Function over many items once for every chunk
+size, with per item and per chunk caching, and reports the run time of the
+first run and of a rerun with all the items cached.
+
+Example::
+
+    python tools/benchmarks/bench_mapnode_chunksize.py -n 10000 -p MultiProc
+"""
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+
+
+def increment(a):
+    return a + 1
+
+
+def mapnode_workflow(nitems, chunksize, cache_chunks, base_dir):
+    """Returns a workflow with a single mapnode over nitems items
+    """
+    wf = pe.Workflow(name='chunks', base_dir=base_dir)
+    node = pe.MapNode(Function(input_names=['a'], output_names=['a'],
+                               function=increment),
+                      iterfield=['a'], name='increment', chunksize=chunksize,
+                      cache_chunks=cache_chunks)
+    node.inputs.a = range(nitems)
+    wf.add_nodes([node])
+    wf.config['execution'] = {'create_report': 'false'}
+    return wf
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--items', dest='nitems', type='int',
+                      default=10000, help='number of mapnode items')
+    parser.add_option('-c', '--chunksizes', dest='chunksizes',
+                      default='1,10,100,1000',
+                      help='comma separated chunk sizes')
+    parser.add_option('-p', '--plugin', dest='plugin', default='MultiProc',
+                      help='execution plugin')
+    options, _ = parser.parse_args()
+    logging.getLogger('workflow').setLevel('ERROR')
+    logging.getLogger('interface').setLevel('ERROR')
+    print '%9s %8s %10s %10s' % ('chunksize', 'cache', 'first (s)',
+                                 'rerun (s)')
+    for chunksize in [int(size) for size in options.chunksizes.split(',')]:
+        for cache_chunks in [False, True]:
+            if chunksize == 1 and cache_chunks:
+                continue
+            base_dir = mkdtemp()
+            wf = mapnode_workflow(options.nitems, chunksize, cache_chunks,
+                                  base_dir)
+            times = []
+            for _ in range(2):
+                t0 = time()
+                wf.run(plugin=options.plugin)
+                times.append(time() - t0)
+            print '%9d %8s %10.2f %10.2f' % (
+                chunksize, ['item', 'chunk'][cache_chunks], times[0],
+                times[1])
+            rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the cost of W3C PROV generation.
+
+Runs a workflow of alternating IdentityInterface and Function nodes once
+for every execution.write_provenance mode and reports the run time.
+
+Example::
+
+    python tools/benchmarks/bench_provenance.py -n 1000
+"""
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function, IdentityInterface
+
+
+def increment(a):
+    return a + 1
+
+
+def chain_workflow(nnodes, base_dir):
+    """Returns a workflow of nnodes alternating identity and function nodes
+    """
+    wf = pe.Workflow(name='chain', base_dir=base_dir)
+    previous = None
+    for idx in range(nnodes):
+        if idx % 2:
+            node = pe.Node(Function(input_names=['a'], output_names=['a'],
+                                    function=increment),
+                           name='increment%d' % idx)
+        else:
+            node = pe.Node(IdentityInterface(fields=['a']),
+                           name='identity%d' % idx)
+        if previous is None:
+            node.inputs.a = 0
+            wf.add_nodes([node])
+        else:
+            wf.connect(previous, 'a', node, 'a')
+        previous = node
+    return wf
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--nodes', dest='nnodes', type='int',
+                      default=1000, help='number of nodes in the workflow')
+    parser.add_option('-p', '--plugin', dest='plugin', default='Linear',
+                      help='execution plugin')
+    options, _ = parser.parse_args()
+    logging.getLogger('workflow').setLevel('ERROR')
+    logging.getLogger('interface').setLevel('ERROR')
+    for mode in ['off', 'node', 'workflow']:
+        base_dir = mkdtemp()
+        wf = chain_workflow(options.nnodes, base_dir)
+        wf.config['execution'] = {'write_provenance': mode,
+                                  'create_report': 'false'}
+        t0 = time()
+        wf.run(plugin=options.plugin)
+        elapsed = time() - t0
+        print '%8s: %8.2f s (%.1f ms/node)' % (
+            mode, elapsed, 1e3 * elapsed / options.nnodes)
+        rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Microbenchmark of the per-node overhead of runtime information capture.
+
+Runs a trivial command line interface repeatedly at every level of
+execution.runtime_capture and reports the mean time per run. The first run
+of each level, which fills the per-process caches, is reported separately.
+
+Example::
+
+    python tools/benchmarks/bench_runtime_capture.py -n 200
+"""
+from optparse import OptionParser
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import config, logging
+from nipype.interfaces.base import CommandLine
+from nipype.utils.toolcache import clear_tool_cache
+
+
+def run_level(level, nruns):
+    config.set('execution', 'runtime_capture', level)
+    clear_tool_cache()
+    interface = CommandLine(command='true', terminal_output='none')
+    t0 = time()
+    interface.run()
+    first = time() - t0
+    t0 = time()
+    for _ in range(nruns):
+        interface.run()
+    return first, (time() - t0) / nruns
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--runs', dest='nruns', type='int', default=100,
+                      help='number of runs per level')
+    options, _ = parser.parse_args()
+    logging.getLogger('interface').setLevel('ERROR')
+    cwd = os.getcwd()
+    tmpdir = mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        for level in ['none', 'basic', 'full']:
+            first, mean = run_level(level, options.nruns)
+            print '%6s: first run %8.2f ms, then %8.2f ms/run' % (
+                level, 1e3 * first, 1e3 * mean)
+    finally:
+        os.chdir(cwd)
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Microbenchmark of the DistributedPluginBase scheduler.
+
+Runs synthetic random DAGs through a plugin whose jobs finish instantly, so
+that the measured time is the scheduling overhead of the plugin base class.
+
+Example::
+
+    python tools/benchmarks/bench_scheduler.py -n 1000 -n 10000 -n 100000
+"""
+from optparse import OptionParser
+import random
+from time import time
+
+import networkx as nx
+
+from nipype import logging
+from nipype.pipeline.plugins.base import DistributedPluginBase
+
+
+class FakeInterface(object):
+    always_run = False
+
+
+class FakeNode(object):
+    """Minimal stand-in for a pipeline node"""
+
+    def __init__(self, idx, config):
+        self._id = 'node%d' % idx
+        self.config = config
+        self.overwrite = None
+        self.run_without_submitting = False
+        self._interface = FakeInterface()
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class InstantPlugin(DistributedPluginBase):
+    """Plugin whose jobs finish as soon as they are submitted"""
+
+    _use_notification = True
+
+    def __init__(self, plugin_args=None):
+        super(InstantPlugin, self).__init__(plugin_args=plugin_args)
+        self._taskid = 0
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        self._notify_task_done(self._taskid)
+        return self._taskid
+
+    def _get_result(self, taskid):
+        return dict(result=None, traceback=None)
+
+    def _clear_task(self, taskid):
+        pass
+
+
+def random_dag(nnodes, max_parents=3, seed=0):
+    """Returns a random DAG where each node depends on earlier nodes"""
+    rng = random.Random(seed)
+    config = dict(execution=dict(local_hash_check='false',
+                                 remove_node_directories='false',
+                                 stop_on_first_crash='false'))
+    nodes = [FakeNode(idx, config) for idx in range(nnodes)]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    for idx in range(1, nnodes):
+        window = max(0, idx - 100)
+        for _ in range(rng.randint(0, max_parents)):
+            graph.add_edge(nodes[rng.randint(window, idx - 1)], nodes[idx])
+    return graph, config
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--nodes', dest='sizes', action='append',
+                      type='int', help='number of nodes in the DAG')
+    parser.add_option('-j', '--max-jobs', dest='max_jobs', type='int',
+                      default=None, help='maximum number of pending jobs')
+    options, _ = parser.parse_args()
+    sizes = options.sizes or [1000, 10000, 100000]
+    logging.getLogger('workflow').setLevel('ERROR')
+    plugin_args = dict(poll_interval=0)
+    if options.max_jobs:
+        plugin_args['max_jobs'] = options.max_jobs
+    for size in sizes:
+        graph, config = random_dag(size)
+        plugin = InstantPlugin(plugin_args=plugin_args)
+        t0 = time()
+        plugin.run(graph, config)
+        elapsed = time() - t0
+        print '%8d nodes %8d edges: %8.2f s (%.1f us/node)' % (
+            size, graph.number_of_edges(), elapsed, 1e6 * elapsed / size)
+
+
+if __name__ == '__main__':
+    main()
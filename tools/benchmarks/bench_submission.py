@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Microbenchmark of the per-task submission overhead of MultiProc.
+
+Compares sending a deep copy of each node to the workers (the previous
+behaviour) with sending the lightweight task descriptors of
+`nipype.pipeline.plugins.multiproc.create_task`.
+
+Example::
+
+    python tools/benchmarks/bench_submission.py -n 2000
+"""
+from copy import deepcopy
+import cPickle
+from optparse import OptionParser
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import config
+import nipype.interfaces.fsl as fsl
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.multiproc import create_task, load_task, init_worker
+from nipype.pipeline.utils import merge_dict
+
+
+def make_nodes(nnodes, wf_config, datadir):
+    nodes = []
+    for idx in range(nnodes):
+        in_file = os.path.join(datadir, 'func%04d.nii.gz' % idx)
+        open(in_file, 'wb').close()
+        node = pe.Node(fsl.ImageMaths(op_string='-add 1', out_data_type='float',
+                                      suffix='_add'),
+                       name='maths%d' % idx)
+        node.inputs.in_file = in_file
+        node.config = merge_dict(deepcopy(wf_config), {})
+        node.base_dir = datadir
+        node.input_source = {'in_file': (os.path.join(datadir, 'prev',
+                                                      'result_prev.pklz'),
+                                         'out_file')}
+        nodes.append(node)
+    return nodes
+
+
+def time_it(func, nodes):
+    t0 = time()
+    size = 0
+    for node in nodes:
+        size += func(node)
+    return time() - t0, size
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--nodes', dest='nnodes', type='int',
+                      default=1000, help='number of nodes to submit')
+    options, _ = parser.parse_args()
+    wf_config = deepcopy(config._sections)
+    datadir = mkdtemp(prefix='bench_submission_')
+    nodes = make_nodes(options.nnodes, wf_config, datadir)
+    init_worker(wf_config)
+
+    def copy_and_pickle(node):
+        data = cPickle.dumps(deepcopy(node), 2)
+        cPickle.loads(data)
+        return len(data)
+
+    def descriptor(node):
+        data = cPickle.dumps(create_task(node, wf_config), 2)
+        load_task(cPickle.loads(data))
+        return len(data)
+
+    for label, func in [('deepcopy + pickle node', copy_and_pickle),
+                        ('task descriptor', descriptor)]:
+        elapsed, size = time_it(func, nodes)
+        print '%-24s %8.1f us/task %8d bytes/task' % (
+            label, 1e6 * elapsed / len(nodes), size / len(nodes))
+    rmtree(datadir)
+
+
+if __name__ == '__main__':
+    main()
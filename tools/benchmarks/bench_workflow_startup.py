@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the startup cost of Workflow.run.
+
+Builds a workflow of nested workflows of Function nodes and runs it with a
+plugin that does not execute anything, so that only the flattening and the
+expansion of the workflow are measured. Reports the run time and the
+increase of the peak resident memory of the process. With --cache, the
+workflow is run twice with execution.cache_execution_plan and the second run
+loads the cached execution graph.
+
+Example::
+
+    python tools/benchmarks/bench_workflow_startup.py -w 50 -n 100 --cache
+"""
+from optparse import OptionParser
+import resource
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+
+
+def increment(a):
+    return a + 1
+
+
+class NullPlugin(object):
+    """Execution plugin that only records the execution graph
+    """
+    def run(self, graph, config, updatehash=False):
+        self.graph = graph
+
+
+def nested_workflow(nworkflows, nnodes):
+    """Returns a workflow of nworkflows chains of nnodes function nodes
+    """
+    wf = pe.Workflow(name='outer')
+    for widx in range(nworkflows):
+        inner = pe.Workflow(name='inner%d' % widx)
+        previous = None
+        for idx in range(nnodes):
+            node = pe.Node(Function(input_names=['a'], output_names=['a'],
+                                    function=increment),
+                           name='increment%d' % idx)
+            if previous is None:
+                node.inputs.a = widx
+                inner.add_nodes([node])
+            else:
+                inner.connect(previous, 'a', node, 'a')
+            previous = node
+        wf.add_nodes([inner])
+    return wf
+
+
+def max_rss():
+    """Returns the peak resident memory of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-w', '--workflows', dest='nworkflows', type='int',
+                      default=50, help='number of nested workflows')
+    parser.add_option('-n', '--nodes', dest='nnodes', type='int',
+                      default=100, help='number of nodes per workflow')
+    parser.add_option('-c', '--cache', dest='cache', action='store_true',
+                      default=False, help='cache the execution plan')
+    options, _ = parser.parse_args()
+    logging.getLogger('workflow').setLevel('ERROR')
+    wf = nested_workflow(options.nworkflows, options.nnodes)
+    wf.config['execution'] = {'create_report': 'false'}
+    if options.cache:
+        wf.base_dir = mkdtemp()
+        wf.config['execution']['cache_execution_plan'] = 'true'
+    print '%8s %8s %10s %14s' % ('nodes', 'run', 'run (s)', 'peak RSS (MB)')
+    for run in range([1, 2][options.cache]):
+        plugin = NullPlugin()
+        rss = max_rss()
+        t0 = time()
+        wf.run(plugin=plugin)
+        elapsed = time() - t0
+        print '%8d %8d %10.2f %+14.1f' % (len(plugin.graph), run + 1,
+                                          elapsed, max_rss() - rss)
+    if options.cache:
+        rmtree(wf.base_dir)
+
+if __name__ == '__main__':
+    main()